@@ -1,12 +1,22 @@
-import csv
-import io
-
 from django import forms
 from django.contrib import admin, messages
+from django.shortcuts import redirect
 from django.template.response import TemplateResponse
 from django.urls import path
 
-from .models import Game, GamePlayer, GameQuestion, GameTurn, Player, Question, Room
+from .jobs import enqueue_import
+from .models import (
+    Game,
+    GameEvent,
+    GamePlayer,
+    GameQuestion,
+    GameTurn,
+    Player,
+    Question,
+    QuestionImportJob,
+    Room,
+    TurnAnswer,
+)
 
 
 @admin.register(Question)
@@ -36,16 +46,10 @@ class QuestionAdmin(admin.ModelAdmin):
         if request.method == "POST":
             form = QuestionImportForm(request.POST, request.FILES)
             if form.is_valid():
-                uploaded = form.cleaned_data["file"]
-                try:
-                    created, errors = import_questions_from_csv(uploaded)
-                    if created:
-                        messages.success(request, f"{created} domande create.")
-                    if errors:
-                        messages.warning(request, f"Import parziale: {errors}")
-                except ValueError as exc:
-                    messages.error(request, str(exc))
-                return self.changelist_view(request)
+                # L'import gira in background: l'avanzamento compare nell'elenco domande.
+                job = enqueue_import(form.cleaned_data["file"])
+                messages.info(request, f"Import di {job.filename} avviato.")
+                return redirect("admin:lobby_question_changelist")
         else:
             form = QuestionImportForm()
 
@@ -54,6 +58,28 @@ class QuestionAdmin(admin.ModelAdmin):
         return TemplateResponse(request, "admin/lobby/question/import_form.html", context)
 
 
+@admin.register(QuestionImportJob)
+class QuestionImportJobAdmin(admin.ModelAdmin):
+    list_display = ("filename", "status", "percent", "rows", "imported", "error_count", "created_at", "finished_at")
+    list_filter = ("status",)
+    readonly_fields = (
+        "filename",
+        "status",
+        "size",
+        "bytes_read",
+        "rows",
+        "imported",
+        "error_count",
+        "errors",
+        "created_at",
+        "started_at",
+        "finished_at",
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+
 class GamePlayerInline(admin.TabularInline):
     model = GamePlayer
     extra = 0
@@ -80,11 +106,25 @@ class GameQuestionInline(admin.TabularInline):
     readonly_fields = ("question",)
 
 
+class TurnAnswerInline(admin.TabularInline):
+    model = TurnAnswer
+    extra = 0
+    can_delete = False
+    readonly_fields = ("turn", "player", "option", "received_at", "was_correct", "points", "rank")
+
+
+class GameEventInline(admin.TabularInline):
+    model = GameEvent
+    extra = 0
+    can_delete = False
+    readonly_fields = ("seq", "version", "kind", "data", "created_at")
+
+
 @admin.register(Game)
 class GameAdmin(admin.ModelAdmin):
-    list_display = ("room", "state", "current_player", "started_at", "finished_at")
+    list_display = ("room", "state", "answer_mode", "current_player", "started_at", "finished_at")
     readonly_fields = ("room", "started_at", "finished_at")
-    inlines = [GamePlayerInline, GameQuestionInline, GameTurnInline]
+    inlines = [GamePlayerInline, GameQuestionInline, GameTurnInline, TurnAnswerInline, GameEventInline]
 
 
 admin.site.register(Room)
@@ -94,60 +134,3 @@ admin.site.register(Player)
 class QuestionImportForm(forms.Form):
     file = forms.FileField(label="File CSV (UTF-8)")
 
-
-def import_questions_from_csv(uploaded_file):
-    try:
-        wrapper = io.TextIOWrapper(uploaded_file, encoding="utf-8")
-    except Exception as exc:
-        raise ValueError(f"Impossibile leggere il file: {exc}") from exc
-
-    reader = csv.DictReader(wrapper)
-    required_headers = {"category", "difficulty", "text", "option_a", "option_b", "option_c", "correct_option"}
-    if set(reader.fieldnames or []) < required_headers:
-        raise ValueError(f"Intestazioni mancanti, attese: {', '.join(sorted(required_headers))}")
-
-    valid_categories = {key for key, _ in Question.CATEGORY_CHOICES}
-    valid_options = {opt for opt, _ in Question.OPTION_CHOICES}
-    created = 0
-    errors = []
-
-    for idx, row in enumerate(reader, start=2):  # start=2 to account for header
-        category = (row.get("category") or "").strip().lower()
-        try:
-            difficulty = int(row.get("difficulty"))
-        except (TypeError, ValueError):
-            errors.append(f"riga {idx}: difficoltà non valida")
-            continue
-        text = (row.get("text") or "").strip()
-        option_a = (row.get("option_a") or "").strip()
-        option_b = (row.get("option_b") or "").strip()
-        option_c = (row.get("option_c") or "").strip()
-        correct_option = (row.get("correct_option") or "").strip().upper()
-        is_active_val = (row.get("is_active") or "true").strip().lower() in ("1", "true", "yes", "y")
-
-        if category not in valid_categories:
-            errors.append(f"riga {idx}: categoria '{category}' non valida")
-            continue
-        if difficulty not in range(1, 6):
-            errors.append(f"riga {idx}: difficoltà fuori range 1-5")
-            continue
-        if correct_option not in valid_options:
-            errors.append(f"riga {idx}: risposta corretta deve essere A/B/C")
-            continue
-        if not text or not option_a or not option_b or not option_c:
-            errors.append(f"riga {idx}: testo o opzioni mancanti")
-            continue
-
-        Question.objects.create(
-            category=category,
-            difficulty=difficulty,
-            text=text,
-            option_a=option_a,
-            option_b=option_b,
-            option_c=option_c,
-            correct_option=correct_option,
-            is_active=is_active_val,
-        )
-        created += 1
-
-    return created, "; ".join(errors)
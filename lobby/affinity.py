@@ -0,0 +1,250 @@
+"""Affinità delle stanze: ogni codice stanza ha un worker proprietario su un anello di hash consistente.
+
+Con più worker (``manage.py run_workers``) un proxy davanti ai processi daphne legge
+ogni richiesta HTTP e l'handshake dei WebSocket, ne ricava il codice stanza (gli URL
+``stanza/<code>/`` di ``urls.py`` e ``ws/stanza/<code>/`` di ``routing.py``) e la inoltra
+al proprietario: cache degli snapshot, registro delle versioni e socket di una stanza
+restano nello stesso processo. Le richieste senza stanza (home, admin, statici) restano
+sul worker già in uso dalla connessione.
+
+Aggiungere o togliere un worker sposta solo le stanze dei suoi tratti dell'anello; il
+nuovo proprietario ricostruisce lo stato dal DB alla prima richiesta. Un worker che non
+risponde esce dall'anello finché non torna raggiungibile.
+"""
+
+import asyncio
+import hashlib
+import itertools
+import re
+from bisect import bisect
+
+ROOM_PATH = re.compile(r"^/(?:ws/)?stanza/([A-Za-z0-9]+)/")
+MAX_HEAD_SIZE = 64 * 1024
+
+
+def room_code_of(path):
+    match = ROOM_PATH.match(path)
+    return match.group(1).upper() if match else None
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Anello con ``replicas`` punti per nodo: chiavi ripartite in modo uniforme, spostamenti minimi."""
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = set(nodes)
+        self.rebuild()
+
+    def rebuild(self):
+        points = sorted((ring_hash(f"{node}#{index}"), node) for node in self.nodes for index in range(self.replicas))
+        self.points = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def add(self, node):
+        self.nodes.add(node)
+        self.rebuild()
+
+    def remove(self, node):
+        self.nodes.discard(node)
+        self.rebuild()
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        return self.owners[bisect(self.points, ring_hash(key)) % len(self.points)]
+
+
+class RequestHead:
+    def __init__(self, raw):
+        lines = raw.decode("latin-1").split("\r\n")
+        self.method, self.path, _ = lines[0].split(" ", 2)
+        self.headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                self.headers[name.strip().lower()] = value.strip()
+
+    @property
+    def upgrade(self):
+        return "upgrade" in self.headers.get("connection", "").lower()
+
+    @property
+    def chunked(self):
+        return "chunked" in self.headers.get("transfer-encoding", "").lower()
+
+    @property
+    def content_length(self):
+        return int(self.headers.get("content-length") or 0)
+
+
+def with_forwarded_for(raw, client_ip):
+    if not client_ip:
+        return raw
+    return raw[:-2] + f"X-Forwarded-For: {client_ip}\r\n\r\n".encode("latin-1")
+
+
+async def pipe(reader, writer, limit=None):
+    """Copia da ``reader`` a ``writer`` fino alla chiusura, oppure ``limit`` byte."""
+    remaining = limit
+    while remaining is None or remaining > 0:
+        chunk = await reader.read(65536 if remaining is None else min(65536, remaining))
+        if not chunk:
+            return False
+        writer.write(chunk)
+        await writer.drain()
+        if remaining is not None:
+            remaining -= len(chunk)
+    return True
+
+
+class Upstream:
+    def __init__(self, node, reader, writer):
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.pump = None
+
+
+class AffinityProxy:
+    """Proxy HTTP/WebSocket verso i worker, su socket Unix, con instradamento per codice stanza.
+
+    I client non mandano una richiesta prima di aver ricevuto la risposta precedente: una
+    connessione keep-alive può quindi passare da un worker all'altro tra una richiesta e
+    l'altra, tenendo aperta una connessione per worker.
+    """
+
+    def __init__(self, ring=None, retry_interval=1.0):
+        self.ring = ring or HashRing()
+        self.addresses = {}  # nodo -> percorso del socket Unix del worker
+        self.retry_interval = retry_interval
+        self.spread = itertools.count()
+        self.checking = set()
+        self.clients = set()
+
+    def add(self, node, path):
+        self.addresses[node] = path
+        self.ring.add(node)
+
+    def remove(self, node):
+        self.ring.remove(node)
+        self.addresses.pop(node, None)
+
+    def route(self, path, current=None):
+        code = room_code_of(path)
+        if code is not None:
+            return self.ring.owner(code)
+        if current is not None and current in self.ring.nodes:
+            return current
+        nodes = sorted(self.ring.nodes)
+        return nodes[next(self.spread) % len(nodes)] if nodes else None
+
+    async def connect(self, node, upstreams, client_writer, state):
+        upstream = upstreams.get(node)
+        if upstream is not None:
+            return upstream
+        reader, writer = await asyncio.open_unix_connection(self.addresses[node])
+        upstream = upstreams[node] = Upstream(node, reader, writer)
+        upstream.pump = asyncio.create_task(self.pump_responses(upstream, upstreams, client_writer, state))
+        return upstream
+
+    async def pump_responses(self, upstream, upstreams, client_writer, state):
+        try:
+            await pipe(upstream.reader, client_writer)
+        except ConnectionError:
+            pass
+        finally:
+            upstreams.pop(upstream.node, None)
+            upstream.writer.close()
+            if state["last"] is upstream:
+                # Il worker ha chiuso dopo l'ultima risposta (Connection: close, timeout): si chiude anche il client.
+                client_writer.close()
+
+    def mark_down(self, node):
+        """Worker irraggiungibile: esce dall'anello e viene ricontrollato finché non risponde."""
+        if node in self.checking or node not in self.addresses:
+            return
+        self.ring.remove(node)
+        self.checking.add(node)
+        asyncio.create_task(self.recheck(node))
+
+    async def recheck(self, node):
+        try:
+            while node in self.addresses:
+                await asyncio.sleep(self.retry_interval)
+                try:
+                    _, writer = await asyncio.open_unix_connection(self.addresses[node])
+                except OSError:
+                    continue
+                writer.close()
+                if node in self.addresses:
+                    self.ring.add(node)
+                return
+        finally:
+            self.checking.discard(node)
+
+    async def handle(self, client_reader, client_writer):
+        upstreams = {}
+        state = {"last": None}
+        self.clients.add(client_writer)
+        peer = client_writer.get_extra_info("peername")
+        client_ip = peer[0] if isinstance(peer, tuple) else None
+        try:
+            while True:
+                try:
+                    raw = await client_reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                try:
+                    head = RequestHead(raw)
+                except ValueError:
+                    client_writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    return
+                upstream = None
+                current = state["last"].node if state["last"] is not None else None
+                for _ in range(max(1, len(self.addresses))):
+                    node = self.route(head.path, current)
+                    if node is None:
+                        break
+                    try:
+                        upstream = await self.connect(node, upstreams, client_writer, state)
+                        break
+                    except OSError:
+                        # Il proprietario è giù: le sue stanze passano al nodo successivo dell'anello.
+                        self.mark_down(node)
+                        current = None
+                if upstream is None:
+                    client_writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    return
+                state["last"] = upstream
+                upstream.writer.write(with_forwarded_for(raw, client_ip))
+                if head.upgrade or head.chunked:
+                    # WebSocket o corpo a lunghezza ignota: da qui in poi la connessione appartiene a questo worker.
+                    await pipe(client_reader, upstream.writer)
+                    return
+                if head.content_length:
+                    if not await pipe(client_reader, upstream.writer, head.content_length):
+                        return
+                else:
+                    await upstream.writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for upstream in list(upstreams.values()):
+                upstream.writer.close()
+            self.clients.discard(client_writer)
+            client_writer.close()
+
+    async def close(self, timeout=5):
+        """Chiude le connessioni aperte e aspetta che i loro handler terminino."""
+        for writer in list(self.clients):
+            writer.close()
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.clients and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+
+    async def serve(self, host, port):
+        return await asyncio.start_server(self.handle, host, port, limit=MAX_HEAD_SIZE, backlog=1024)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class LobbyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'lobby'
+
+    def ready(self):
+        # Collega i segnali di Question all'indice in memoria del banco domande.
+        from . import question_bank  # noqa: F401
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class SnapshotCache:
+    """Cache LRU in-process degli snapshot di stato, indicizzati per (chiave, versione).
+
+    Per ogni chiave si tengono le ultime ``history`` versioni: servono a calcolare
+    i patch per i client che si ricollegano con una versione di poco indietro.
+    Le build sono single-flight per (chiave, versione) e limitate a
+    ``build_concurrency`` in parallelo, così un'ondata di riconnessioni dopo un
+    riavvio produce una build per stanza invece di una per socket.
+    """
+
+    def __init__(self, max_entries=512, history=1, build_concurrency=4):
+        self.max_entries = max_entries
+        self.history = history
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._build_slots = threading.BoundedSemaphore(build_concurrency)
+
+    def get(self, key, version):
+        with self._lock:
+            versions = self._entries.get(key)
+            if versions is None or version not in versions:
+                return None
+            self._entries.move_to_end(key)
+            return versions[version]
+
+    def set(self, key, version, snapshot):
+        with self._lock:
+            versions = self._entries.setdefault(key, {})
+            if len(versions) >= self.history and version < min(versions):
+                # Un builder più lento non deve scalzare versioni più nuove.
+                return
+            versions[version] = snapshot
+            for stale in sorted(versions)[: -self.history]:
+                del versions[stale]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_build(self, key, version, builder):
+        snapshot = self.get(key, version)
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            flight = self._in_flight.setdefault((key, version), threading.Lock())
+        with flight:
+            snapshot = self.get(key, version)
+            if snapshot is None:
+                with self._build_slots:
+                    snapshot = builder()
+                self.set(key, version, snapshot)
+        with self._lock:
+            self._in_flight.pop((key, version), None)
+        return snapshot
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class VersionRegistry:
+    """Ultima versione nota per chiave in questo processo, alimentata da scritture e broadcast.
+
+    Permette di rispondere ai ping dei client senza toccare il DB: se la versione
+    dichiarata dal client è allineata basta un pong.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, key, version):
+        with self._lock:
+            current = self._versions.get(key)
+            if current is None or version > current:
+                self._versions[key] = version
+            self._versions.move_to_end(key)
+            while len(self._versions) > self.max_entries:
+                self._versions.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            return self._versions.get(key)
+
+
+game_snapshots = SnapshotCache(
+    max_entries=getattr(settings, "SNAPSHOT_CACHE_SIZE", 512),
+    history=getattr(settings, "SNAPSHOT_HISTORY", 8),
+    build_concurrency=getattr(settings, "SNAPSHOT_BUILD_CONCURRENCY", 4),
+)
+room_snapshots = SnapshotCache(
+    max_entries=getattr(settings, "SNAPSHOT_CACHE_SIZE", 512),
+    build_concurrency=getattr(settings, "SNAPSHOT_BUILD_CONCURRENCY", 4),
+)
+state_versions = VersionRegistry()
@@ -0,0 +1,461 @@
+"""Channel layer per più processi ASGI sulla stessa macchina, senza servizi esterni.
+
+Ogni processo tiene in memoria le code dei propri canali e i gruppi a cui appartengono
+(come ``InMemoryChannelLayer``) e si collega via socket Unix a un broker locale
+(``manage.py channel_broker``). Il broker conosce i membri di tutti i gruppi e inoltra
+``group_send`` e ``send`` ai processi che ospitano i canali destinatari: un frame per
+processo, qualunque sia il numero di socket collegati a quel processo.
+
+Il broker non decodifica i messaggi: legge l'intestazione JSON (operazione, gruppo,
+canali) e inoltra il corpo così com'è. Il corpo è pickle, quindi i messaggi arrivano con
+gli stessi tipi Python dell'in-memory (chiavi intere comprese), ma si decodifica senza
+classi né funzioni: solo dict, liste, tuple, insiemi, stringhe e numeri, niente che esegua
+codice. Il socket nasce con permessi 0600 e da entrambi i lati si accettano solo processi
+dello stesso utente.
+
+Se il broker non risponde ogni processo continua a consegnare ai propri canali e si
+ricollega in background, ripubblicando i gruppi dei suoi canali.
+"""
+
+import asyncio
+import io
+import json
+import os
+import pickle
+import queue
+import signal
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+# Intestazione di ogni frame: lunghezza dell'header JSON e del corpo.
+FRAME = struct.Struct(">II")
+CLIENT_ID_LENGTH = 12
+
+
+def encode_frame(header, body=b""):
+    head = json.dumps(header, separators=(",", ":")).encode()
+    return FRAME.pack(len(head), len(body)) + head + body
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("connessione chiusa")
+        data += chunk
+    return bytes(data)
+
+
+def read_frame(sock):
+    head_size, body_size = FRAME.unpack(recv_exactly(sock, FRAME.size))
+    header = json.loads(recv_exactly(sock, head_size))
+    return header, recv_exactly(sock, body_size) if body_size else b""
+
+
+async def aread_frame(reader):
+    head_size, body_size = FRAME.unpack(await reader.readexactly(FRAME.size))
+    header = json.loads(await reader.readexactly(head_size))
+    return header, await reader.readexactly(body_size) if body_size else b""
+
+
+class MessageUnpickler(pickle.Unpickler):
+    """Unpickler senza globali: un corpo che nomina una classe o una funzione viene rifiutato."""
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"tipo non ammesso nei messaggi: {module}.{name}")
+
+
+def loads_message(body):
+    return MessageUnpickler(io.BytesIO(body)).load()
+
+
+def peer_uid(sock):
+    """Utente del processo all'altro capo di un socket Unix; None dove SO_PEERCRED non esiste."""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    _, uid, _ = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid
+
+
+def same_user(sock):
+    return peer_uid(sock) in (None, os.getuid())
+
+
+def owner_of(channel):
+    """Processo che ospita un canale ``<prefisso><client>!<locale>``; None per i canali con nome."""
+    mark = channel.find("!")
+    if mark < CLIENT_ID_LENGTH:
+        return None
+    return channel[mark - CLIENT_ID_LENGTH : mark]
+
+
+def resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """Layer di un processo: consegna locale e inoltro tramite il broker per gli altri processi.
+
+    I canali con nome (senza ``!``) restano locali al processo, come nell'in-memory.
+    Un messaggio per un canale pieno di un altro processo viene scartato all'arrivo e
+    contato in ``dropped``: solo la ``send`` a un canale locale può sollevare ``ChannelFull``.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        path="/tmp/quizzzone-channels.sock",
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        reconnect_delay=1.0,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = path
+        self.group_expiry = group_expiry
+        self.reconnect_delay = reconnect_delay
+        self.client_id = uuid.uuid4().hex[:CLIENT_ID_LENGTH]
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.channels = {}  # canale -> deque[(scadenza, messaggio)]
+        self.waiters = {}  # canale -> [(loop, future)] delle receive in attesa
+        self.groups = {}  # gruppo -> {canale: ingresso}, solo canali di questo processo
+        self.outbox = queue.SimpleQueue()
+        self.sock = None
+        self.started = False
+        self.dropped = 0
+
+    # Connessione al broker
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self.read_loop, name="channel-layer-reader", daemon=True).start()
+        threading.Thread(target=self.write_loop, name="channel-layer-writer", daemon=True).start()
+
+    def read_loop(self):
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                if not same_user(sock):
+                    # Socket creato da un altro utente al posto del broker: non gli si crede.
+                    raise ConnectionRefusedError(self.path)
+                self.attach(sock)
+                while True:
+                    header, body = read_frame(sock)
+                    self.deliver_remote(header["channels"], body)
+            except (OSError, EOFError):
+                pass
+            with self.lock:
+                if self.sock is sock:
+                    self.sock = None
+            sock.close()
+            time.sleep(self.reconnect_delay)
+
+    def attach(self, sock):
+        """Presenta il processo al broker e ripubblica i gruppi, prima di qualsiasi frame in coda."""
+        with self.send_lock:
+            with self.lock:
+                frames = [encode_frame({"op": "hello", "client": self.client_id})]
+                frames += [
+                    encode_frame({"op": "group_add", "group": group, "channel": channel})
+                    for group, members in self.groups.items()
+                    for channel in members
+                ]
+                self.sock = sock
+            sock.sendall(b"".join(frames))
+
+    def write_loop(self):
+        while True:
+            frames = [self.outbox.get()]
+            # Quello che si è accumulato nel frattempo parte con una sola scrittura.
+            while len(frames) < 256:
+                try:
+                    frames.append(self.outbox.get_nowait())
+                except queue.Empty:
+                    break
+            with self.send_lock:
+                sock = self.sock
+                if sock is None:
+                    # Senza broker i frame si perdono; i gruppi vengono ripubblicati alla riconnessione.
+                    continue
+                try:
+                    sock.sendall(b"".join(frames))
+                except OSError:
+                    sock.close()
+
+    def publish(self, header, body=b""):
+        self.start()
+        self.outbox.put(encode_frame(header, body))
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    # Code locali
+
+    def expire(self, channel, pending, now):
+        """Scarta i messaggi scaduti; un canale con messaggi scaduti è considerato chiuso ed esce dai gruppi."""
+        expired = False
+        while pending and pending[0][0] < now:
+            pending.popleft()
+            expired = True
+        if expired:
+            for group, members in list(self.groups.items()):
+                if members.pop(channel, None) is not None:
+                    self.outbox.put(encode_frame({"op": "group_discard", "group": group, "channel": channel}))
+                    if not members:
+                        del self.groups[group]
+
+    def deliver(self, channel, message):
+        now = time.time()
+        with self.lock:
+            pending = self.channels.setdefault(channel, deque())
+            self.expire(channel, pending, now)
+            if len(pending) >= self.get_capacity(channel):
+                return False
+            pending.append((now + self.expiry, message))
+            waiters = self.waiters.pop(channel, ())
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(resolve, future)
+            except RuntimeError:
+                # Loop già chiuso (es. un async_to_sync terminato).
+                pass
+        return True
+
+    def deliver_remote(self, channels, body):
+        # Una sola copia per frame, condivisa dai canali di questo processo.
+        try:
+            message = loads_message(body)
+        except pickle.UnpicklingError:
+            self.dropped += len(channels)
+            return
+        for channel in channels:
+            if not self.deliver(channel, message):
+                self.dropped += 1
+
+    def local_members(self, group):
+        horizon = time.time() - self.group_expiry
+        with self.lock:
+            members = self.groups.get(group, {})
+            return [channel for channel, joined in members.items() if joined >= horizon]
+
+    # API del channel layer
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        body = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        owner = owner_of(channel)
+        if owner is not None and owner != self.client_id:
+            self.publish({"op": "send", "channel": channel}, body)
+            return
+        # Anche in locale si consegna la copia decodificata: un tipo non ammesso fallisce qui, da chi invia.
+        if not self.deliver(channel, loads_message(body)):
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        self.start()
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                pending = self.channels.get(channel)
+                if pending:
+                    self.expire(channel, pending, time.time())
+                if pending:
+                    message = pending.popleft()[1]
+                    if not pending:
+                        del self.channels[channel]
+                    return message
+                future = loop.create_future()
+                self.waiters.setdefault(channel, []).append((loop, future))
+            try:
+                await future
+            finally:
+                with self.lock:
+                    waiting = self.waiters.get(channel, [])
+                    if (loop, future) in waiting:
+                        waiting.remove((loop, future))
+                        if not waiting:
+                            del self.waiters[channel]
+
+    async def new_channel(self, prefix="specific."):
+        return f"{prefix}{self.client_id}!{uuid.uuid4().hex[:12]}"
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if owner_of(channel) == self.client_id:
+            with self.lock:
+                self.groups.setdefault(group, {})[channel] = time.time()
+        self.publish({"op": "group_add", "group": group, "channel": channel})
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        with self.lock:
+            members = self.groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del self.groups[group]
+        self.publish({"op": "group_discard", "group": group, "channel": channel})
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        body = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        # Il broker inoltra agli altri processi; ai canali locali si consegna qui, senza andata e ritorno.
+        self.publish({"op": "group_send", "group": group}, body)
+        members = self.local_members(group)
+        if members:
+            self.deliver_remote(members, body)
+
+    async def flush(self):
+        with self.lock:
+            self.channels = {}
+            self.groups = {}
+
+    async def close(self):
+        pass
+
+
+class ChannelBroker:
+    """Broker dei gruppi: un server asyncio sul socket Unix, un client per processo ASGI."""
+
+    def __init__(self, path, group_expiry=86400, max_buffer=16 * 1024 * 1024):
+        self.path = path
+        self.group_expiry = group_expiry
+        self.max_buffer = max_buffer
+        self.clients = {}  # client id -> writer
+        self.connections = set()
+        self.groups = {}  # gruppo -> {canale: ingresso}
+        self.forwarded = 0
+        self.dropped = 0
+        self.server = None
+
+    async def serve(self):
+        """Resta in ascolto fino a SIGINT/SIGTERM, poi chiude le connessioni e rimuove il socket."""
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await self.start()
+        try:
+            await stop.wait()
+        finally:
+            await self.close()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # Socket rimasto da un broker precedente.
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Permessi decisi al bind: il socket non esiste mai con quelli della umask del processo.
+        umask = os.umask(0o177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.server = await asyncio.start_unix_server(self.handle, sock=sock)
+
+    async def close(self):
+        """Chiude il server e le connessioni dei processi, poi rimuove il socket."""
+        try:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            while self.connections:
+                await asyncio.sleep(0.01)
+            await self.server.wait_closed()
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def handle(self, reader, writer):
+        client = None
+        if not same_user(writer.get_extra_info("socket")):
+            writer.close()
+            return
+        self.connections.add(writer)
+        try:
+            while True:
+                header, body = await aread_frame(reader)
+                op = header["op"]
+                if op == "hello":
+                    client = header["client"]
+                    self.clients[client] = writer
+                elif op == "group_add":
+                    self.groups.setdefault(header["group"], {})[header["channel"]] = time.time()
+                elif op == "group_discard":
+                    self.discard(header["group"], header["channel"])
+                elif op == "group_send":
+                    self.forward(client, self.members(header["group"]), body)
+                elif op == "send":
+                    self.forward(client, [header["channel"]], body)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if client is not None and self.clients.get(client) is writer:
+                del self.clients[client]
+                self.drop_client(client)
+            self.connections.discard(writer)
+            writer.close()
+
+    def members(self, group):
+        members = self.groups.get(group)
+        if not members:
+            return []
+        horizon = time.time() - self.group_expiry
+        for channel in [channel for channel, joined in members.items() if joined < horizon]:
+            del members[channel]
+        return list(members)
+
+    def discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    def drop_client(self, client):
+        """I canali di un processo che si è scollegato escono da tutti i gruppi."""
+        for group, members in list(self.groups.items()):
+            for channel in [channel for channel in members if owner_of(channel) == client]:
+                del members[channel]
+            if not members:
+                del self.groups[group]
+
+    def forward(self, sender, channels, body):
+        by_owner = {}
+        for channel in channels:
+            owner = owner_of(channel)
+            if owner is not None and owner != sender:
+                by_owner.setdefault(owner, []).append(channel)
+        for owner, owned in by_owner.items():
+            writer = self.clients.get(owner)
+            if writer is None or writer.transport.get_write_buffer_size() > self.max_buffer:
+                # Processo assente o che non legge: meglio perdere il messaggio che la memoria del broker.
+                self.dropped += len(owned)
+                continue
+            writer.write(encode_frame({"channels": owned}, body))
+            self.forwarded += len(owned)
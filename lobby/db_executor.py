@@ -0,0 +1,119 @@
+"""Pool di thread dedicato al lavoro sul DB dei consumer WebSocket e delle azioni di gioco.
+
+``database_sync_to_async`` e ``sync_to_async`` sono thread-sensitive: sotto daphne
+tutto il lavoro sul DB di tutti i socket del processo passa da un solo thread, e
+un broadcast aspetta gli snapshot di ogni altra stanza. Qui i task vanno su
+``DB_EXECUTOR_WORKERS`` thread, con una coda per stanza servita a turno
+(round-robin): una stanza con molte riconnessioni non affama le altre.
+
+Ogni thread tiene la propria connessione al DB tra un task e l'altro; la chiude
+dopo un errore del DB o quando supera ``DB_EXECUTOR_CONN_MAX_AGE`` secondi.
+Con ``DB_EXECUTOR_WORKERS = 0`` si torna a ``sync_to_async`` (thread unico).
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+
+class DatabaseExecutor:
+    def __init__(self, workers=8, conn_max_age=300.0, name="db"):
+        self.workers = workers
+        self.conn_max_age = conn_max_age
+        self.name = name
+        self._queues = OrderedDict()
+        self._ready = threading.Condition()
+        self._threads = []
+        self._queued = 0
+        self._running = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._started = 0
+        self._wait_total = 0.0
+
+    async def run(self, key, func, *args, **kwargs):
+        """Esegue ``func`` su un thread del pool, nella coda di ``key`` (di solito il codice stanza)."""
+        if self.workers <= 0:
+            return await sync_to_async(func)(*args, **kwargs)
+        return await asyncio.wrap_future(self.submit(key, func, *args, **kwargs))
+
+    def submit(self, key, func, *args, **kwargs):
+        future = Future()
+        with self._ready:
+            self._queues.setdefault(key, deque()).append((future, func, args, kwargs, time.monotonic()))
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+            if len(self._threads) < self.workers and self._queued > len(self._threads) - self._running:
+                self.start_worker()
+            self._ready.notify()
+        return future
+
+    def start_worker(self):
+        thread = threading.Thread(target=self.work, name=f"{self.name}-{len(self._threads)}", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def next_task(self):
+        """Primo task della prima stanza in attesa; la stanza passa in fondo se ha altri task (round-robin)."""
+        with self._ready:
+            while not self._queues:
+                self._ready.wait()
+            key, queue = next(iter(self._queues.items()))
+            task = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            self._queued -= 1
+            self._running += 1
+            self._started += 1
+            self._wait_total += time.monotonic() - task[4]
+            return task
+
+    def work(self):
+        connected_at = time.monotonic()
+        while True:
+            future, func, args, kwargs, _ = self.next_task()
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(*args, **kwargs))
+                    except DatabaseError as exc:
+                        # Connessione forse inutilizzabile: la si riapre al prossimo task.
+                        connections.close_all()
+                        future.set_exception(exc)
+                    except BaseException as exc:
+                        future.set_exception(exc)
+            finally:
+                with self._ready:
+                    self._running -= 1
+                    self._completed += 1
+            if time.monotonic() - connected_at > self.conn_max_age:
+                connections.close_all()
+                connected_at = time.monotonic()
+
+    def stats(self):
+        """Profondità delle code e contatori, per il monitoraggio."""
+        with self._ready:
+            return {
+                "workers": self.workers,
+                "threads": len(self._threads),
+                "running": self._running,
+                "queued": self._queued,
+                "rooms_waiting": len(self._queues),
+                "max_queued": self._max_queued,
+                "completed": self._completed,
+                "avg_wait_ms": round(self._wait_total / self._started * 1000, 3) if self._started else 0.0,
+            }
+
+
+db_executor = DatabaseExecutor(
+    workers=getattr(settings, "DB_EXECUTOR_WORKERS", 8),
+    conn_max_age=getattr(settings, "DB_EXECUTOR_CONN_MAX_AGE", 300.0),
+)
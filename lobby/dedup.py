@@ -0,0 +1,103 @@
+"""Deduplica del banco domande tramite l'impronta del contenuto (``Question.fingerprint``)."""
+
+from django.db import transaction
+from django.db.models import Case, Count, Min, Value, When
+
+from .models import (
+    FINGERPRINT_FIELDS,
+    GameCheckpoint,
+    GameEvent,
+    GameQuestion,
+    GameTurn,
+    Question,
+    question_fingerprint,
+)
+from .question_bank import question_bank
+
+
+def backfill_fingerprints(batch_size=2000):
+    """Calcola l'impronta delle domande che ne sono prive; restituisce quante ne ha aggiornate."""
+    total = 0
+    while batch := list(Question.objects.filter(fingerprint="").order_by("id").only("id", *FINGERPRINT_FIELDS)[:batch_size]):
+        for question in batch:
+            question.fingerprint = question_fingerprint(*(getattr(question, field) for field in FINGERPRINT_FIELDS))
+        Question.objects.bulk_update(batch, ["fingerprint"])
+        total += len(batch)
+    return total
+
+
+def duplicate_groups(batch_size):
+    """Pagine di {impronta: id da tenere} per le impronte con più domande, in ordine di impronta.
+
+    Paginazione per chiave invece di un cursore aperto: tra una pagina e l'altra si scrive.
+    """
+    last = ""
+    while True:
+        page = list(
+            Question.objects.exclude(fingerprint="")
+            .filter(fingerprint__gt=last)
+            .order_by("fingerprint")
+            .values("fingerprint")
+            .annotate(copies=Count("id"), keep=Min("id"))
+            .filter(copies__gt=1)
+            .values_list("fingerprint", "keep")[:batch_size]
+        )
+        if not page:
+            return
+        last = page[-1][0]
+        yield dict(page)
+
+
+def merge_group_page(keepers):
+    """Unisce le copie nella domanda più vecchia; partite e turni passano alla domanda tenuta."""
+    duplicates = list(
+        Question.objects.filter(fingerprint__in=keepers)
+        .exclude(id__in=keepers.values())
+        .values_list("id", "fingerprint", "is_active")
+    )
+    target = {qid: keepers[fingerprint] for qid, fingerprint, _ in duplicates}
+    reactivate = {keepers[fingerprint] for _, fingerprint, is_active in duplicates if is_active}
+    remap = Case(*(When(question_id=qid, then=Value(keep)) for qid, keep in target.items()))
+    with transaction.atomic():
+        remap_game_logs(GameQuestion.objects.filter(question_id__in=target).values_list("game_id", flat=True), target)
+        GameQuestion.objects.filter(question_id__in=target).update(question_id=remap)
+        GameTurn.objects.filter(question_id__in=target).update(question_id=remap)
+        # Basta una copia attiva perché la domanda resti nei quiz.
+        Question.objects.filter(id__in=reactivate, is_active=False).update(is_active=True)
+        Question.objects.filter(id__in=target).delete()
+    return len(target)
+
+
+def remap_game_logs(game_ids, target):
+    """Gli id delle copie passano alla domanda tenuta anche nel log delle partite (eventi e checkpoint)."""
+    game_ids = set(game_ids)
+    events = list(
+        GameEvent.objects.filter(game_id__in=game_ids, kind__in=[GameEvent.KIND_STARTED, GameEvent.KIND_CHOSEN])
+    )
+    for event in events:
+        if event.kind == GameEvent.KIND_CHOSEN:
+            event.data["question"] = target.get(event.data["question"], event.data["question"])
+        else:
+            event.data["questions"] = [target.get(qid, qid) for qid in event.data["questions"]]
+    GameEvent.objects.bulk_update(events, ["data"], batch_size=500)
+    checkpoints = list(GameCheckpoint.objects.filter(game_id__in=game_ids))
+    for checkpoint in checkpoints:
+        checkpoint.state["questions"] = [target.get(qid, qid) for qid in checkpoint.state["questions"]]
+        for turn in checkpoint.state["turns"]:
+            turn[1] = target.get(turn[1], turn[1])
+    GameCheckpoint.objects.bulk_update(checkpoints, ["state"], batch_size=500)
+
+
+def merge_duplicates(batch_size=500, dry_run=False, on_page=None):
+    """Unisce tutte le domande con la stessa impronta; restituisce (gruppi, domande rimosse)."""
+    groups = removed = 0
+    with question_bank.bulk_changes():
+        for keepers in duplicate_groups(batch_size):
+            groups += len(keepers)
+            if dry_run:
+                removed += Question.objects.filter(fingerprint__in=keepers).count() - len(keepers)
+                continue
+            removed += merge_group_page(keepers)
+            if on_page:
+                on_page(groups, removed)
+    return groups, removed
@@ -0,0 +1,1134 @@
+"""Motore di gioco in memoria: lo stato autorevole delle partite attive del processo.
+
+``choose`` e ``answer`` si applicano a un ``GameEngine`` (giocatori, anello dei turni,
+tabellone, punteggi e turno corrente) senza toccare il DB, e lo snapshot si costruisce
+dallo stesso oggetto. Ogni azione produce eventi del log della partita (``GameEvent``, in
+sola aggiunta), con un checkpoint compatto ogni ``GAME_CHECKPOINT_INTERVAL`` eventi: un
+motore si carica, o si ricostruisce a una versione passata, da un checkpoint più la coda
+del log. Eventi, checkpoint e righe di ``Game``, ``GameTurn`` e ``GamePlayer`` arrivano sul
+DB con un batch per partita in un'unica transazione: subito dopo una risposta, entro
+``GAME_FLUSH_DELAY`` secondi dopo una scelta. Scelta e risposta dello stesso turno finiscono
+così di solito nello stesso batch. Ogni batch è un compare-and-swap sulla versione salvata:
+se un altro processo ha scritto la partita, il motore viene scartato e ricaricato dal DB.
+
+Ogni fase del turno (scelta, risposta) ha una scadenza (``deadline``): ``expire`` la fa valere
+con gli stessi eventi di una risposta sbagliata o di un passaggio di turno.
+
+Nella modalità ``ANSWER_ALL`` rispondono tutti i giocatori: ``buzz`` registra solo opzione e
+istante d'arrivo, senza versione né evento, e ``close_buzz`` assegna esiti, posizioni e punti a
+tutti in un solo evento ``answered`` quando hanno risposto tutti o scade il tempo.
+
+Il motore è autorevole solo se ogni stanza è servita da un solo processo (un daphne, oppure
+``run_workers`` con il proxy di affinità). Con ``GAME_WRITE_BEHIND = 0`` ogni azione aspetta
+il proprio batch prima del broadcast, e un conflitto diventa un 409.
+"""
+
+import asyncio
+import atexit
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Game, GameCheckpoint, GameEvent, GamePlayer, GameQuestion, GameTurn, Question, TurnAnswer
+from .question_bank import question_bank
+from .timer_wheel import TimerWheel
+
+logger = logging.getLogger(__name__)
+
+# Moltiplicatore massimo delle scadenze di turno in una stanza dove nessuno gioca più.
+TURN_IDLE_BACKOFF = 32
+# Risposte simultanee senza scadenza configurata: secondi su cui cala il bonus di velocità, e dopo
+# i quali il turno si chiude comunque con le risposte arrivate.
+BUZZ_SCORING_WINDOW = 30
+
+
+class ActionRejected(Exception):
+    """Azione di gioco rifiutata: ``status`` HTTP e ``payload`` JSON dell'errore."""
+
+    def __init__(self, status, error, **extra):
+        super().__init__(error)
+        self.status = status
+        self.payload = {"error": error, **extra}
+
+
+class StaleGame(Exception):
+    """La partita sul DB non è più quella da cui è partito il motore; ``version`` è quella attuale."""
+
+    def __init__(self, version):
+        super().__init__(version)
+        self.version = version
+
+
+def stale_rejection(room, action, current_version):
+    """409: la partita è cambiata dopo la lettura, il client deve ricaricare lo stato e riprovare."""
+    logger.info("%s rejected: stale version", action, extra={"room": room.code, "version": current_version})
+    return ActionRejected(
+        409, "La partita è cambiata nel frattempo: aggiorna e riprova.", stale=True, version=current_version
+    )
+
+
+def no_question_rejection(room, category, difficulty):
+    logger.info(
+        "choose_question no question available",
+        extra={"room": room.code, "category": category, "difficulty": difficulty},
+    )
+    return ActionRejected(400, "Nessuna domanda disponibile per questa materia/livello.")
+
+
+def parse_expected_version(params, version):
+    """Versione dello stato su cui il client ha agito (campo ``version``); senza, quella attuale."""
+    raw = params.get("version")
+    if raw in (None, ""):
+        return version
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        raise ActionRejected(400, "Versione non valida.") from None
+
+
+def iso(value):
+    return value.isoformat() if value else None
+
+
+def parse_time(value):
+    return parse_datetime(value) if value else None
+
+
+class Seat:
+    """Giocatore della partita, seduto (in ``GameEngine.seats``) o uscito ma citato da un turno."""
+
+    __slots__ = ("player_id", "nickname", "icon", "session_key", "order", "score")
+
+    def __init__(self, player_id, nickname, icon, session_key, order=0, score=0):
+        self.player_id = player_id
+        self.nickname = nickname
+        self.icon = icon
+        self.session_key = session_key
+        self.order = order
+        self.score = score
+
+    @classmethod
+    def of(cls, player, order=0, score=0):
+        return cls(player.pk, player.nickname, player.icon, player.session_key, order, score)
+
+
+class TurnRecord:
+    """Turno giocato: ``id`` è il numero del turno nella partita, ``saved`` se la riga GameTurn esiste già."""
+
+    __slots__ = (
+        "id",
+        "saved",
+        "player",
+        "question_id",
+        "started_at",
+        "answered_at",
+        "selected_option",
+        "was_correct",
+        "points_awarded",
+        "answers",
+    )
+
+    def __init__(self, number, player, question_id, started_at):
+        self.id = number
+        self.saved = False
+        self.player = player
+        self.question_id = question_id
+        self.started_at = started_at
+        self.answered_at = None
+        self.selected_option = None
+        self.was_correct = None
+        self.points_awarded = 0
+        # Risposte simultanee già valutate: [giocatore, opzione, arrivo, corretta, punti, posizione].
+        self.answers = None
+
+    def row(self, game_id):
+        return GameTurn(
+            game_id=game_id,
+            player_id=self.player.player_id,
+            question_id=self.question_id,
+            started_at=self.started_at,
+            answered_at=self.answered_at,
+            selected_option=self.selected_option,
+            was_correct=self.was_correct,
+            points_awarded=self.points_awarded,
+        )
+
+    def answer_rows(self, game_id):
+        return [
+            TurnAnswer(
+                game_id=game_id,
+                turn=self.id,
+                player_id=player_id,
+                option=option,
+                received_at=parse_time(received_at),
+                was_correct=correct,
+                points=points,
+                rank=rank,
+            )
+            for player_id, option, received_at, correct, points, rank in self.answers
+        ]
+
+
+class GameEngine:
+    """Stato di una partita attiva; i comandi e le letture passano da ``lock``.
+
+    Ogni comando valida, poi produce eventi (``GameEvent``) e li applica con ``apply``: lo
+    stesso metodo che ricostruisce la partita da un checkpoint e dalla coda del log.
+    """
+
+    __slots__ = (
+        "lock",
+        "flush_lock",
+        "room",
+        "game_id",
+        "version",
+        "saved_version",
+        "seq",
+        "checkpoint_seq",
+        "state",
+        "asked_mask",
+        "turns_played",
+        "turn_order",
+        "turn_cursor",
+        "rotation_mode",
+        "answer_mode",
+        "current_player_id",
+        "current_turn",
+        "finished_at",
+        "since",
+        "idle_turns",
+        "seats",
+        "absent",
+        "turns",
+        "question_ids",
+        "records",
+        "dirty_turns",
+        "dirty_seats",
+        "dirty_answers",
+        "pending_events",
+        "writing_events",
+        "buzzes",
+    )
+
+    def __init__(self, room, game_id):
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.room = room
+        self.game_id = game_id
+        self.version = self.saved_version = 0
+        # Ultimo evento applicato e ultimo checkpoint salvato (None: partita senza checkpoint nel log).
+        self.seq = 0
+        self.checkpoint_seq = None
+        self.state = Game.STATE_CHOOSING
+        self.asked_mask = 0
+        self.turns_played = 0
+        self.turn_order = []
+        self.turn_cursor = 0
+        self.rotation_mode = Game.ROTATION_EVERY_TURN
+        self.answer_mode = Game.ANSWER_SINGLE
+        self.current_player_id = None
+        self.current_turn = None
+        self.finished_at = None
+        # Inizio della fase corrente (scelta o risposta) e turni scaduti di fila senza che nessuno giocasse.
+        self.since = None
+        self.idle_turns = 0
+        self.seats = {}
+        # Giocatori usciti dalla partita ma ancora citati da un turno o dal Game.
+        self.absent = {}
+        self.turns = []
+        self.question_ids = []
+        self.records = {}
+        self.dirty_turns = set()
+        self.dirty_seats = set()
+        self.dirty_answers = []
+        self.pending_events = []
+        # Eventi del batch in scrittura: non più in sospeso, non ancora visibili sul DB.
+        self.writing_events = []
+        # Risposte simultanee al turno aperto, valutate tutte insieme alla chiusura: giocatore -> (opzione, arrivo).
+        self.buzzes = {}
+
+    @classmethod
+    def load(cls, room, game):
+        """Motore alla versione corrente della partita: dal log se c'è, se no dalle righe relazionali."""
+        engine = cls.replay(room, game, game.version)
+        if engine is not None and engine.version == game.version:
+            return engine
+        if engine is not None:
+            logger.warning(
+                "game log behind the game row: loading from rows",
+                extra={"room": room.code, "version": game.version, "log_version": engine.version},
+            )
+        return cls.from_rows(room, game, seq=engine.seq if engine is not None else 0)
+
+    @classmethod
+    def replay(cls, room, game, version):
+        """Partita alla ``version`` più recente ≤ ``version``: ultimo checkpoint più la coda del log.
+
+        Due query (più generazione e record mancanti del banco); None se il log non copre quella versione.
+        """
+        checkpoint = game.checkpoints.filter(version__lte=version).order_by("-seq").first()
+        engine = cls(room, game.pk)
+        if checkpoint is not None:
+            engine.restore(checkpoint.state)
+            engine.seq = engine.checkpoint_seq = checkpoint.seq
+            engine.version = checkpoint.version
+        for event in game.events.filter(seq__gt=engine.seq, version__lte=version).order_by("seq"):
+            if engine.seq == 0 and event.kind != GameEvent.KIND_STARTED:
+                # Log iniziato a partita in corso: le versioni precedenti al primo checkpoint non si ricostruiscono.
+                return None
+            engine.apply(event.kind, event.data)
+            engine.seq = event.seq
+            engine.version = event.version
+        if engine.seq == 0:
+            return None
+        if engine.checkpoint_seq is None:
+            engine.checkpoint_seq = 0
+        if engine.since is None:
+            engine.since = game.started_at
+        engine.settle()
+        return engine
+
+    @classmethod
+    def from_rows(cls, room, game, seq=0):
+        """Partite precedenti al log: giocatori, turni e domande dalle tabelle; il primo batch salva un checkpoint."""
+        engine = cls(room, game.pk)
+        engine.take_fields(game)
+        engine.seq = seq
+        for gp in game.players.select_related("player").order_by("order"):
+            engine.seats[gp.player_id] = Seat.of(gp.player, gp.order, gp.score)
+        for number, row in enumerate(game.turns.select_related("player").order_by("started_at", "id"), start=1):
+            player = engine.seat_of(row.player_id) or engine.absent.setdefault(row.player_id, Seat.of(row.player))
+            turn = TurnRecord(number, player, row.question_id, row.started_at)
+            turn.answered_at = row.answered_at
+            turn.selected_option = row.selected_option
+            turn.was_correct = row.was_correct
+            turn.points_awarded = row.points_awarded
+            engine.turns.append(turn)
+            if row.pk == game.current_turn_id:
+                engine.current_turn = turn
+        if engine.answer_mode == Game.ANSWER_ALL:
+            for answer in game.answers.order_by("turn", "received_at"):
+                turn = engine.turns[answer.turn - 1]
+                if turn.answered_at is None:
+                    # Turno ancora aperto: le righe sono risposte arrivate, non ancora valutate.
+                    engine.buzzes[answer.player_id] = (answer.option, answer.received_at)
+                    continue
+                if turn.answers is None:
+                    turn.answers = []
+                turn.answers.append(
+                    [answer.player_id, answer.option, iso(answer.received_at), answer.was_correct, answer.points, answer.rank]
+                )
+        if game.current_player_id and engine.seat_of(game.current_player_id) is None:
+            engine.absent[game.current_player_id] = Seat.of(game.current_player)
+        # Ordine di estrazione, come nell'evento ``started``: le righe sono inserite in quell'ordine.
+        engine.question_ids = list(
+            GameQuestion.objects.filter(game=game).order_by("pk").values_list("question_id", flat=True)
+        )
+        engine.since = engine.derive_since() or game.started_at
+        engine.settle()
+        return engine
+
+    @classmethod
+    def started_event(cls, game, players, question_ids):
+        """Primo evento del log di una partita nuova: lo stato iniziale completo, come un checkpoint."""
+        engine = cls(None, game.pk)
+        engine.take_fields(game)
+        engine.since = game.started_at
+        for order, player in enumerate(players):
+            engine.seats[player.pk] = Seat.of(player, order)
+        engine.question_ids = list(question_ids)
+        return GameEvent(
+            game=game, seq=1, version=game.version, kind=GameEvent.KIND_STARTED, data=engine.compact()
+        )
+
+    def take_fields(self, game):
+        self.version = game.version
+        self.state = game.state
+        self.asked_mask = game.asked_mask
+        self.turns_played = game.turns_played
+        self.turn_order = list(game.turn_order)
+        self.turn_cursor = game.turn_cursor
+        self.rotation_mode = game.rotation_mode
+        self.answer_mode = game.answer_mode
+        self.current_player_id = game.current_player_id
+        self.finished_at = game.finished_at
+
+    def settle(self):
+        """Motore appena caricato: tutto è già sul DB; servono solo i record delle domande."""
+        for turn in self.turns:
+            turn.saved = True
+        self.dirty_turns.clear()
+        self.dirty_seats.clear()
+        self.dirty_answers.clear()
+        self.saved_version = self.version
+        self.records = question_bank.records(set(self.question_ids) | {turn.question_id for turn in self.turns})
+
+    def compact(self):
+        """Stato in JSON: dati dell'evento ``started`` e dei checkpoint."""
+        return {
+            "state": self.state,
+            "asked_mask": self.asked_mask,
+            "turns_played": self.turns_played,
+            "turn_order": self.turn_order,
+            "turn_cursor": self.turn_cursor,
+            "rotation_mode": self.rotation_mode,
+            "answer_mode": self.answer_mode,
+            "current_player": self.current_player_id,
+            "finished_at": iso(self.finished_at),
+            "since": iso(self.since),
+            "idle_turns": self.idle_turns,
+            "seats": [
+                [seat.player_id, seat.nickname, seat.icon, seat.session_key, seat.order, seat.score]
+                for seat in self.seats.values()
+            ],
+            "absent": [[seat.player_id, seat.nickname, seat.icon, seat.session_key] for seat in self.absent.values()],
+            "turns": [
+                [
+                    turn.player.player_id,
+                    turn.question_id,
+                    iso(turn.started_at),
+                    iso(turn.answered_at),
+                    turn.selected_option,
+                    turn.was_correct,
+                    turn.points_awarded,
+                    *([turn.answers] if turn.answers is not None else []),
+                ]
+                for turn in self.turns
+            ],
+            "current_turn": self.current_turn.id if self.current_turn else None,
+            "questions": self.question_ids,
+        }
+
+    def restore(self, data):
+        self.state = data["state"]
+        self.asked_mask = data["asked_mask"]
+        self.turns_played = data["turns_played"]
+        self.turn_order = list(data["turn_order"])
+        self.turn_cursor = data["turn_cursor"]
+        self.rotation_mode = data["rotation_mode"]
+        self.answer_mode = data.get("answer_mode", Game.ANSWER_SINGLE)
+        self.current_player_id = data["current_player"]
+        self.finished_at = parse_time(data["finished_at"])
+        self.seats = {row[0]: Seat(*row) for row in data["seats"]}
+        self.absent = {row[0]: Seat(*row) for row in data["absent"]}
+        self.turns = []
+        for number, (player_id, question_id, started_at, answered_at, selected, correct, points, *answers) in enumerate(
+            data["turns"], start=1
+        ):
+            turn = TurnRecord(number, self.seat_of(player_id), question_id, parse_time(started_at))
+            turn.answered_at = parse_time(answered_at)
+            turn.selected_option = selected
+            turn.was_correct = correct
+            turn.points_awarded = points
+            turn.answers = answers[0] if answers else None
+            self.turns.append(turn)
+        self.current_turn = self.turns[data["current_turn"] - 1] if data["current_turn"] else None
+        self.question_ids = list(data["questions"])
+        # Checkpoint ed eventi started precedenti alle scadenze non hanno since.
+        self.since = parse_time(data.get("since")) or self.derive_since()
+        self.idle_turns = data.get("idle_turns", 0)
+
+    def derive_since(self):
+        """Inizio della fase corrente dai turni: la scelta in attesa di risposta o l'ultima risposta."""
+        if self.current_turn is not None:
+            return self.current_turn.started_at
+        return max((turn.answered_at for turn in self.turns if turn.answered_at), default=None)
+
+    def apply(self, kind, data):
+        """Applica un evento allo stato: i comandi e il replay del log passano entrambi da qui."""
+        if kind == GameEvent.KIND_STARTED:
+            self.restore(data)
+        elif kind == GameEvent.KIND_CHOSEN:
+            turn = TurnRecord(data["turn"], self.seat_of(data["player"]), data["question"], parse_time(data["at"]))
+            self.turns.append(turn)
+            self.current_turn = turn
+            self.dirty_turns.add(turn)
+            self.asked_mask |= Game.slot_bit(data["category"], data["difficulty"])
+            self.turns_played += 1
+            self.buzzes = {}
+            self.state = Game.STATE_ANSWERING
+            self.since = turn.started_at
+            self.idle_turns = 0
+        elif kind == GameEvent.KIND_ANSWERED:
+            turn = self.turns[data["turn"] - 1]
+            turn.selected_option = data["option"]
+            turn.was_correct = data["correct"]
+            turn.points_awarded = data["points"]
+            turn.answered_at = parse_time(data["at"])
+            self.dirty_turns.add(turn)
+            if "answers" in data:
+                # Risposta simultanea: i punti vanno a ogni giocatore che ha risposto, chi ha scelto compreso.
+                turn.answers = data["answers"]
+                self.dirty_answers.append(turn)
+                self.buzzes = {}
+                for player_id, _, _, _, points, _ in turn.answers:
+                    seat = self.seat_of(player_id)
+                    if points and seat is not None:
+                        seat.score += points
+                        self.dirty_seats.add(seat)
+            elif turn.points_awarded:
+                turn.player.score += turn.points_awarded
+                self.dirty_seats.add(turn.player)
+            self.current_turn = None
+            self.state = Game.STATE_CHOOSING
+            self.since = turn.answered_at
+            self.idle_turns = self.idle_turns + 1 if data.get("expired") else 0
+        elif kind == GameEvent.KIND_ROTATED:
+            self.turn_cursor = data["cursor"]
+            self.current_player_id = data["player"]
+            if data.get("expired"):
+                # Scelta scaduta: il turno passa senza domanda e la nuova fase parte da qui.
+                self.since = parse_time(data["at"])
+                self.idle_turns += 1
+        elif kind == GameEvent.KIND_FINISHED:
+            self.state = Game.STATE_FINISHED
+            self.finished_at = parse_time(data["at"])
+
+    def commit(self, events):
+        """Nuova versione: applica gli eventi ``(kind, data)`` e li mette in coda per il prossimo batch."""
+        self.version += 1
+        for kind, data in events:
+            self.apply(kind, data)
+            self.seq += 1
+            self.pending_events.append(
+                GameEvent(game_id=self.game_id, seq=self.seq, version=self.version, kind=kind, data=data)
+            )
+
+    def unsaved_events(self):
+        """Eventi non ancora confermati sul DB (batch in scrittura, poi in sospeso), in ordine di ``seq``."""
+        with self.lock:
+            return self.writing_events + self.pending_events
+
+    def seat_of(self, player_id):
+        return self.seats.get(player_id) or self.absent.get(player_id)
+
+    def seat_for_session(self, session_key):
+        return next((seat for seat in self.seats.values() if seat.session_key == session_key), None)
+
+    @property
+    def current_player(self):
+        return self.seat_of(self.current_player_id)
+
+    @property
+    def dirty(self):
+        return self.version != self.saved_version
+
+    @property
+    def deadline(self):
+        """Istante entro cui il giocatore di turno deve scegliere o rispondere; None se la fase non scade.
+
+        Ogni giro intero di turni scaduti raddoppia il tempo (fino a ``TURN_IDLE_BACKOFF`` volte):
+        una stanza abbandonata non riempie il log di passaggi di turno.
+        """
+        if self.state == Game.STATE_FINISHED or self.since is None or not self.turn_order:
+            return None
+        if self.state == Game.STATE_ANSWERING:
+            timeout = settings.TURN_ANSWER_TIMEOUT
+            if timeout <= 0 and self.answer_mode == Game.ANSWER_ALL:
+                # Il turno si chiude quando rispondono tutti: senza scadenza un assente lo bloccherebbe.
+                timeout = BUZZ_SCORING_WINDOW
+        else:
+            timeout = settings.TURN_CHOOSE_TIMEOUT
+        if timeout <= 0:
+            return None
+        backoff = min(2 ** (self.idle_turns // len(self.turn_order)), TURN_IDLE_BACKOFF)
+        return self.since + timedelta(seconds=timeout * backoff)
+
+    def is_asked(self, category, level):
+        return bool(self.asked_mask & Game.slot_bit(category, level))
+
+    @property
+    def remaining_questions(self):
+        return Game.BOARD_SIZE - self.asked_mask.bit_count()
+
+    def remaining_by_level(self):
+        """{materia: {livello: 0/1}}: una domanda per casella, disponibile finché il bit è spento."""
+        return {
+            category: {level: int(not self.is_asked(category, level)) for level in Game.BOARD_LEVELS}
+            for category in Game.BOARD_CATEGORIES
+        }
+
+    def next_turn(self, was_correct=None):
+        """(cursore, giocatore) del prossimo turno, None se resta lo stesso giocatore.
+
+        Con ``ROTATION_ON_WRONG`` chi risponde giusto resta di turno.
+        """
+        if not self.turn_order:
+            return None
+        if self.rotation_mode == Game.ROTATION_ON_WRONG and was_correct:
+            return None
+        cursor = (self.turn_cursor + 1) % len(self.turn_order)
+        return cursor, self.turn_order[cursor]
+
+    def choose(self, session_key, params):
+        """Apre il turno sulla casella scelta; ActionRejected se l'azione non è ammessa."""
+        with self.lock:
+            room = self.room
+            if self.state == Game.STATE_FINISHED:
+                logger.warning(
+                    "choose_question rejected: game finished",
+                    extra={"room": room.code, "session": session_key},
+                )
+                raise ActionRejected(400, "La partita è già terminata.")
+            current_player = self.current_player
+            if not current_player or current_player.session_key != session_key:
+                logger.info(
+                    "choose_question rejected: not current player",
+                    extra={
+                        "room": room.code,
+                        "session": session_key,
+                        "current_player": getattr(current_player, "session_key", None),
+                    },
+                )
+                raise ActionRejected(403, "Non è il tuo turno.")
+
+            category = params.get("category")
+            difficulty = params.get("difficulty")
+            try:
+                difficulty = int(difficulty)
+            except (TypeError, ValueError):
+                logger.warning(
+                    "choose_question bad difficulty",
+                    extra={"room": room.code, "session": session_key, "category": category, "raw": difficulty},
+                )
+                raise ActionRejected(400, "Livello non valido.") from None
+
+            if category not in dict(Question.CATEGORY_CHOICES):
+                logger.warning(
+                    "choose_question invalid category",
+                    extra={"room": room.code, "session": session_key, "category": category},
+                )
+                raise ActionRejected(400, "Materia non valida.")
+            if difficulty not in range(1, 6):
+                raise ActionRejected(400, "Livello non valido.")
+
+            if parse_expected_version(params, self.version) != self.version:
+                raise stale_rejection(room, "choose_question", self.version)
+
+            if self.state != Game.STATE_CHOOSING:
+                logger.info(
+                    "choose_question rejected: game not choosing",
+                    extra={"room": room.code, "state": self.state, "session": session_key},
+                )
+                raise ActionRejected(400, "C'è già una domanda attiva.")
+            if self.is_asked(category, difficulty):
+                raise no_question_rejection(room, category, difficulty)
+            candidates = [
+                record for record in self.records.values() if (record.category, record.difficulty) == (category, difficulty)
+            ]
+            if not candidates:
+                raise no_question_rejection(room, category, difficulty)
+            question = random.choice(candidates)
+
+            self.commit(
+                [
+                    (
+                        GameEvent.KIND_CHOSEN,
+                        {
+                            "turn": len(self.turns) + 1,
+                            "player": current_player.player_id,
+                            "question": question.id,
+                            "category": category,
+                            "difficulty": difficulty,
+                            "at": iso(timezone.now()),
+                        },
+                    )
+                ]
+            )
+            turn = self.current_turn
+            logger.info(
+                "choose_question OK",
+                extra={
+                    "room": room.code,
+                    "category": category,
+                    "difficulty": difficulty,
+                    "question_id": question.id,
+                    "turn_id": turn.id,
+                    "player": current_player.nickname,
+                },
+            )
+
+    def answer(self, session_key, params):
+        """Registra la risposta al turno corrente e passa il turno; ActionRejected se non è ammessa."""
+        with self.lock:
+            room = self.room
+            turn = self.current_turn
+            if self.state != Game.STATE_ANSWERING or not turn:
+                logger.info(
+                    "submit_answer rejected: no active question",
+                    extra={"room": room.code, "state": self.state, "session": session_key},
+                )
+                raise ActionRejected(400, "Nessuna domanda attiva.")
+            current_player = self.current_player
+            if not current_player or current_player.session_key != session_key:
+                logger.info(
+                    "submit_answer rejected: not current player",
+                    extra={
+                        "room": room.code,
+                        "session": session_key,
+                        "current_player": getattr(current_player, "session_key", None),
+                    },
+                )
+                raise ActionRejected(403, "Non puoi rispondere, non è il tuo turno.")
+
+            selected = params.get("option")
+            if selected not in dict(Question.OPTION_CHOICES):
+                logger.warning(
+                    "submit_answer invalid option",
+                    extra={"room": room.code, "session": session_key, "selected": selected},
+                )
+                raise ActionRejected(400, "Opzione non valida.")
+
+            if parse_expected_version(params, self.version) != self.version:
+                raise stale_rejection(room, "submit_answer", self.version)
+
+            if turn.selected_option:
+                logger.info(
+                    "submit_answer rejected: already answered",
+                    extra={"room": room.code, "turn_id": turn.id, "session": session_key},
+                )
+                raise ActionRejected(400, "Hai già risposto a questa domanda.")
+
+            question = self.records[turn.question_id]
+            correct = selected == question.correct_option
+            points = question.points if correct else 0
+            remaining_questions = self.close_turn(turn, {"option": selected, "correct": correct, "points": points})
+            logger.info(
+                "submit_answer recorded",
+                extra={
+                    "room": room.code,
+                    "turn_id": turn.id,
+                    "question_id": turn.question_id,
+                    "player": current_player.nickname,
+                    "selected": selected,
+                    "correct": correct,
+                    "points": points,
+                    "state": self.state,
+                    "remaining": remaining_questions,
+                },
+            )
+
+    def close_turn(self, turn, outcome):
+        """Chiude il turno con l'esito dato e passa la mano (o chiude la partita); restituisce le caselle rimaste."""
+        now = iso(timezone.now())
+        events = [(GameEvent.KIND_ANSWERED, {"turn": turn.id, **outcome, "at": now})]
+        # La casella del turno è già segnata da choose: lettura del tabellone, nessun conteggio.
+        remaining_questions = self.remaining_questions
+        if remaining_questions <= 0:
+            events.append((GameEvent.KIND_FINISHED, {"at": now}))
+        else:
+            rotation = self.next_turn(was_correct=outcome["correct"])
+            if rotation is not None:
+                events.append((GameEvent.KIND_ROTATED, {"cursor": rotation[0], "player": rotation[1]}))
+        self.commit(events)
+        return remaining_questions
+
+    def buzz(self, session_key, params, received_at):
+        """Risposta di un giocatore qualsiasi alla domanda aperta, nella modalità ``ANSWER_ALL``.
+
+        Registra solo opzione e istante di arrivo, senza nuova versione né broadcast: esiti e punti si
+        calcolano per tutti alla chiusura del turno (``close_buzz``). Restituisce (posto, turno, completo),
+        con completo vero quando hanno risposto tutti i giocatori seduti.
+        """
+        with self.lock:
+            room = self.room
+            turn = self.current_turn
+            if self.state != Game.STATE_ANSWERING or not turn:
+                logger.info(
+                    "submit_answer rejected: no active question",
+                    extra={"room": room.code, "state": self.state, "session": session_key},
+                )
+                raise ActionRejected(400, "Nessuna domanda attiva.")
+            seat = self.seat_for_session(session_key)
+            if seat is None:
+                logger.info("submit_answer rejected: not a player", extra={"room": room.code, "session": session_key})
+                raise ActionRejected(403, "Non partecipi a questa partita.")
+            selected = params.get("option")
+            if selected not in dict(Question.OPTION_CHOICES):
+                logger.warning(
+                    "submit_answer invalid option",
+                    extra={"room": room.code, "session": session_key, "selected": selected},
+                )
+                raise ActionRejected(400, "Opzione non valida.")
+            if parse_expected_version(params, self.version) != self.version:
+                raise stale_rejection(room, "submit_answer", self.version)
+            if seat.player_id in self.buzzes:
+                raise ActionRejected(400, "Hai già risposto a questa domanda.")
+            self.buzzes[seat.player_id] = (selected, received_at)
+            return seat, turn, len(self.buzzes) >= len(self.seats)
+
+    def merge_buzzes(self, turn_id, rows):
+        """Risposte ``(giocatore, opzione, arrivo)`` salvate sul DB per il turno aperto: valgono più di quelle in memoria."""
+        with self.lock:
+            if self.current_turn is not None and self.current_turn.id == turn_id:
+                self.buzzes.update((player_id, (option, received_at)) for player_id, option, received_at in rows)
+
+    def close_buzz(self, turn_id):
+        """Chiude il turno a risposta simultanea ``turn_id``: ordine d'arrivo, esiti e punti di tutti in un evento.
+
+        Le risposte corrette sono ordinate per istante di arrivo sul server; i punti sono il livello della
+        domanda più un bonus di velocità che cala fino a zero alla scadenza della risposta. False se il turno
+        è già stato chiuso (da un'altra risposta o dalla scadenza).
+        """
+        with self.lock:
+            turn = self.current_turn
+            if self.state != Game.STATE_ANSWERING or turn is None or turn.id != turn_id:
+                return False
+            question = self.records[turn.question_id]
+            window = settings.TURN_ANSWER_TIMEOUT or BUZZ_SCORING_WINDOW
+            answers = []
+            rank = 0
+            for player_id, (option, received_at) in sorted(self.buzzes.items(), key=lambda item: (item[1][1], item[0])):
+                correct = option == question.correct_option
+                points = 0
+                if correct:
+                    rank += 1
+                    elapsed = (received_at - turn.started_at).total_seconds()
+                    points = question.points + round(question.points * max(0.0, 1 - elapsed / window))
+                answers.append([player_id, option, iso(received_at), correct, points, rank if correct else None])
+            mine = next((answer for answer in answers if answer[0] == turn.player.player_id), None)
+            outcome = {
+                "option": mine[1] if mine else None,
+                "correct": bool(mine and mine[3]),
+                "points": mine[4] if mine else 0,
+                "answers": answers,
+            }
+            if not answers:
+                outcome["expired"] = True
+            self.close_turn(turn, outcome)
+            logger.info(
+                "simultaneous answers scored",
+                extra={"room": self.room.code, "turn_id": turn.id, "answers": len(answers), "correct": rank},
+            )
+            return True
+
+    def expire(self, version):
+        """Fa valere la scadenza della fase corrente, se la partita è ancora alla ``version``.
+
+        Risposta scaduta: il turno si chiude come una risposta sbagliata senza opzione. Scelta
+        scaduta: il turno passa al prossimo giocatore. False se non c'è niente da far scadere.
+        """
+        with self.lock:
+            deadline = self.deadline
+            if self.version != version or deadline is None or deadline > timezone.now():
+                return False
+            player = self.current_player
+            turn = self.current_turn
+            if self.state == Game.STATE_ANSWERING and turn and self.answer_mode == Game.ANSWER_ALL:
+                # Tempo finito per tutti: si valuta chi ha risposto.
+                self.close_buzz(turn.id)
+            elif self.state == Game.STATE_ANSWERING and turn:
+                self.close_turn(turn, {"option": None, "correct": False, "points": 0, "expired": True})
+            else:
+                rotation = self.next_turn()
+                if rotation is None:
+                    return False
+                self.commit(
+                    [
+                        (
+                            GameEvent.KIND_ROTATED,
+                            {"cursor": rotation[0], "player": rotation[1], "at": iso(timezone.now()), "expired": True},
+                        )
+                    ]
+                )
+            logger.info(
+                "turn expired",
+                extra={
+                    "room": self.room.code,
+                    "phase": Game.STATE_ANSWERING if turn else Game.STATE_CHOOSING,
+                    "player": getattr(player, "nickname", None),
+                    "version": self.version,
+                    "idle_turns": self.idle_turns,
+                },
+            )
+            return True
+
+    def flush(self):
+        """Salva le modifiche in sospeso in una transazione; False se non ce n'erano.
+
+        StaleGame se la partita sul DB non è alla versione salvata da questo motore.
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return False
+                version, seq = self.version, self.seq
+                fields = {
+                    "state": self.state,
+                    "asked_mask": self.asked_mask,
+                    "turns_played": self.turns_played,
+                    "turn_cursor": self.turn_cursor,
+                    "current_player_id": self.current_player_id,
+                    "finished_at": self.finished_at,
+                }
+                current_turn = self.current_turn
+                turns = [(turn, turn.row(self.game_id)) for turn in self.dirty_turns]
+                scores = [(seat, seat.score) for seat in self.dirty_seats if seat.player_id in self.seats]
+                answered = self.dirty_answers
+                answers = [row for turn in answered for row in turn.answer_rows(self.game_id)]
+                events = self.pending_events
+                checkpoint = None
+                if (
+                    self.checkpoint_seq is None
+                    or seq - self.checkpoint_seq >= settings.GAME_CHECKPOINT_INTERVAL
+                    or self.state == Game.STATE_FINISHED
+                ):
+                    checkpoint = GameCheckpoint(game_id=self.game_id, seq=seq, version=version, state=self.compact())
+                self.dirty_turns, self.dirty_seats, self.dirty_answers, self.pending_events = set(), set(), [], []
+                self.writing_events = events
+            try:
+                self.write(version, fields, current_turn, turns, scores, answers, events, checkpoint)
+            except BaseException:
+                # Il batch torna in sospeso: il prossimo tentativo riparte dalla stessa versione salvata.
+                with self.lock:
+                    self.dirty_turns.update(turn for turn, _ in turns)
+                    self.dirty_seats.update(seat for seat, _ in scores)
+                    self.dirty_answers[:0] = answered
+                    self.pending_events[:0] = events
+                    self.writing_events = []
+                raise
+            with self.lock:
+                for turn, _ in turns:
+                    turn.saved = True
+                self.saved_version = version
+                self.writing_events = []
+                if checkpoint is not None:
+                    self.checkpoint_seq = seq
+            return True
+
+    def write(self, version, fields, current_turn, turns, scores, answers, events, checkpoint):
+        new = [row for turn, row in turns if not turn.saved]
+        answered = [row for turn, row in turns if turn.saved]
+        if current_turn is None:
+            fields["current_turn_id"] = None
+        with transaction.atomic():
+            # Prima il compare-and-swap: un batch in conflitto si ferma qui, prima di scrivere il log.
+            if not Game.objects.filter(pk=self.game_id, version=self.saved_version).update(version=version, **fields):
+                raise StaleGame(Game.objects.filter(pk=self.game_id).values_list("version", flat=True).first())
+            GameEvent.objects.bulk_create(events)
+            if checkpoint is not None:
+                checkpoint.save()
+            # Le tabelle relazionali restano una proiezione del log, aggiornata nello stesso batch.
+            if new:
+                GameTurn.objects.bulk_create(new)
+            for row in answered:
+                GameTurn.objects.filter(game_id=self.game_id, question_id=row.question_id).update(
+                    answered_at=row.answered_at,
+                    selected_option=row.selected_option,
+                    was_correct=row.was_correct,
+                    points_awarded=row.points_awarded,
+                )
+            for seat, score in scores:
+                GamePlayer.objects.filter(game_id=self.game_id, player_id=seat.player_id).update(score=score)
+            if answers:
+                # Punteggio del turno in un solo statement: le righe arrivate prima (senza write-behind) si aggiornano.
+                TurnAnswer.objects.bulk_create(
+                    answers,
+                    update_conflicts=True,
+                    unique_fields=["game", "turn", "player"],
+                    update_fields=["option", "received_at", "was_correct", "points", "rank"],
+                )
+            if current_turn is not None and not current_turn.saved:
+                row = next(row for turn, row in turns if turn is current_turn)
+                Game.objects.filter(pk=self.game_id).update(current_turn_id=row.pk)
+
+
+class GameEngines:
+    """Motori delle partite attive del processo, per codice stanza (LRU).
+
+    Come le build degli snapshot, i caricamenti dal DB sono single-flight per stanza e al più
+    ``load_concurrency`` in parallelo: dopo un riavvio una stanza si carica una volta sola.
+    """
+
+    def __init__(self, max_entries=512, load_concurrency=4):
+        self.max_entries = max_entries
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._load_slots = threading.BoundedSemaphore(load_concurrency)
+
+    def cached(self, code):
+        with self._lock:
+            engine = self._engines.get(code)
+            if engine is not None:
+                self._engines.move_to_end(code)
+            return engine
+
+    def get(self, room, game):
+        """Motore di ``game``, caricato dal DB se manca o se il DB è più avanti (scritto da un altro processo)."""
+        engine = self.cached(room.code)
+        if engine is not None and engine.game_id == game.pk and game.version <= engine.version:
+            return engine
+        with self._lock:
+            flight = self._in_flight.setdefault(room.code, threading.Lock())
+        with flight:
+            engine = self.cached(room.code)
+            if engine is None or engine.game_id != game.pk or game.version > engine.version:
+                # Nessun altro thread l'ha caricato mentre si aspettava il proprio turno.
+                with self._load_slots:
+                    engine = GameEngine.load(room, game)
+                with self._lock:
+                    self._engines[room.code] = engine
+                    self.evict()
+        with self._lock:
+            self._in_flight.pop(room.code, None)
+        return engine
+
+    def version_of(self, room, game):
+        """Versione corrente della partita: quella del motore se è in memoria e aggiornato, se no quella del DB."""
+        engine = self.cached(room.code)
+        if engine is not None and engine.game_id == game.pk and game.version <= engine.version:
+            return engine.version
+        return game.version
+
+    def discard(self, code, engine=None):
+        with self._lock:
+            if engine is None or self._engines.get(code) is engine:
+                self._engines.pop(code, None)
+
+    def all(self):
+        with self._lock:
+            return list(self._engines.values())
+
+    def evict(self):
+        # Solo motori già salvati: uno con modifiche in sospeso resta finché il flusher non lo svuota.
+        excess = len(self._engines) - self.max_entries
+        for code, engine in list(self._engines.items()):
+            if excess <= 0:
+                break
+            if not engine.dirty and not engine.buzzes:
+                del self._engines[code]
+                excess -= 1
+
+    def clear(self):
+        with self._lock:
+            self._engines.clear()
+
+
+class GameFlusher:
+    """Thread di write-behind: salva i motori modificati alla scadenza, e tutti all'uscita del processo."""
+
+    def __init__(self, engines, delay=1.0):
+        self.engines = engines
+        self.delay = delay
+        # Chiamata con la stanza e il loop del server dopo un conflitto, per reinviare ai client lo stato del DB.
+        self.on_conflict = None
+        # Event loop delle azioni che hanno programmato i salvataggi (None fuori dal server ASGI).
+        self.loop = None
+        self._due = {}  # motore -> istante entro cui salvarlo
+        self._ready = threading.Condition()
+        self._thread = None
+        atexit.register(self.flush_all)
+
+    def schedule(self, engine, urgent=False):
+        deadline = time.monotonic() + (0 if urgent else self.delay)
+        try:
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        with self._ready:
+            self._due[engine] = min(deadline, self._due.get(engine, deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="game-flusher", daemon=True)
+                self._thread.start()
+            self._ready.notify()
+
+    def run(self):
+        while True:
+            with self._ready:
+                while True:
+                    now = time.monotonic()
+                    due = [engine for engine, deadline in self._due.items() if deadline <= now]
+                    if due:
+                        break
+                    self._ready.wait(min(self._due.values()) - now if self._due else None)
+                for engine in due:
+                    del self._due[engine]
+            for engine in due:
+                self.flush(engine)
+
+    def flush(self, engine):
+        try:
+            engine.flush()
+        except StaleGame as exc:
+            logger.error(
+                "game write-behind conflict: engine dropped",
+                extra={"room": engine.room.code, "version": engine.version, "db_version": exc.version},
+            )
+            self.engines.discard(engine.room.code, engine)
+            if self.on_conflict is not None:
+                self.on_conflict(engine.room.code, self.loop)
+        except DatabaseError:
+            logger.exception("game write-behind failed, retrying", extra={"room": engine.room.code})
+            connection.close()
+            self.schedule(engine)
+        except Exception:
+            logger.exception("game write-behind failed: engine dropped", extra={"room": engine.room.code})
+            self.engines.discard(engine.room.code, engine)
+
+    def flush_all(self):
+        """Salva subito ogni motore con modifiche in sospeso (all'uscita e nei benchmark)."""
+        with self._ready:
+            self._due.clear()
+        for engine in self.engines.all():
+            if engine.dirty:
+                self.flush(engine)
+
+
+class TurnDeadlines:
+    """Scadenze dei turni delle partite in memoria: un timer per stanza sulla ruota del processo.
+
+    Si usa dal thread dell'event loop. ``arm`` è idempotente per versione: si può chiamare a ogni
+    azione e a ogni client che si collega, e sposta il timer solo se la partita è andata avanti.
+    """
+
+    def __init__(self, wheel):
+        self.wheel = wheel
+        # Coroutine chiamata con (codice stanza, versione) alla scadenza.
+        self.on_expire = None
+        self._timers = {}  # codice -> ((partita, versione), Timer)
+
+    def arm(self, engine):
+        with engine.lock:
+            key = (engine.game_id, engine.version)
+            deadline = engine.deadline
+        code = engine.room.code
+        armed = self._timers.get(code)
+        if armed is not None:
+            if armed[0] == key:
+                return
+            armed[1].cancel()
+            del self._timers[code]
+        if deadline is None:
+            return
+        delay = (deadline - timezone.now()).total_seconds()
+        self._timers[code] = (key, self.wheel.call_later(delay, self.fire, code, key[1]))
+
+    def cancel(self, code):
+        armed = self._timers.pop(code, None)
+        if armed is not None:
+            armed[1].cancel()
+
+    def fire(self, code, version):
+        self._timers.pop(code, None)
+        if self.on_expire is not None:
+            asyncio.ensure_future(self.on_expire(code, version))
+
+    def __len__(self):
+        return len(self._timers)
+
+
+game_engines = GameEngines(
+    max_entries=getattr(settings, "GAME_ENGINE_CACHE_SIZE", 512),
+    load_concurrency=getattr(settings, "SNAPSHOT_BUILD_CONCURRENCY", 4),
+)
+game_flusher = GameFlusher(game_engines, delay=getattr(settings, "GAME_FLUSH_DELAY", 1.0))
+turn_deadlines = TurnDeadlines(TimerWheel(tick=getattr(settings, "TURN_TIMER_TICK", 0.1)))
@@ -0,0 +1,159 @@
+"""Import in streaming del banco domande da CSV.
+
+Le righe passano da una pipeline di generatori (lettura -> validazione -> blocchi)
+e vengono scritte un blocco per transazione: la memoria resta proporzionale al
+blocco, non al file, e un errore a metà lascia solo blocchi completi. Le domande
+già presenti (stessa impronta del contenuto) non vengono duplicate.
+"""
+
+import csv
+from contextlib import nullcontext
+from itertools import islice
+
+from django.db import transaction
+
+from .models import Question
+from .question_bank import question_bank
+
+REQUIRED_HEADERS = {"category", "difficulty", "text", "option_a", "option_b", "option_c", "correct_option"}
+VALID_CATEGORIES = {key for key, _ in Question.CATEGORY_CHOICES}
+VALID_OPTIONS = {opt for opt, _ in Question.OPTION_CHOICES}
+
+
+class ImportResult:
+    """Conteggi dell'import ed errori, conservati solo fino a ``max_errors``."""
+
+    def __init__(self, max_errors=50):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.created = 0
+        # Righe la cui domanda esisteva già (stessa impronta): aggiornate o lasciate com'erano.
+        self.updated = 0
+        self.unchanged = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append(f"riga {line}: {message}")
+
+    def summary(self):
+        text = "; ".join(self.errors)
+        hidden = self.error_count - len(self.errors)
+        if hidden:
+            text += f" (e altri {hidden} errori)"
+        return text
+
+
+def read_rows(stream):
+    """(numero di riga, dict) per ogni riga; ValueError se mancano intestazioni."""
+    reader = csv.DictReader(stream)
+    if not REQUIRED_HEADERS <= set(reader.fieldnames or []):
+        raise ValueError(f"Intestazioni mancanti, attese: {', '.join(sorted(REQUIRED_HEADERS))}")
+    return enumerate(reader, start=2)  # start=2 to account for header
+
+
+def parse_row(row):
+    """Question non salvata a partire da una riga CSV; ValueError con il motivo se la riga non è valida."""
+    category = (row.get("category") or "").strip().lower()
+    try:
+        difficulty = int(row.get("difficulty"))
+    except (TypeError, ValueError):
+        raise ValueError("difficoltà non valida") from None
+    text = (row.get("text") or "").strip()
+    option_a = (row.get("option_a") or "").strip()
+    option_b = (row.get("option_b") or "").strip()
+    option_c = (row.get("option_c") or "").strip()
+    correct_option = (row.get("correct_option") or "").strip().upper()
+    is_active_val = (row.get("is_active") or "true").strip().lower() in ("1", "true", "yes", "y")
+
+    if category not in VALID_CATEGORIES:
+        raise ValueError(f"categoria '{category}' non valida")
+    if difficulty not in range(1, 6):
+        raise ValueError("difficoltà fuori range 1-5")
+    if correct_option not in VALID_OPTIONS:
+        raise ValueError("risposta corretta deve essere A/B/C")
+    if not text or not option_a or not option_b or not option_c:
+        raise ValueError("testo o opzioni mancanti")
+    return Question(
+        category=category,
+        difficulty=difficulty,
+        text=text,
+        option_a=option_a,
+        option_b=option_b,
+        option_c=option_c,
+        correct_option=correct_option,
+        is_active=is_active_val,
+    )
+
+
+def valid_questions(rows, result):
+    for line, row in rows:
+        result.rows += 1
+        try:
+            yield parse_row(row)
+        except ValueError as exc:
+            result.add_error(line, exc)
+
+
+def chunked(items, size):
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def import_questions(stream, chunk_size=1000, max_errors=50, atomic=False, on_chunk=None):
+    """Importa le domande da un CSV testuale; restituisce un ImportResult.
+
+    Ogni blocco di ``chunk_size`` righe valide è una transazione; con ``atomic``
+    l'intero import lo è (tutto o niente). ``on_chunk(result)`` viene chiamata
+    dopo ogni blocco scritto, per mostrare l'avanzamento.
+    """
+    result = ImportResult(max_errors=max_errors)
+    rows = read_rows(stream)
+    # bulk_create non invia segnali: l'indice in memoria si ricarica una volta sola alla fine.
+    with question_bank.bulk_changes(), (transaction.atomic() if atomic else nullcontext()):
+        for chunk in chunked(valid_questions(rows, result), chunk_size):
+            upsert_chunk(chunk, result)
+            if on_chunk:
+                on_chunk(result)
+    return result
+
+
+def upsert_chunk(chunk, result):
+    """Inserisce le domande nuove e aggiorna risposta e stato di quelle già presenti (stessa impronta).
+
+    Reimportare lo stesso file non duplica nulla: una query sull'indice dell'impronta per blocco.
+    La lettura resta fuori dalla transazione di scrittura (su SQLite una transazione che legge
+    e poi scrive fallisce se un altro import sta scrivendo); due import concorrenti dello
+    stesso contenuto possono quindi creare una copia, che dedupe_questions riunisce.
+    """
+    by_fingerprint = {}
+    for question in chunk:
+        question.fingerprint = question.compute_fingerprint()
+        # A parità di impronta nello stesso blocco vale l'ultima riga.
+        by_fingerprint[question.fingerprint] = question
+    result.unchanged += len(chunk) - len(by_fingerprint)
+    existing = {}
+    for qid, fingerprint, correct_option, is_active in (
+        Question.objects.filter(fingerprint__in=by_fingerprint)
+        .order_by("-id")
+        .values_list("id", "fingerprint", "correct_option", "is_active")
+    ):
+        # Copie precedenti alla deduplica: si aggiorna la più vecchia, come farebbe dedupe_questions.
+        existing[fingerprint] = (qid, correct_option, is_active)
+    new = [question for fingerprint, question in by_fingerprint.items() if fingerprint not in existing]
+    changed = []
+    for fingerprint, (qid, correct_option, is_active) in existing.items():
+        question = by_fingerprint[fingerprint]
+        if (question.correct_option, question.is_active) == (correct_option, is_active):
+            result.unchanged += 1
+            continue
+        question.id = qid
+        changed.append(question)
+    with transaction.atomic():
+        Question.objects.bulk_create(new)
+        Question.objects.bulk_update(changed, ["correct_option", "is_active"])
+    result.created += len(new)
+    result.updated += len(changed)
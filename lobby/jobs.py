@@ -0,0 +1,134 @@
+"""Import CSV delle domande fuori dalla richiesta HTTP.
+
+L'upload viene copiato in un file temporaneo e accodato a un pool di thread del
+processo (``QUESTION_IMPORT_WORKERS``): la view dell'admin risponde subito e le
+richieste di gioco, servite da altri thread, non aspettano l'import. Lo stato
+del job è salvato in ``QuestionImportJob`` e ogni avanzamento viene inviato al
+gruppo ``question_imports`` del channel layer, seguito dall'elenco domande in admin.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .importers import import_questions
+from .models import QuestionImportJob
+
+IMPORT_GROUP = "question_imports"
+# Intervallo minimo tra due salvataggi/notifiche di avanzamento dello stesso job.
+PROGRESS_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, "QUESTION_IMPORT_WORKERS", 2), thread_name_prefix="question-import"
+)
+
+
+def enqueue_import(uploaded_file):
+    """Salva l'upload su disco, crea il job e lo accoda al commit; restituisce il job."""
+    with tempfile.NamedTemporaryFile(
+        dir=getattr(settings, "QUESTION_IMPORT_DIR", None), prefix="import-", suffix=".csv", delete=False
+    ) as target:
+        for chunk in uploaded_file.chunks():
+            target.write(chunk)
+    job = QuestionImportJob.objects.create(
+        filename=uploaded_file.name, path=target.name, size=os.path.getsize(target.name)
+    )
+    loop = server_event_loop()
+    transaction.on_commit(lambda: executor.submit(run_import, job.pk, loop))
+    broadcast_job(job)
+    return job
+
+
+def server_event_loop():
+    """Event loop del server ASGI che sta servendo la richiesta, None se non c'è (comandi, WSGI)."""
+
+    async def running_loop():
+        return asyncio.get_running_loop()
+
+    loop = async_to_sync(running_loop)()
+    return loop if loop.is_running() else None
+
+
+def broadcast_job(job, loop=None):
+    message = {"type": "import_progress", "job": job.as_dict()}
+    if loop is None:
+        async_to_sync(get_channel_layer().group_send)(IMPORT_GROUP, message)
+        return
+    # Dai thread del pool si passa dal loop del server: il channel layer in memoria
+    # non sveglia un loop diverso da quello su cui i consumer sono in attesa.
+    asyncio.run_coroutine_threadsafe(get_channel_layer().group_send(IMPORT_GROUP, message), loop).result()
+
+
+def run_import(job_id, loop=None):
+    close_old_connections()
+    try:
+        job = QuestionImportJob.objects.get(pk=job_id)
+        job.status = QuestionImportJob.STATUS_RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=["status", "started_at"])
+        broadcast_job(job, loop)
+        try:
+            execute_import(job, loop)
+        except ValueError as exc:
+            fail_job(job, str(exc), loop)
+        except Exception:
+            logger.exception("question import failed", extra={"job": job.pk})
+            fail_job(job, "Errore imprevisto durante l'import: dettagli nel log del server.", loop)
+        finally:
+            if os.path.exists(job.path):
+                os.remove(job.path)
+    finally:
+        # Thread del pool: la connessione non viene chiusa dal ciclo richiesta/risposta di Django.
+        connection.close()
+
+
+def execute_import(job, loop=None):
+    last_sent = 0.0
+
+    with open(job.path, "rb") as raw:
+
+        def progress(result):
+            nonlocal last_sent
+            now = time.monotonic()
+            if now - last_sent < PROGRESS_INTERVAL:
+                return
+            last_sent = now
+            save_progress(job, result, raw.tell(), loop)
+
+        result = import_questions(
+            io.TextIOWrapper(raw, encoding="utf-8", newline=""),
+            chunk_size=settings.QUESTION_IMPORT_CHUNK_SIZE,
+            on_chunk=progress,
+        )
+    job.status = QuestionImportJob.STATUS_DONE
+    job.finished_at = timezone.now()
+    job.errors = result.summary()
+    save_progress(job, result, job.size, loop, extra_fields=["status", "finished_at", "errors"])
+
+
+def save_progress(job, result, bytes_read, loop=None, extra_fields=()):
+    job.bytes_read = bytes_read
+    job.rows = result.rows
+    job.imported = result.created
+    job.error_count = result.error_count
+    job.save(update_fields=["bytes_read", "rows", "imported", "error_count", *extra_fields])
+    broadcast_job(job, loop)
+
+
+def fail_job(job, message, loop=None):
+    job.status = QuestionImportJob.STATUS_FAILED
+    job.finished_at = timezone.now()
+    job.errors = message
+    job.save(update_fields=["status", "finished_at", "errors"])
+    broadcast_job(job, loop)
@@ -0,0 +1,187 @@
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.crypto import get_random_string
+
+from lobby.forms import ICON_CHOICES
+from lobby.management.commands.bench_gameplay import Client
+from lobby.models import Game, Player, Room
+from lobby.sampling import BOARD_SLOTS, sample_board
+from lobby.views import MAX_PLAYERS, create_game
+
+
+class Command(BaseCommand):
+    help = (
+        "Risposte simultanee contro un server avviato: N stanze con fino a 10 giocatori in modalità "
+        "'rispondono tutti', e a ogni domanda tutti i giocatori di tutte le stanze rispondono entro la "
+        "stessa finestra di pochi millisecondi. Riporta latenza delle risposte, errori, tempo di chiusura "
+        "del turno e verifica che ogni risposta sia registrata una volta, in ordine d'arrivo. Stanze e "
+        "partite sono create direttamente nel DB del server, nei limiti della lobby, e cancellate alla fine."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Indirizzo del server da misurare.")
+        parser.add_argument("--rooms", type=int, default=12, help="Stanze che giocano in parallelo.")
+        parser.add_argument(
+            "--players", type=int, default=MAX_PLAYERS, help=f"Giocatori per stanza (al più {MAX_PLAYERS})."
+        )
+        parser.add_argument("--window-ms", type=float, default=50, help="Finestra in cui partono tutte le risposte.")
+        parser.add_argument("--rounds", type=int, default=5, help="Domande giocate.")
+
+    def handle(self, *args, **options):
+        players = options["players"]
+        if not 1 <= players <= min(MAX_PLAYERS, len(ICON_CHOICES)):
+            raise CommandError(f"I giocatori per stanza vanno da 1 a {MAX_PLAYERS}, come nella lobby.")
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        tables = []
+        try:
+            for _ in range(options["rooms"]):
+                tables.append(self.create_table(store, players, options["url"]))
+            for table in tables:
+                for seat, client in enumerate(table["clients"]):
+                    # Connessioni keep-alive aperte prima della misura.
+                    self.get_state(client, table["code"], table["cookies"][seat])
+            # Posti alternati tra le stanze: nella finestra gli invii di una stanza restano distanziati.
+            seats = [(table, seat) for seat in range(players) for table in tables]
+            latencies, spreads, closes, errors = [], [], [], 0
+            self.inversions = 0
+            with ThreadPoolExecutor(max_workers=len(seats)) as pool:
+                for _ in range(options["rounds"]):
+                    versions = {table["code"]: self.choose(table) for table in tables}
+                    if None in versions.values():
+                        break
+                    # Partenze scaglionate nella finestra: l'ordine atteso è quello d'invio.
+                    start = time.perf_counter() + 0.2
+                    step = options["window_ms"] / 1000 / len(seats)
+                    barrier = threading.Barrier(len(seats))
+                    results = list(
+                        pool.map(
+                            lambda index: self.answer(
+                                seats[index][0],
+                                seats[index][1],
+                                versions[seats[index][0]["code"]],
+                                barrier,
+                                start + index * step,
+                            ),
+                            range(len(seats)),
+                        )
+                    )
+                    sent = [sent for sent, _, _ in results]
+                    spreads.append((max(sent) - min(sent)) * 1000)
+                    latencies.extend(elapsed for _, elapsed, ok in results if ok)
+                    errors += sum(not ok for _, _, ok in results)
+                    closes.append((max(sent[i] + results[i][1] / 1000 for i in range(len(seats))) - min(sent)) * 1000)
+                    by_room = {table["code"]: [0.0] * players for table in tables}
+                    for (table, seat), at in zip(seats, sent):
+                        by_room[table["code"]][seat] = at
+                    for table in tables:
+                        self.verify(table, players, by_room[table["code"]])
+        finally:
+            for table in tables:
+                table["room"].delete()
+        self.report(len(tables), players, latencies, spreads, closes, errors)
+
+    def create_table(self, store, players, url):
+        """Stanza con ``players`` giocatori (icone della lobby) e partita avviata in modalità ``ANSWER_ALL``."""
+        room = Room.objects.create()
+        cookies, seated = [], []
+        for seat in range(players):
+            session = store()
+            session.create()
+            seated.append(
+                Player.objects.create(
+                    room=room,
+                    nickname=f"Buzz{seat}",
+                    icon=ICON_CHOICES[seat][0],
+                    session_key=session.session_key,
+                )
+            )
+            csrf = get_random_string(32)
+            cookies.append((f"{settings.SESSION_COOKIE_NAME}={session.session_key}; {settings.CSRF_COOKIE_NAME}={csrf}", csrf))
+        question_ids = list(sample_board(BOARD_SLOTS).values())
+        if not all(question_ids):
+            room.delete()
+            raise CommandError("Servono domande per ogni materia e livello.")
+        # Avvio senza passare dalla lobby: il server carica la partita dalle tabelle alla prima richiesta.
+        with transaction.atomic():
+            create_game(room, seated, seated[0], question_ids, answer_mode=Game.ANSWER_ALL)
+        return {
+            "room": room,
+            "code": room.code,
+            "cookies": cookies,
+            "clients": [Client(url) for _ in range(players)],
+            "by_nickname": {f"Buzz{seat}": seat for seat in range(players)},
+        }
+
+    def choose(self, table):
+        """Il giocatore di turno sceglie la prima casella libera; restituisce la versione, None a partita finita."""
+        code, cookies, clients = table["code"], table["cookies"], table["clients"]
+        state = self.get_state(clients[0], code, cookies[0])
+        if state["game_over"]:
+            return None
+        chooser = table["by_nickname"][state["current_player"]["nickname"]]
+        category, level = next(
+            (category, level) for category, levels in state["available"].items() for level, count in levels.items() if count
+        )
+        status, body = clients[chooser].request(
+            "POST",
+            f"/stanza/{code}/gioco/scegli/",
+            cookies[chooser],
+            {"category": category, "difficulty": level, "version": state["version"]},
+        )
+        if status != 200:
+            raise CommandError(f"Scelta fallita ({status}): {body[:200]!r}")
+        return json.loads(body)["version"]
+
+    def get_state(self, client, code, cookie):
+        status, body = client.request("GET", f"/stanza/{code}/gioco/state/", cookie)
+        if status != 200:
+            raise CommandError(f"Stato non disponibile ({status}).")
+        return json.loads(body)
+
+    def answer(self, table, seat, version, barrier, at):
+        barrier.wait()
+        while time.perf_counter() < at:
+            pass
+        sent = time.perf_counter()
+        status, _ = table["clients"][seat].request(
+            "POST",
+            f"/stanza/{table['code']}/gioco/rispondi/",
+            table["cookies"][seat],
+            {"option": "ABC"[seat % 3], "version": version},
+        )
+        return sent, (time.perf_counter() - sent) * 1000, status == 200
+
+    def verify(self, table, players, sent):
+        last_answer = self.get_state(table["clients"][0], table["code"], table["cookies"][0])["last_answer"]
+        answers = (last_answer or {}).get("answers") or []
+        if len(answers) != players:
+            raise CommandError(f"Stanza {table['code']}: registrate {len(answers)} risposte su {players}.")
+        ranks = [row["rank"] for row in answers if row["rank"] is not None]
+        if ranks != list(range(1, len(ranks) + 1)):
+            raise CommandError("Posizioni delle risposte corrette non consecutive.")
+        # Ordine del server contro ordine d'invio: inversioni solo tra invii più vicini della latenza di rete.
+        order = [table["by_nickname"][row["player"]["nickname"]] for row in answers]
+        self.inversions += sum(1 for a, b in zip(order, order[1:]) if sent[a] > sent[b])
+
+    def report(self, rooms, players, latencies, spreads, closes, errors):
+        if len(latencies) < 2:
+            raise CommandError("Troppe poche risposte per una misura.")
+        p99 = statistics.quantiles(latencies, n=100)[98]
+        self.stdout.write(f"stanze {rooms} da {players} giocatori, domande {len(spreads)}")
+        self.stdout.write(
+            f"invii entro      {statistics.median(spreads):8.1f} ms (mediana per domanda, max {max(spreads):.1f})"
+        )
+        self.stdout.write(
+            f"risposta         p50 {statistics.median(latencies):7.1f} ms  p99 {p99:7.1f} ms  max {max(latencies):7.1f} ms"
+        )
+        self.stdout.write(f"turni chiusi in  {statistics.median(closes):8.1f} ms dal primo invio (mediana)")
+        self.stdout.write(f"errori           {errors:8d}")
+        self.stdout.write(f"inversioni       {self.inversions:8d} (coppie arrivate in ordine diverso dall'invio)")
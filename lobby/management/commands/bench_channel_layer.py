@@ -0,0 +1,130 @@
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand, CommandError
+
+from lobby.channel_layer import UnixSocketChannelLayer
+
+GROUP = "bench"
+
+
+async def play(layer, channels, senders, messages, size, barrier, timeout):
+    """Un worker: ``channels`` canali nel gruppo e ``messages`` group_send; restituisce (secondi, consegne, perse)."""
+    names = [await layer.new_channel() for _ in range(channels)]
+    for name in names:
+        await layer.group_add(GROUP, name)
+    if isinstance(layer, UnixSocketChannelLayer):
+        while not layer.connected:
+            await asyncio.sleep(0.01)
+    loop = asyncio.get_running_loop()
+    if barrier is not None:
+        await loop.run_in_executor(None, barrier.wait)
+        # I group_add degli altri worker devono arrivare al broker prima dei primi invii.
+        await asyncio.sleep(0.2)
+    expected = senders * messages
+    received = [0]
+
+    async def drain(name):
+        for _ in range(expected):
+            await layer.receive(name)
+            received[0] += 1
+
+    receivers = asyncio.gather(*(drain(name) for name in names))
+    payload = "x" * size
+    started = time.perf_counter()
+    for seq in range(messages):
+        await layer.group_send(GROUP, {"type": "bench.message", "seq": seq, "payload": payload})
+        if seq % 32 == 0:
+            await asyncio.sleep(0)
+    try:
+        await asyncio.wait_for(receivers, timeout)
+    except asyncio.TimeoutError:
+        pass
+    return time.perf_counter() - started, received[0], getattr(layer, "dropped", 0)
+
+
+def run_worker(path, channels, senders, messages, size, barrier, timeout, results):
+    layer = UnixSocketChannelLayer(path, capacity=senders * messages + 1)
+    results.put(asyncio.run(play(layer, channels, senders, messages, size, barrier, timeout)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Messaggi consegnati al secondo dal channel layer multi-processo al crescere dei worker: "
+        "ogni worker ha N canali in un gruppo comune e vi invia M group_send. "
+        "Avvia un broker temporaneo; solo Linux (fork)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", default="1,2,4,8", help="Numero di processi da misurare, separati da virgola.")
+        parser.add_argument("--channels", type=int, default=50, help="Canali (socket) per worker.")
+        parser.add_argument("--messages", type=int, default=500, help="group_send per worker.")
+        parser.add_argument("--size", type=int, default=2000, help="Byte di payload per messaggio.")
+        parser.add_argument("--timeout", type=float, default=60, help="Attesa massima delle consegne per worker.")
+
+    def handle(self, *args, **options):
+        if not hasattr(os, "fork"):
+            raise CommandError("Il benchmark avvia i worker con fork: serve Linux.")
+        context = multiprocessing.get_context("fork")
+        self.stdout.write(
+            f"{'backend':<10} {'worker':>6} {'group_send/s':>13} {'consegne/s':>11} {'consegnati':>11} {'persi':>6}"
+        )
+        layer = InMemoryChannelLayer(capacity=options["messages"] + 1)
+        elapsed, delivered, lost = asyncio.run(
+            play(layer, options["channels"], 1, options["messages"], options["size"], None, options["timeout"])
+        )
+        self.row("in-memory", 1, options["messages"], elapsed, delivered, lost)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "channels.sock")
+            broker = subprocess.Popen(
+                [sys.executable, "manage.py", "channel_broker", "--socket", path], stdout=subprocess.DEVNULL
+            )
+            try:
+                for workers in (int(value) for value in options["workers"].split(",")):
+                    barrier = context.Barrier(workers)
+                    results = context.Queue()
+                    processes = [
+                        context.Process(
+                            target=run_worker,
+                            args=(
+                                path,
+                                options["channels"],
+                                workers,
+                                options["messages"],
+                                options["size"],
+                                barrier,
+                                options["timeout"],
+                                results,
+                            ),
+                        )
+                        for _ in range(workers)
+                    ]
+                    for process in processes:
+                        process.start()
+                    outcomes = [results.get(timeout=options["timeout"] + 30) for _ in processes]
+                    for process in processes:
+                        process.join()
+                    self.row(
+                        "broker",
+                        workers,
+                        workers * options["messages"],
+                        max(elapsed for elapsed, _, _ in outcomes),
+                        sum(delivered for _, delivered, _ in outcomes),
+                        workers * workers * options["messages"] * options["channels"]
+                        - sum(delivered for _, delivered, _ in outcomes),
+                    )
+            finally:
+                broker.terminate()
+                broker.wait()
+
+    def row(self, backend, workers, sent, elapsed, delivered, lost):
+        self.stdout.write(
+            f"{backend:<10} {workers:>6} {sent / elapsed:13.0f} {delivered / elapsed:11.0f} {delivered:>11} {lost:>6}"
+        )
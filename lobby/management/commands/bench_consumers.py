@@ -0,0 +1,157 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+from importlib import import_module
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lobby.cache import game_snapshots
+from lobby.db_executor import db_executor
+from lobby.forms import ICON_CHOICES
+from lobby.models import Player, Room
+from lobby.sampling import BOARD_SLOTS, sample_board
+from lobby.views import create_game
+
+
+def create_table(index, question_ids):
+    """Stanza con due giocatori e partita avviata; restituisce (codice, {nickname: header cookie})."""
+    store = import_module(settings.SESSION_ENGINE).SessionStore
+    room = Room.objects.create()
+    players, cookies = [], {}
+    for seat, (icon, _) in enumerate(ICON_CHOICES[:2]):
+        session = store()
+        session.create()
+        nickname = f"Bench{index}-{seat}"
+        players.append(Player.objects.create(room=room, nickname=nickname, icon=icon, session_key=session.session_key))
+        cookies[nickname] = [(b"cookie", f"{settings.SESSION_COOKIE_NAME}={session.session_key}".encode())]
+    create_game(room, players, players[0], question_ids)
+    return room.code, cookies
+
+
+async def open_socket(application, code, cookie):
+    socket = WebsocketCommunicator(application, f"/ws/stanza/{code}/gioco/", headers=cookie)
+    connected, _ = await socket.connect(timeout=30)
+    if not connected:
+        raise CommandError(f"Connessione WebSocket rifiutata per la stanza {code}")
+    await socket.receive_from(timeout=30)  # hello
+    state = json.loads(await socket.receive_from(timeout=30))
+    return socket, state
+
+
+class Command(BaseCommand):
+    help = (
+        "Latenza azione -> stato ricevuto in una stanza mentre altre N stanze sullo stesso processo "
+        "si ricollegano di continuo, con il pool DB dei consumer e con il thread unico (workers 0). "
+        "Stanze e giocatori di prova vengono creati nel DB e cancellati alla fine."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", default="10,50,200", help="Stanze con riconnessioni continue, separate da virgola.")
+        parser.add_argument("--workers", default=f"0,{settings.DB_EXECUTOR_WORKERS}", help="Thread del pool da confrontare.")
+        parser.add_argument("--probes", type=int, default=20, help="Azioni misurate nella stanza sonda (max 48).")
+        parser.add_argument(
+            "--interval", type=float, default=1.0, help="Secondi tra due riconnessioni nella stessa stanza (0 = senza pausa)."
+        )
+
+    def handle(self, *args, **options):
+        from quizzzone.asgi import application
+
+        sizes = sorted(int(size) for size in options["rooms"].split(","))
+        chosen = sample_board(BOARD_SLOTS)
+        if not all(chosen.values()):
+            raise CommandError("Serve almeno una domanda attiva per ogni materia e livello.")
+        question_ids = list(chosen.values())
+        tables = [create_table(index, question_ids) for index in range(sizes[-1] + 1)]
+        self.stdout.write(
+            f"{'workers':>8} {'stanze':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'riconn./s':>10} {'coda max':>9}"
+        )
+        try:
+            for workers in (int(value) for value in options["workers"].split(",")):
+                db_executor.workers = workers
+                for size in sizes:
+                    # Stanza sonda nuova per ogni misura: la partita ha 25 domande.
+                    probe = create_table(len(tables), question_ids)
+                    tables.append(probe)
+                    result = asyncio.run(
+                        self.measure(application, probe, tables[:size], options["probes"], options["interval"])
+                    )
+                    self.stdout.write(
+                        f"{workers:>8} {size:>7} {result['p50']:8.2f} {result['p99']:8.2f} {result['max']:8.2f} "
+                        f"{result['reconnects']:10.1f} {result['max_queued']:>9}"
+                    )
+        finally:
+            Room.objects.filter(code__in=[code for code, _ in tables]).delete()
+            game_snapshots.clear()
+
+    async def measure(self, application, probe, churn_tables, probes, interval):
+        db_executor._max_queued = 0
+        stop = asyncio.Event()
+        reconnects = [0]
+
+        async def churn(code, cookie):
+            # Una riconnessione ogni ``interval`` secondi: ognuna legge sessione e stato della stanza dal DB.
+            await asyncio.sleep(random.uniform(0, interval))
+            while not stop.is_set():
+                started = time.perf_counter()
+                socket, _ = await open_socket(application, code, cookie)
+                await socket.disconnect()
+                reconnects[0] += 1
+                await asyncio.sleep(max(0, interval - (time.perf_counter() - started)))
+
+        code, cookies = probe
+        sockets = {}
+        state = None
+        for nickname, cookie in cookies.items():
+            sockets[nickname], state = await open_socket(application, code, cookie)
+        workers = [asyncio.create_task(churn(table_code, next(iter(table_cookies.values())))) for table_code, table_cookies in churn_tables]
+        await asyncio.sleep(max(1, interval))
+        reconnects[0] = 0
+        started = time.perf_counter()
+        samples = []
+        try:
+            for index in range(probes):
+                socket = sockets[state["current_player"]["nickname"]]
+                if state["status"] == "choosing":
+                    category, level = next(
+                        (category, int(level))
+                        for category, levels in state["available"].items()
+                        for level, count in levels.items()
+                        if count
+                    )
+                    action = {"type": "choose", "category": category, "difficulty": level}
+                else:
+                    action = {"type": "answer", "option": "A"}
+                sent = time.perf_counter()
+                await socket.send_to(json.dumps({**action, "request_id": index, "version": state["version"]}))
+                ack = json.loads(await socket.receive_from(timeout=60))
+                if not ack["ok"]:
+                    raise CommandError(f"Azione rifiutata: {ack}")
+                state = await self.receive_version(socket, ack["version"])
+                samples.append((time.perf_counter() - sent) * 1000)
+                # Anche l'altro giocatore riceve il broadcast: lo si consuma per tenere pulita la sua coda.
+                for other in sockets.values():
+                    if other is not socket:
+                        await self.receive_version(other, ack["version"])
+        finally:
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for socket in sockets.values():
+                await socket.disconnect()
+        return {
+            "p50": statistics.median(samples),
+            "p99": statistics.quantiles(samples, n=100, method="inclusive")[98] if len(samples) > 1 else samples[0],
+            "max": max(samples),
+            "reconnects": reconnects[0] / elapsed,
+            "max_queued": db_executor.stats()["max_queued"] if db_executor.workers else "-",
+        }
+
+    async def receive_version(self, socket, version):
+        while True:
+            message = json.loads(await socket.receive_from(timeout=60))
+            if message.get("type") == "game_state" and message["version"] >= version:
+                return message
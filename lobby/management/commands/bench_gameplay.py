@@ -0,0 +1,178 @@
+import http.client
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+
+from lobby.forms import ICON_CHOICES
+from lobby.models import Player, Room
+
+ENDPOINTS = ("avvio", "state", "scegli", "rispondi")
+
+
+class Table:
+    """Una stanza con due giocatori e la loro sessione, creata nel DB condiviso con il server."""
+
+    def __init__(self, index):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        self.room = Room.objects.create()
+        self.cookies = {}
+        for seat, (icon, _) in enumerate(ICON_CHOICES[:2]):
+            session = store()
+            session.create()
+            nickname = f"Bench{index}-{seat}"
+            Player.objects.create(room=self.room, nickname=nickname, icon=icon, session_key=session.session_key)
+            csrf = get_random_string(32)
+            self.cookies[nickname] = (
+                f"{settings.SESSION_COOKIE_NAME}={session.session_key}; {settings.CSRF_COOKIE_NAME}={csrf}",
+                csrf,
+            )
+        self.host = next(iter(self.cookies))
+
+
+class Client:
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.connection = None
+
+    def request(self, method, path, cookie, body=None):
+        cookie_header, csrf = cookie
+        headers = {"Cookie": cookie_header, "X-CSRFToken": csrf}
+        if body is not None:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            body = urlencode(body)
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, response.read()
+            except (ConnectionError, http.client.HTTPException):
+                # Connessione keep-alive chiusa dal server: si riapre una volta.
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+
+class Command(BaseCommand):
+    help = (
+        "Gioca partite in parallelo contro un server avviato (es. daphne quizzzone.asgi:application) "
+        "e riporta richieste/s e latenza p50/p99 di stato, scelta e risposta. "
+        "Stanze e giocatori di prova vengono creati nel DB del server e cancellati alla fine."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Indirizzo del server da misurare.")
+        parser.add_argument("--concurrency", type=int, default=8, help="Partite giocate in parallelo.")
+        parser.add_argument("--duration", type=float, default=15, help="Durata della misura in secondi.")
+
+    def handle(self, *args, **options):
+        self.samples = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.rooms = []
+        self.lock = threading.Lock()
+        deadline = time.monotonic() + options["duration"]
+        started = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+                workers = [
+                    pool.submit(self.play, options["url"], index, deadline) for index in range(options["concurrency"])
+                ]
+                for worker in workers:
+                    worker.result()
+        finally:
+            elapsed = time.perf_counter() - started
+            Room.objects.filter(pk__in=self.rooms).delete()
+        self.report(elapsed)
+
+    def play(self, url, index, deadline):
+        client = Client(url)
+        table = None
+        while time.monotonic() < deadline:
+            if table is None:
+                table = self.new_table(client, index)
+                if table is None:
+                    continue
+            code = table.room.code
+            state = self.call(client, "state", "GET", f"/stanza/{code}/gioco/state/", table.cookies[table.host])
+            if state is None:
+                continue
+            if state["game_over"]:
+                table = None
+                continue
+            cookie = table.cookies[state["current_player"]["nickname"]]
+            category, level = next(
+                (category, level)
+                for category, levels in state["available"].items()
+                for level, count in levels.items()
+                if count
+            )
+            chosen = self.call(
+                client,
+                "scegli",
+                "POST",
+                f"/stanza/{code}/gioco/scegli/",
+                cookie,
+                {"category": category, "difficulty": level, "version": state["version"]},
+            )
+            if chosen is None:
+                continue
+            self.call(
+                client,
+                "rispondi",
+                "POST",
+                f"/stanza/{code}/gioco/rispondi/",
+                cookie,
+                {"option": "A", "version": chosen["version"]},
+            )
+
+    def new_table(self, client, index):
+        table = Table(index)
+        with self.lock:
+            self.rooms.append(table.room.pk)
+        started = time.perf_counter()
+        status, body = client.request("POST", f"/stanza/{table.room.code}/start/", table.cookies[table.host], {})
+        elapsed = (time.perf_counter() - started) * 1000
+        if status == 400:
+            raise CommandError(f"Avvio partita fallito: {body.decode(errors='replace')[:200]}")
+        with self.lock:
+            if status != 302:
+                self.errors["avvio"] += 1
+                return None
+            self.samples["avvio"].append(elapsed)
+        return table
+
+    def call(self, client, endpoint, method, path, cookie, body=None):
+        started = time.perf_counter()
+        status, payload = client.request(method, path, cookie, body)
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.lock:
+            if status != 200:
+                self.errors[endpoint] += 1
+                return None
+            self.samples[endpoint].append(elapsed)
+        return json.loads(payload)
+
+    def report(self, elapsed):
+        self.stdout.write(f"{'endpoint':<10} {'richieste':>10} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errori':>7}")
+        rows = [(endpoint, self.samples[endpoint], self.errors[endpoint]) for endpoint in ENDPOINTS]
+        rows.append(("totale", sum(self.samples.values(), []), sum(self.errors.values())))
+        for name, samples, errors in rows:
+            if len(samples) < 2:
+                self.stdout.write(f"{name:<10} {len(samples):>10} {'-':>8} {'-':>8} {'-':>8} {errors:>7}")
+                continue
+            p99 = statistics.quantiles(samples, n=100)[98]
+            self.stdout.write(
+                f"{name:<10} {len(samples):>10} {len(samples) / elapsed:8.1f} "
+                f"{statistics.median(samples):8.2f} {p99:8.2f} {errors:>7}"
+            )
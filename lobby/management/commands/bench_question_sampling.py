@@ -0,0 +1,94 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from lobby.models import Question
+from lobby.question_bank import question_bank
+from lobby.sampling import sample_by_id_range, slot_ranges
+from lobby.views import REQUIRED_COMBINATIONS
+
+
+def legacy_board():
+    # Estrazione precedente: una query ORDER BY random() per casella.
+    return {
+        (category, level): Question.objects.filter(is_active=True, category=category, difficulty=level)
+        .order_by("?")
+        .values_list("id", flat=True)
+        .first()
+        for category, level in REQUIRED_COMBINATIONS
+    }
+
+
+def timed(func, rounds):
+    samples = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+class Command(BaseCommand):
+    help = (
+        "Misura il tempo di estrazione delle 25 domande di una partita al crescere del banco. "
+        "Le domande sintetiche vengono inserite in una transazione annullata alla fine."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="500,5000,50000,250000,1000000", help="Dimensioni del banco, separate da virgola.")
+        parser.add_argument("--rounds", type=int, default=20, help="Estrazioni per misura (si riporta la mediana).")
+        parser.add_argument("--legacy-limit", type=int, default=250000, help="Oltre questa dimensione non si misura ORDER BY random().")
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options["sizes"].split(","))
+        rounds = options["rounds"]
+        self.stdout.write(
+            f"{'domande':>10} {'legacy ms':>10} {'freddo ms':>10} {'caldo ms':>10} {'indice ms':>10} {'memoria ms':>10}"
+        )
+        with transaction.atomic():
+            count = Question.objects.filter(is_active=True).count()
+            for size in sizes:
+                count += self.fill(size - count)
+                legacy = timed(legacy_board, rounds) if count <= options["legacy_limit"] else None
+
+                def cold():
+                    slot_ranges.invalidate()
+                    sample_by_id_range(REQUIRED_COMBINATIONS)
+
+                cold_ms = timed(cold, rounds)
+                warm_ms = timed(lambda: sample_by_id_range(REQUIRED_COMBINATIONS), rounds)
+                # bulk_create non invia segnali: l'indice in memoria va ricaricato a mano (una volta per misura).
+                question_bank.reload()
+                index_ms = timed(question_bank.index, 1)
+                memory_ms = timed(lambda: question_bank.sample(REQUIRED_COMBINATIONS), rounds)
+                legacy_text = f"{legacy:10.2f}" if legacy is not None else f"{'-':>10}"
+                self.stdout.write(
+                    f"{count:>10} {legacy_text} {cold_ms:10.2f} {warm_ms:10.2f} {index_ms:10.2f} {memory_ms:10.2f}"
+                )
+            transaction.set_rollback(True)
+        slot_ranges.invalidate()
+        question_bank.reload()
+
+    def fill(self, missing, batch_size=5000):
+        created = 0
+        while created < missing:
+            batch = [
+                Question(
+                    category=category,
+                    difficulty=level,
+                    text=f"Domanda di prova {created + idx}",
+                    option_a="a",
+                    option_b="b",
+                    option_c="c",
+                    correct_option=Question.OPTION_A,
+                )
+                for idx, (category, level) in enumerate(
+                    REQUIRED_COMBINATIONS[(created + n) % len(REQUIRED_COMBINATIONS)]
+                    for n in range(min(batch_size, missing - created))
+                )
+            ]
+            Question.objects.bulk_create(batch)
+            created += len(batch)
+        return max(created, 0)
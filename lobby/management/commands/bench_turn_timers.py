@@ -0,0 +1,100 @@
+import asyncio
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lobby.timer_wheel import TimerWheel
+
+
+async def measure(backend, delays, rearm, load_ms, tick):
+    """Una scadenza per stanza, una parte riarmata prima di scadere, l'event loop occupato da ``load_ms``.
+
+    Restituisce (µs per armo, µs per riarmo, ritardi in secondi rispetto all'istante previsto).
+    """
+    loop = asyncio.get_running_loop()
+    wheel = TimerWheel(tick=tick)
+    late = []
+    pending = [len(delays)]
+    done = asyncio.Event()
+
+    def fire(when):
+        late.append(loop.time() - when)
+        pending[0] -= 1
+        if not pending[0]:
+            done.set()
+
+    async def sleeper(delay, when):
+        await asyncio.sleep(delay)
+        fire(when)
+
+    def arm(delay):
+        when = loop.time() + delay
+        if backend == "wheel":
+            return wheel.call_later(delay, fire, when)
+        if backend == "call_later":
+            return loop.call_later(delay, fire, when)
+        return loop.create_task(sleeper(delay, when))
+
+    running = True
+
+    async def load():
+        # Richieste simulate: CPU per load_ms, poi una pausa uguale (loop occupato al 50%).
+        while running:
+            end = time.perf_counter() + load_ms / 1000
+            while time.perf_counter() < end:
+                pass
+            await asyncio.sleep(load_ms / 1000)
+
+    loader = loop.create_task(load()) if load_ms else None
+    started = time.perf_counter()
+    handles = [arm(delay) for delay in delays]
+    armed = time.perf_counter() - started
+    # Le stanze che giocano: la scadenza si sposta in avanti, come dopo una scelta o una risposta.
+    moved = range(0, len(delays), max(int(1 / rearm), 1)) if rearm else range(0)
+    started = time.perf_counter()
+    for index in moved:
+        handles[index].cancel()
+        handles[index] = arm(delays[index] + 1)
+    rearmed = time.perf_counter() - started
+    try:
+        await asyncio.wait_for(done.wait(), max(delays) + 30)
+    finally:
+        running = False
+        if loader is not None:
+            await loader
+    return armed / len(delays) * 1e6, rearmed / max(len(moved), 1) * 1e6, late
+
+
+class Command(BaseCommand):
+    help = (
+        "Scadenze dei turni per molte stanze: costo di armo e riarmo e ritardo dei timer rispetto "
+        "all'istante previsto, con l'event loop sotto carico. Confronta la ruota di timer del processo "
+        "con loop.call_later e con un task per stanza."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=20000, help="Stanze, una scadenza ciascuna.")
+        parser.add_argument("--spread", type=float, default=5, help="Secondi su cui si distribuiscono le scadenze.")
+        parser.add_argument("--rearm", type=float, default=0.5, help="Frazione di stanze che riarmano prima di scadere.")
+        parser.add_argument("--load-ms", type=float, default=2, help="Millisecondi di CPU per richiesta simulata (0: loop libero).")
+        parser.add_argument("--tick", type=float, default=settings.TURN_TIMER_TICK, help="Tick della ruota in secondi.")
+        parser.add_argument("--backends", default="wheel,call_later,task", help="Backend da misurare, separati da virgola.")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        delays = [1 + rng.random() * options["spread"] for _ in range(options["rooms"])]
+        self.stdout.write(
+            f"{'backend':<11} {'stanze':>7} {'armo µs':>8} {'riarmo µs':>10} "
+            f"{'ritardo p50':>12} {'p99':>8} {'max':>8}  (ms)"
+        )
+        for backend in options["backends"].split(","):
+            armed, rearmed, late = asyncio.run(
+                measure(backend, delays, options["rearm"], options["load_ms"], options["tick"])
+            )
+            late.sort()
+            self.stdout.write(
+                f"{backend:<11} {len(late):>7} {armed:8.2f} {rearmed:10.2f} "
+                f"{late[len(late) // 2] * 1000:12.1f} {late[int(len(late) * 0.99)] * 1000:8.1f} {late[-1] * 1000:8.1f}"
+            )
@@ -0,0 +1,29 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from lobby.channel_layer import ChannelBroker
+
+
+class Command(BaseCommand):
+    help = (
+        "Avvia il broker dei gruppi per il channel layer multi-processo: i worker ASGI della "
+        "macchina (QUIZZZONE_CHANNEL_BROKER) vi si collegano per inoltrarsi i broadcast."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--socket",
+            default=settings.CHANNEL_BROKER_SOCKET or "/tmp/quizzzone-channels.sock",
+            help="Percorso del socket Unix.",
+        )
+        parser.add_argument(
+            "--group-expiry", type=int, default=86400, help="Secondi dopo i quali un canale esce da un gruppo."
+        )
+
+    def handle(self, *args, **options):
+        broker = ChannelBroker(options["socket"], group_expiry=options["group_expiry"])
+        self.stdout.write(f"Broker in ascolto su {options['socket']}")
+        asyncio.run(broker.serve())
+        self.stdout.write(f"{broker.forwarded} messaggi inoltrati, {broker.dropped} scartati.")
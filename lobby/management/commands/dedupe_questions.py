@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from lobby.dedup import backfill_fingerprints, merge_duplicates
+
+
+class Command(BaseCommand):
+    help = (
+        "Unisce le domande con lo stesso contenuto (materia, livello, testo e opzioni). "
+        "Tiene la più vecchia; partite e turni delle copie passano a quella."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Gruppi di copie uniti per transazione.")
+        parser.add_argument("--dry-run", action="store_true", help="Conta le copie senza modificare nulla.")
+
+    def handle(self, *args, **options):
+        filled = backfill_fingerprints()
+        if filled:
+            self.stdout.write(f"Impronta calcolata per {filled} domande.")
+
+        def progress(groups, removed):
+            self.stdout.write(f"{groups} gruppi, {removed} copie rimosse", ending="\r")
+            self.stdout.flush()
+
+        groups, removed = merge_duplicates(
+            batch_size=options["batch_size"], dry_run=options["dry_run"], on_page=progress
+        )
+        self.stdout.write("")
+        verb = "da rimuovere" if options["dry_run"] else "rimosse"
+        self.stdout.write(self.style.SUCCESS(f"{groups} domande con copie, {removed} copie {verb}."))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from lobby.engine import GameEngine
+from lobby.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Ricostruisce una partita dal log degli eventi (ultimo checkpoint più la coda) e ne stampa "
+        "eventi e stato; con --check confronta il risultato con le tabelle relazionali."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("code", help="Codice della stanza.")
+        parser.add_argument("--at", type=int, help="Versione da ricostruire (default: l'ultima salvata).")
+        parser.add_argument("--check", action="store_true", help="Confronta il replay con Game, GameTurn e GamePlayer.")
+
+    def handle(self, *args, **options):
+        room = Room.objects.select_related("game").filter(code=options["code"].upper()).first()
+        game = getattr(room, "game", None) if room else None
+        if game is None:
+            raise CommandError("Partita non trovata.")
+        if options["check"] and options["at"] is not None:
+            raise CommandError("--check confronta l'ultima versione: non si combina con --at.")
+        version = game.version if options["at"] is None else options["at"]
+        for event in game.events.filter(version__lte=version).order_by("seq"):
+            self.stdout.write(f"{event.seq:>4} v{event.version:<4} {event.kind:<9} {event.data if event.seq > 1 else ''}")
+        engine = GameEngine.replay(room, game, version)
+        if engine is None:
+            raise CommandError(f"Il log non copre la versione {version}.")
+        self.stdout.write(
+            f"versione {engine.version} (seq {engine.seq}), stato {engine.state}, "
+            f"turni {len(engine.turns)}, di turno {getattr(engine.current_player, 'nickname', '-')}"
+        )
+        for seat in sorted(engine.seats.values(), key=lambda seat: -seat.score):
+            self.stdout.write(f"  {seat.nickname:<20} {seat.score:>4}")
+        if options["check"]:
+            if engine.version != game.version:
+                raise CommandError(f"Il log arriva alla versione {engine.version}, la partita è alla {game.version}.")
+            # Inizio fase e turni scaduti di fila stanno solo nel log: le tabelle non li proiettano.
+            replayed, expected = engine.compact(), GameEngine.from_rows(room, game).compact()
+            for key in ("since", "idle_turns"):
+                replayed.pop(key)
+                expected.pop(key)
+            if replayed != expected:
+                raise CommandError("Il replay non coincide con le tabelle relazionali.")
+            self.stdout.write(self.style.SUCCESS("Replay coerente con le tabelle relazionali."))
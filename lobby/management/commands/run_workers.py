@@ -0,0 +1,160 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lobby.affinity import AffinityProxy
+
+
+class Command(BaseCommand):
+    help = (
+        "Avvia più worker daphne dietro un proxy che manda ogni stanza sempre allo stesso worker "
+        "(hash consistente del codice stanza), e se serve il broker dei gruppi. "
+        "SIGTTIN aggiunge un worker, SIGTTOU ne toglie uno. Con più di un worker va impostato "
+        "QUIZZZONE_CHANNEL_BROKER."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processi daphne.")
+        parser.add_argument("--bind", default="0.0.0.0", help="Indirizzo di ascolto.")
+        parser.add_argument("--port", type=int, default=8000, help="Porta di ascolto.")
+        parser.add_argument("--no-broker", action="store_true", help="Il broker è avviato a parte.")
+        parser.add_argument(
+            "--shared-socket",
+            action="store_true",
+            help="Senza proxy: i worker condividono il socket in ascolto e le stanze si spargono tra i processi.",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] > 1 and not settings.CHANNEL_BROKER_SOCKET:
+            raise CommandError(
+                "Con più worker serve QUIZZZONE_CHANNEL_BROKER: altrimenti i broadcast restano nel processo."
+            )
+        if options["workers"] > 1 and options["shared_socket"] and settings.GAME_WRITE_BEHIND:
+            raise CommandError(
+                "Con --shared-socket una stanza può finire su più processi: serve QUIZZZONE_GAME_WRITE_BEHIND=0."
+            )
+        module, attribute = settings.ASGI_APPLICATION.rsplit(".", 1)
+        self.application = f"{module}:{attribute}"
+        self.broker = None
+        if settings.CHANNEL_BROKER_SOCKET and not options["no_broker"]:
+            self.broker = subprocess.Popen([sys.executable, "manage.py", "channel_broker"])
+            # I worker si ricollegano comunque da soli; si evita solo un secondo senza broadcast all'avvio.
+            self.wait_for(settings.CHANNEL_BROKER_SOCKET)
+        try:
+            if options["shared_socket"]:
+                self.run_shared(options)
+            else:
+                with tempfile.TemporaryDirectory(prefix="quizzzone-workers-") as directory:
+                    asyncio.run(self.run_proxied(options, directory))
+        finally:
+            if self.broker is not None:
+                self.broker.terminate()
+                self.broker.wait()
+
+    def wait_for(self, path, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(path) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return os.path.exists(path)
+
+    def run_shared(self, options):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options["bind"], options["port"]))
+        listener.listen(1024)
+        fd = listener.fileno()
+        os.set_inheritable(fd, True)
+        processes = [
+            subprocess.Popen([sys.executable, "-m", "daphne", "--fd", str(fd), self.application], pass_fds=[fd])
+            for _ in range(options["workers"])
+        ]
+        self.stdout.write(f"{options['workers']} worker su {options['bind']}:{options['port']} (socket condiviso)")
+
+        def stop(*_):
+            for process in processes:
+                process.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            # Se un processo termina si fermano tutti: il supervisore esterno (Docker, systemd) riavvia.
+            while all(process.poll() is None for process in processes):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop()
+            for process in processes:
+                process.wait()
+            listener.close()
+
+    async def run_proxied(self, options, directory):
+        proxy = AffinityProxy()
+        workers = {}  # nodo -> processo daphne
+        names = iter(range(sys.maxsize))
+
+        def spawn(node):
+            path = os.path.join(directory, f"{node}.sock")
+            if os.path.exists(path):
+                os.unlink(path)
+            workers[node] = subprocess.Popen(
+                [sys.executable, "-m", "daphne", "-u", path, "--proxy-headers", self.application]
+            )
+            return path
+
+        async def start(node):
+            path = spawn(node)
+            if await asyncio.to_thread(self.wait_for, path):
+                proxy.add(node, path)
+
+        async def grow():
+            await start(f"worker-{next(names)}")
+            self.stdout.write(f"{len(workers)} worker")
+
+        async def shrink():
+            if len(workers) <= 1:
+                return
+            node = sorted(workers)[-1]
+            # Prima fuori dall'anello: le sue stanze passano agli altri, i client si ricollegano lì.
+            proxy.remove(node)
+            process = workers.pop(node)
+            process.terminate()
+            await asyncio.to_thread(process.wait)
+            self.stdout.write(f"{len(workers)} worker")
+
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        loop.add_signal_handler(signal.SIGTTIN, lambda: asyncio.ensure_future(grow()))
+        loop.add_signal_handler(signal.SIGTTOU, lambda: asyncio.ensure_future(shrink()))
+
+        await asyncio.gather(*(start(f"worker-{next(names)}") for _ in range(options["workers"])))
+        server = await proxy.serve(options["bind"], options["port"])
+        self.stdout.write(f"{len(workers)} worker dietro {options['bind']}:{options['port']}")
+        try:
+            async with server:
+                while not stop.is_set():
+                    for node, process in list(workers.items()):
+                        if process.poll() is not None:
+                            # Worker caduto: le stanze passano agli altri finché il nuovo processo non è pronto.
+                            proxy.remove(node)
+                            await start(node)
+                    try:
+                        await asyncio.wait_for(stop.wait(), 0.5)
+                    except asyncio.TimeoutError:
+                        pass
+                server.close()
+                await proxy.close()
+        finally:
+            for process in workers.values():
+                process.terminate()
+            for process in workers.values():
+                await asyncio.to_thread(process.wait)
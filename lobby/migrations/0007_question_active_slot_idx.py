@@ -0,0 +1,17 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobby', '0006_room_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['category', 'difficulty', 'id'], name='question_active_slot_idx'),
+        ),
+    ]
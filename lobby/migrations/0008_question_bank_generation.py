@@ -0,0 +1,20 @@
+# Generated by Django 5.0.14 on 2026-10-17 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobby', '0007_question_active_slot_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuestionBankGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
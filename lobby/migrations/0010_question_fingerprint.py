@@ -0,0 +1,44 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:03
+
+import hashlib
+import re
+import unicodedata
+
+from django.db import migrations, models
+
+# Copia congelata di ``normalise_text`` e ``question_fingerprint`` a questa migrazione:
+# se l'impronta cambierà, servirà una nuova migrazione che la ricalcoli.
+FINGERPRINT_FIELDS = ("category", "difficulty", "text", "option_a", "option_b", "option_c")
+
+
+def normalise_text(value):
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", value or "")).strip().casefold()
+
+
+def question_fingerprint(category, difficulty, text, option_a, option_b, option_c):
+    parts = [normalise_text(category), str(difficulty)] + [normalise_text(v) for v in (text, option_a, option_b, option_c)]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+def fill_fingerprints(apps, schema_editor):
+    Question = apps.get_model("lobby", "Question")
+    while batch := list(Question.objects.filter(fingerprint="").order_by("id").only("id", *FINGERPRINT_FIELDS)[:2000]):
+        for question in batch:
+            question.fingerprint = question_fingerprint(*(getattr(question, field) for field in FINGERPRINT_FIELDS))
+        Question.objects.bulk_update(batch, ["fingerprint"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobby', '0009_question_import_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
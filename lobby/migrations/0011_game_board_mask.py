@@ -0,0 +1,45 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:07
+
+from django.db import migrations, models
+
+
+# Copia congelata di ``Game.slot_bit`` a questa migrazione: materie nell'ordine del tabellone, 5 livelli.
+BOARD_CATEGORIES = ["storia", "scienza", "cultura", "sport", "geografia"]
+BOARD_LEVELS = 5
+
+
+def slot_bit(category, level):
+    return 1 << (BOARD_CATEGORIES.index(category) * BOARD_LEVELS + level - 1)
+
+
+def fill_board(apps, schema_editor):
+    Game = apps.get_model("lobby", "Game")
+    GameTurn = apps.get_model("lobby", "GameTurn")
+    boards = {}
+    turns = GameTurn.objects.order_by().values_list("game_id", "question__category", "question__difficulty")
+    for game_id, category, difficulty in turns.iterator(chunk_size=2000):
+        mask, played = boards.get(game_id, (0, 0))
+        boards[game_id] = (mask | slot_bit(category, difficulty), played + 1)
+    games = [Game(pk=pk, asked_mask=mask, turns_played=played) for pk, (mask, played) in boards.items()]
+    Game.objects.bulk_update(games, ["asked_mask", "turns_played"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobby', '0010_question_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='asked_mask',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='turns_played',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_board, migrations.RunPython.noop),
+    ]
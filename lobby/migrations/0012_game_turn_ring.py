@@ -0,0 +1,44 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:10
+
+from django.db import migrations, models
+
+
+def fill_turn_ring(apps, schema_editor):
+    Game = apps.get_model("lobby", "Game")
+    GamePlayer = apps.get_model("lobby", "GamePlayer")
+    rings = {}
+    for game_id, player_id in GamePlayer.objects.order_by("game_id", "order").values_list("game_id", "player_id"):
+        rings.setdefault(game_id, []).append(player_id)
+    games = []
+    for game in Game.objects.filter(pk__in=rings).only("id", "current_player_id"):
+        game.turn_order = rings[game.pk]
+        if game.current_player_id in game.turn_order:
+            game.turn_cursor = game.turn_order.index(game.current_player_id)
+        games.append(game)
+    Game.objects.bulk_update(games, ["turn_order", "turn_cursor"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobby', '0011_game_board_mask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='rotation_mode',
+            field=models.CharField(choices=[('every_turn', 'Il turno passa dopo ogni risposta'), ('on_wrong', 'Il turno passa solo dopo una risposta sbagliata')], default='every_turn', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='turn_cursor',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='turn_order',
+            field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(fill_turn_ring, migrations.RunPython.noop),
+    ]
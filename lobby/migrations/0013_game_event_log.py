@@ -0,0 +1,49 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobby', '0012_game_turn_ring'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('state', models.JSONField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='lobby.game')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GameEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('version', models.PositiveIntegerField()),
+                ('kind', models.CharField(choices=[('started', 'Partita iniziata'), ('chosen', 'Domanda scelta'), ('answered', 'Risposta data'), ('rotated', 'Cambio turno'), ('finished', 'Partita finita')], max_length=20)),
+                ('data', models.JSONField(default=dict)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='lobby.game')),
+            ],
+            options={
+                'ordering': ['game', 'seq'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='gamecheckpoint',
+            constraint=models.UniqueConstraint(fields=('game', 'seq'), name='unique_checkpoint_seq_per_game'),
+        ),
+        migrations.AddConstraint(
+            model_name='gameevent',
+            constraint=models.UniqueConstraint(fields=('game', 'seq'), name='unique_event_seq_per_game'),
+        ),
+    ]
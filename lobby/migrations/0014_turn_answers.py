@@ -0,0 +1,40 @@
+# Generated by Django 5.0.14 on 2026-10-17 03:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lobby', '0013_game_event_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='answer_mode',
+            field=models.CharField(choices=[('single', 'Risponde solo il giocatore di turno'), ('all', 'Rispondono tutti insieme: punti a chi indovina, di più ai più veloci')], default='single', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='TurnAnswer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('turn', models.PositiveIntegerField()),
+                ('option', models.CharField(choices=[('A', 'Opzione A'), ('B', 'Opzione B'), ('C', 'Opzione C')], max_length=1)),
+                ('received_at', models.DateTimeField()),
+                ('was_correct', models.BooleanField(blank=True, null=True)),
+                ('points', models.IntegerField(default=0)),
+                ('rank', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='answers', to='lobby.game')),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='turn_answers', to='lobby.player')),
+            ],
+            options={
+                'ordering': ['game', 'turn', 'received_at'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='turnanswer',
+            constraint=models.UniqueConstraint(fields=('game', 'turn', 'player'), name='unique_answer_per_turn'),
+        ),
+    ]
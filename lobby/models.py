@@ -1,3 +1,7 @@
+import hashlib
+import re
+import unicodedata
+
 from django.db import models
 from django.utils import timezone
 from django.utils.crypto import get_random_string
@@ -14,10 +18,17 @@ class Room(models.Model):
     created_at = models.DateTimeField(default=timezone.now)
     started = models.BooleanField(default=False)
     started_at = models.DateTimeField(null=True, blank=True)
+    # Incrementata a ogni ingresso/uscita/avvio: chiave per gli snapshot della lobby in cache.
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return f"Stanza {self.code}"
 
+    def bump_version(self):
+        """Segnala una modifica della lobby e riallinea la versione dell'istanza."""
+        Room.objects.filter(pk=self.pk).update(version=models.F("version") + 1)
+        self.refresh_from_db(fields=["version"])
+
 
 class Player(models.Model):
     room = models.ForeignKey(Room, related_name="players", on_delete=models.CASCADE)
@@ -37,6 +48,20 @@ class Player(models.Model):
         return f"{self.nickname} ({self.room.code})"
 
 
+def normalise_text(value):
+    """Forma canonica per il confronto: Unicode NFKC, minuscole, spazi compattati."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", value or "")).strip().casefold()
+
+
+def question_fingerprint(category, difficulty, text, option_a, option_b, option_c):
+    """Impronta del contenuto di una domanda: uguale per due righe che differiscono solo per maiuscole o spazi."""
+    parts = [normalise_text(category), str(difficulty)] + [normalise_text(v) for v in (text, option_a, option_b, option_c)]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+FINGERPRINT_FIELDS = ("category", "difficulty", "text", "option_a", "option_b", "option_c")
+
+
 class Question(models.Model):
     CATEGORY_STORIA = "storia"
     CATEGORY_SCIENZA = "scienza"
@@ -72,9 +97,20 @@ class Question(models.Model):
     correct_option = models.CharField(max_length=1, choices=OPTION_CHOICES)
     is_active = models.BooleanField(default=True, help_text="Disattiva per escludere la domanda dai quiz.")
     created_at = models.DateTimeField(default=timezone.now)
+    # Impronta di materia, livello, testo e opzioni: chiave dell'upsert in import e della deduplica.
+    # Non univoca a livello DB finché le copie già presenti non sono state unite (dedupe_questions).
+    fingerprint = models.CharField(max_length=64, blank=True, default="", db_index=True, editable=False)
 
     class Meta:
         ordering = ["category", "difficulty", "created_at"]
+        indexes = [
+            # Estrazione per intervallo di id (lobby.sampling): una ricerca nell'indice per casella.
+            models.Index(
+                fields=["category", "difficulty", "id"],
+                condition=models.Q(is_active=True),
+                name="question_active_slot_idx",
+            ),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=models.Q(difficulty__gte=1, difficulty__lte=5),
@@ -85,6 +121,18 @@ class Question(models.Model):
     def __str__(self):
         return f"[{self.get_category_display()} {self.difficulty}] {self.text[:50]}"
 
+    def compute_fingerprint(self):
+        return question_fingerprint(
+            self.category, self.difficulty, self.text, self.option_a, self.option_b, self.option_c
+        )
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = self.compute_fingerprint()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and set(update_fields) & set(FINGERPRINT_FIELDS):
+            kwargs["update_fields"] = {*update_fields, "fingerprint"}
+        super().save(*args, **kwargs)
+
     @property
     def points(self):
         return self.difficulty
@@ -97,6 +145,69 @@ class Question(models.Model):
         }
 
 
+class QuestionBankGeneration(models.Model):
+    """Contatore condiviso tra processi: cambia a ogni modifica del banco domande (una sola riga, pk=1)."""
+
+    generation = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Generazione {self.generation}"
+
+
+class QuestionImportJob(models.Model):
+    """Import CSV eseguito in background (lobby.jobs); l'avanzamento arriva in admin via Channels."""
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "In coda"),
+        (STATUS_RUNNING, "In corso"),
+        (STATUS_DONE, "Completato"),
+        (STATUS_FAILED, "Fallito"),
+    ]
+
+    filename = models.CharField(max_length=255)
+    # File temporaneo con l'upload, rimosso a fine import.
+    path = models.CharField(max_length=500, editable=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    size = models.PositiveBigIntegerField(default=0)
+    bytes_read = models.PositiveBigIntegerField(default=0)
+    rows = models.PositiveIntegerField(default=0)
+    imported = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"Import {self.filename} ({self.get_status_display()})"
+
+    @property
+    def percent(self):
+        if self.status == self.STATUS_DONE:
+            return 100
+        return min(99, int(self.bytes_read * 100 / self.size)) if self.size else 0
+
+    def as_dict(self):
+        return {
+            "id": self.pk,
+            "filename": self.filename,
+            "status": self.status,
+            "status_label": self.get_status_display(),
+            "percent": self.percent,
+            "rows": self.rows,
+            "imported": self.imported,
+            "error_count": self.error_count,
+            "errors": self.errors,
+        }
+
+
 class Game(models.Model):
     STATE_CHOOSING = "choosing"
     STATE_ANSWERING = "answering"
@@ -106,6 +217,18 @@ class Game(models.Model):
         (STATE_ANSWERING, _("Domanda attiva")),
         (STATE_FINISHED, _("Finita")),
     ]
+    ROTATION_EVERY_TURN = "every_turn"
+    ROTATION_ON_WRONG = "on_wrong"
+    ROTATION_CHOICES = [
+        (ROTATION_EVERY_TURN, _("Il turno passa dopo ogni risposta")),
+        (ROTATION_ON_WRONG, _("Il turno passa solo dopo una risposta sbagliata")),
+    ]
+    ANSWER_SINGLE = "single"
+    ANSWER_ALL = "all"
+    ANSWER_CHOICES = [
+        (ANSWER_SINGLE, _("Risponde solo il giocatore di turno")),
+        (ANSWER_ALL, _("Rispondono tutti insieme: punti a chi indovina, di più ai più veloci")),
+    ]
 
     room = models.OneToOneField(Room, related_name="game", on_delete=models.CASCADE)
     current_player = models.ForeignKey(
@@ -117,25 +240,29 @@ class Game(models.Model):
     state = models.CharField(max_length=20, choices=STATE_CHOICES, default=STATE_CHOOSING)
     started_at = models.DateTimeField(default=timezone.now)
     finished_at = models.DateTimeField(null=True, blank=True)
+    # Incrementata a ogni scrittura sullo stato: chiave per gli snapshot in cache.
+    version = models.PositiveIntegerField(default=0)
+    # Tabellone 5x5 denormalizzato: un bit per casella (materia, livello) già uscita e il numero
+    # di turni giocati. Aggiornati dal motore di gioco alla scelta, letti senza join.
+    asked_mask = models.PositiveIntegerField(default=0)
+    turns_played = models.PositiveSmallIntegerField(default=0)
+    # Anello dei turni: id dei giocatori in ordine di gioco e posizione di chi è di turno.
+    # La rotazione è un calcolo sull'anello più l'aggiornamento di due campi, senza leggere i giocatori.
+    turn_order = models.JSONField(default=list)
+    turn_cursor = models.PositiveSmallIntegerField(default=0)
+    rotation_mode = models.CharField(max_length=20, choices=ROTATION_CHOICES, default=ROTATION_EVERY_TURN)
+    answer_mode = models.CharField(max_length=20, choices=ANSWER_CHOICES, default=ANSWER_SINGLE)
+
+    BOARD_CATEGORIES = [key for key, _ in Question.CATEGORY_CHOICES]
+    BOARD_LEVELS = [level for level, _ in Question.LEVEL_CHOICES]
+    BOARD_SIZE = len(BOARD_CATEGORIES) * len(BOARD_LEVELS)
 
     def __str__(self):
         return f"Partita {self.room.code}"
 
-    def rotate_to_next_player(self, only_on_wrong=False, was_correct=None):
-        """Passa al giocatore successivo mantenendo l'ordine di ingresso."""
-        if self.current_player is None:
-            return None
-        if only_on_wrong and was_correct:
-            return self.current_player
-        players = list(self.players.order_by("order"))
-        if not players:
-            return None
-        current_idx = next((idx for idx, gp in enumerate(players) if gp.player_id == self.current_player_id), 0)
-        next_idx = (current_idx + 1) % len(players)
-        next_player = players[next_idx].player
-        self.current_player = next_player
-        self.save(update_fields=["current_player"])
-        return next_player
+    @classmethod
+    def slot_bit(cls, category, level):
+        return 1 << (cls.BOARD_CATEGORIES.index(category) * len(cls.BOARD_LEVELS) + level - 1)
 
     @property
     def is_over(self):
@@ -185,3 +312,84 @@ class GameTurn(models.Model):
 
     def __str__(self):
         return f"Turno {self.id} ({self.game.room.code})"
+
+
+class TurnAnswer(models.Model):
+    """Risposta di un giocatore nella modalità a risposta simultanea: una riga per (turno, giocatore).
+
+    ``turn`` è il numero del turno nella partita (come gli id dei turni nello stato). ``received_at``
+    è l'istante di arrivo sul server; esito, punti e ``rank`` (ordine tra le risposte corrette) si
+    scrivono tutti insieme alla chiusura del turno.
+    """
+
+    game = models.ForeignKey(Game, related_name="answers", on_delete=models.CASCADE)
+    turn = models.PositiveIntegerField()
+    player = models.ForeignKey(Player, related_name="turn_answers", on_delete=models.CASCADE)
+    option = models.CharField(max_length=1, choices=Question.OPTION_CHOICES)
+    received_at = models.DateTimeField()
+    was_correct = models.BooleanField(null=True, blank=True)
+    points = models.IntegerField(default=0)
+    rank = models.PositiveSmallIntegerField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["game", "turn", "player"], name="unique_answer_per_turn"),
+        ]
+        ordering = ["game", "turn", "received_at"]
+
+    def __str__(self):
+        return f"Risposta {self.option} turno {self.turn} ({self.game_id})"
+
+
+class GameEvent(models.Model):
+    """Log della partita in sola aggiunta: ``seq`` progressivo, ``version`` quella della partita dopo l'evento.
+
+    Un'azione di gioco produce uno o più eventi con la stessa versione (risposta, poi cambio turno o fine).
+    """
+
+    KIND_STARTED = "started"
+    KIND_CHOSEN = "chosen"
+    KIND_ANSWERED = "answered"
+    KIND_ROTATED = "rotated"
+    KIND_FINISHED = "finished"
+    KIND_CHOICES = [
+        (KIND_STARTED, _("Partita iniziata")),
+        (KIND_CHOSEN, _("Domanda scelta")),
+        (KIND_ANSWERED, _("Risposta data")),
+        (KIND_ROTATED, _("Cambio turno")),
+        (KIND_FINISHED, _("Partita finita")),
+    ]
+
+    game = models.ForeignKey(Game, related_name="events", on_delete=models.CASCADE)
+    seq = models.PositiveIntegerField()
+    version = models.PositiveIntegerField()
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    data = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["game", "seq"], name="unique_event_seq_per_game"),
+        ]
+        ordering = ["game", "seq"]
+
+    def __str__(self):
+        return f"{self.seq} {self.kind} ({self.game.room.code})"
+
+
+class GameCheckpoint(models.Model):
+    """Stato compatto della partita dopo l'evento ``seq``: con la coda del log ricostruisce qualsiasi versione successiva."""
+
+    game = models.ForeignKey(Game, related_name="checkpoints", on_delete=models.CASCADE)
+    seq = models.PositiveIntegerField()
+    version = models.PositiveIntegerField()
+    state = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["game", "seq"], name="unique_checkpoint_seq_per_game"),
+        ]
+
+    def __str__(self):
+        return f"Checkpoint {self.seq} ({self.game.room.code})"
@@ -0,0 +1,33 @@
+"""Patch compatti tra due versioni dello stato di gioco.
+
+Un patch è una lista di operazioni ``["set", path, value]`` o ``["del", path]``
+dove ``path`` è la lista delle chiavi (sempre stringhe, come arrivano al client
+dopo la serializzazione JSON). Le liste sono trattate come valori atomici: la
+classifica cambia ordine a ogni punto, diffarla elemento per elemento non conviene.
+"""
+
+
+def diff_state(old, new, path=()):
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key, value in new.items():
+            child_path = (*path, str(key))
+            if key in old:
+                ops.extend(diff_state(old[key], value, child_path))
+            else:
+                ops.append(["set", list(child_path), value])
+        for key in old:
+            if key not in new:
+                ops.append(["del", [*path, str(key)]])
+        return ops
+    return [["set", list(path), new]]
+
+
+def game_patch(old, new):
+    """Messaggio game_patch da ``old`` a ``new``, None se non cambia nulla."""
+    ops = diff_state(old, new)
+    if not ops:
+        return None
+    return {"type": "game_patch", "base": old["version"], "version": new["version"], "ops": ops}
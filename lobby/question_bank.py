@@ -0,0 +1,234 @@
+"""Indice in memoria del banco domande, per processo.
+
+Due strutture:
+
+- l'indice degli id attivi per casella (materia, livello), in array ordinati:
+  l'estrazione delle domande di una partita non passa più dal DB;
+- i record delle domande (testo, opzioni, risposta corretta) in una LRU
+  riempita a richiesta, un'unica query per tutti gli id mancanti.
+
+Le modifiche fatte in questo processo (admin, import CSV) aggiornano le strutture
+subito tramite i segnali di ``Question``; gli altri processi se ne accorgono dal
+contatore ``QuestionBankGeneration``, riletto al più ogni
+``QUESTION_BANK_CHECK_INTERVAL`` secondi, e ricaricano l'indice.
+"""
+
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import Question, QuestionBankGeneration
+
+CATEGORY_LABELS = dict(Question.CATEGORY_CHOICES)
+RECORD_FIELDS = ("id", "category", "difficulty", "text", "option_a", "option_b", "option_c", "correct_option")
+
+
+class QuestionRecord(NamedTuple):
+    """Copia immutabile dei campi di ``Question`` usati durante la partita, con la stessa interfaccia."""
+
+    id: int
+    category: str
+    difficulty: int
+    text: str
+    option_a: str
+    option_b: str
+    option_c: str
+    correct_option: str
+
+    @property
+    def points(self):
+        return self.difficulty
+
+    def get_category_display(self):
+        return CATEGORY_LABELS.get(self.category, self.category)
+
+    def get_options(self):
+        return {
+            Question.OPTION_A: self.option_a,
+            Question.OPTION_B: self.option_b,
+            Question.OPTION_C: self.option_c,
+        }
+
+
+class QuestionBank:
+    def __init__(self, enabled=True, max_records=20000, check_interval=5.0):
+        self.enabled = enabled
+        self.max_records = max_records
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._index = None
+        self._records = OrderedDict()
+        self._generation = None
+        self._checked_at = 0.0
+        self._bulk = threading.local()
+
+    # --- indice degli id attivi ---
+
+    def sample(self, slots):
+        """Un id attivo a caso per casella, {casella: id o None}; senza DB quando l'indice è carico."""
+        index = self.index()
+        return {slot: random.choice(index[slot]) if index.get(slot) else None for slot in slots}
+
+    def index(self):
+        self.check_generation()
+        with self._lock:
+            if self._index is None:
+                self._index = self.load_index()
+            return self._index
+
+    def load_index(self):
+        index = {}
+        rows = Question.objects.filter(is_active=True).order_by("id").values_list("id", "category", "difficulty")
+        for qid, category, difficulty in rows.iterator(chunk_size=10000):
+            index.setdefault((category, difficulty), array("q")).append(qid)
+        return index
+
+    # --- record delle domande ---
+
+    def record(self, question_id):
+        return self.records([question_id]).get(question_id)
+
+    def records(self, question_ids):
+        """{id: QuestionRecord} per gli id richiesti; gli id non in cache si leggono con una sola query."""
+        if not self.enabled:
+            return self.fetch_records(question_ids)
+        self.check_generation()
+        found = {}
+        with self._lock:
+            for qid in question_ids:
+                record = self._records.get(qid)
+                if record is not None:
+                    self._records.move_to_end(qid)
+                    found[qid] = record
+        missing = [qid for qid in question_ids if qid not in found]
+        if missing:
+            fetched = self.fetch_records(missing)
+            with self._lock:
+                for qid, record in fetched.items():
+                    self.remember(record)
+            found.update(fetched)
+        return found
+
+    def fetch_records(self, question_ids):
+        rows = Question.objects.filter(id__in=set(question_ids)).values_list(*RECORD_FIELDS)
+        return {row[0]: QuestionRecord(*row) for row in rows}
+
+    def remember(self, record):
+        self._records[record.id] = record
+        self._records.move_to_end(record.id)
+        while len(self._records) > self.max_records:
+            self._records.popitem(last=False)
+
+    # --- invalidazione ---
+
+    def question_saved(self, question):
+        with self._lock:
+            if self._index is not None:
+                self.discard_id(question.id)
+                if question.is_active:
+                    insort(self._index.setdefault((question.category, question.difficulty), array("q")), question.id)
+            if question.id in self._records:
+                self.remember(QuestionRecord(*(getattr(question, field) for field in RECORD_FIELDS)))
+
+    def question_deleted(self, question):
+        with self._lock:
+            if self._index is not None:
+                self.discard_id(question.id)
+            self._records.pop(question.id, None)
+
+    def discard_id(self, question_id):
+        # La casella potrebbe essere cambiata con il salvataggio: si cerca l'id in tutte (25 ricerche binarie).
+        for ids in self._index.values():
+            pos = bisect_left(ids, question_id)
+            if pos < len(ids) and ids[pos] == question_id:
+                del ids[pos]
+                return
+
+    def reload(self):
+        with self._lock:
+            self._index = None
+            self._records.clear()
+            self._generation = None
+            self._checked_at = 0.0
+
+    def check_generation(self):
+        """Ricarica tutto se un altro processo ha modificato il banco; al più una query ogni check_interval."""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        generation = current_generation()
+        with self._lock:
+            self._checked_at = now
+            if self._generation is not None and generation != self._generation:
+                self._index = None
+                self._records.clear()
+            self._generation = generation
+
+    def bump_generation(self):
+        """Segnala la modifica agli altri processi; questo processo ha già applicato la modifica."""
+        generation = bump_generation()
+        with self._lock:
+            if self._generation is not None and generation == self._generation + 1:
+                self._generation = generation
+            else:
+                # Modifiche di altri processi nel frattempo: al prossimo accesso si ricarica.
+                self._checked_at = 0.0
+
+    @contextmanager
+    def bulk_changes(self):
+        """Sospende gli aggiornamenti riga per riga (import CSV): una sola ricarica alla fine."""
+        self._bulk.active = True
+        try:
+            yield
+        finally:
+            self._bulk.active = False
+            self.reload()
+            bump_generation()
+
+    def handle_save(self, sender, instance, **kwargs):
+        if getattr(self._bulk, "active", False):
+            return
+        # Si applica solo a transazione confermata: un salvataggio annullato non deve restare nell'indice.
+        question = copy(instance)
+        transaction.on_commit(lambda: self.changed(self.question_saved, question))
+
+    def handle_delete(self, sender, instance, **kwargs):
+        if getattr(self._bulk, "active", False):
+            return
+        question = copy(instance)
+        transaction.on_commit(lambda: self.changed(self.question_deleted, question))
+
+    def changed(self, apply, question):
+        apply(question)
+        self.bump_generation()
+
+
+def current_generation():
+    return QuestionBankGeneration.objects.filter(pk=1).values_list("generation", flat=True).first() or 0
+
+
+def bump_generation():
+    if not QuestionBankGeneration.objects.filter(pk=1).update(generation=models.F("generation") + 1):
+        QuestionBankGeneration.objects.get_or_create(pk=1)
+        QuestionBankGeneration.objects.filter(pk=1).update(generation=models.F("generation") + 1)
+    return current_generation()
+
+
+question_bank = QuestionBank(
+    enabled=getattr(settings, "QUESTION_BANK_ENABLED", True),
+    max_records=getattr(settings, "QUESTION_BANK_RECORDS", 20000),
+    check_interval=getattr(settings, "QUESTION_BANK_CHECK_INTERVAL", 5.0),
+)
+
+post_save.connect(question_bank.handle_save, sender=Question, dispatch_uid="question_bank_save")
+post_delete.connect(question_bank.handle_delete, sender=Question, dispatch_uid="question_bank_delete")
@@ -5,4 +5,5 @@ from . import ws_consumers
 websocket_urlpatterns = [
     path("ws/stanza/<str:code>/", ws_consumers.RoomConsumer.as_asgi()),
     path("ws/stanza/<str:code>/gioco/", ws_consumers.GameConsumer.as_asgi()),
+    path("ws/admin/import/", ws_consumers.QuestionImportConsumer.as_asgi()),
 ]
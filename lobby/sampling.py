@@ -0,0 +1,120 @@
+"""Estrazione casuale delle domande di una partita senza ``ORDER BY random()``.
+
+Per ogni casella (materia, livello) si tiene l'intervallo di id delle domande
+attive; l'estrazione sceglie un id a caso nell'intervallo e prende la prima
+domanda attiva con id >= di quello. Con l'indice parziale su
+(category, difficulty, id) è una ricerca nell'indice per casella, e le 25
+caselle viaggiano in un'unica query fatta di sottoquery scalari.
+
+I buchi negli id (domande cancellate o disattivate) rendono la distribuzione
+non perfettamente uniforme: la domanda subito dopo un buco ha più probabilità.
+Per un quiz va bene; in cambio l'avvio non dipende più dalla dimensione del banco.
+"""
+
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Question
+from .question_bank import question_bank
+
+
+class SlotRanges:
+    """Intervalli di id per casella, ricalcolati al più ogni ``ttl`` secondi.
+
+    Un intervallo vecchio non produce estrazioni sbagliate: le domande nuove
+    restano escluse fino al ricalcolo, e una casella che non trova nulla forza
+    subito un ricalcolo (vedi ``sample_board``).
+    """
+
+    def __init__(self, slots, ttl=60):
+        self.slots = list(slots)
+        self.ttl = ttl
+        self._ranges = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._ranges is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return self._ranges
+        ranges = load_ranges(self.slots)
+        with self._lock:
+            self._ranges, self._loaded_at = ranges, time.monotonic()
+        return ranges
+
+    def invalidate(self):
+        with self._lock:
+            self._ranges = None
+
+
+BOARD_SLOTS = [(category, level) for category, _ in Question.CATEGORY_CHOICES for level in range(1, 6)]
+
+slot_ranges = SlotRanges(BOARD_SLOTS, ttl=getattr(settings, "QUESTION_SAMPLING_TTL", 60))
+
+
+def slot_subquery(condition="", order="id"):
+    table = connection.ops.quote_name(Question._meta.db_table)
+    return (
+        f"(SELECT id FROM {table} WHERE is_active = %s AND category = %s AND difficulty = %s{condition} "
+        f"ORDER BY {order} LIMIT 1)"
+    )
+
+
+def fetch_row(subqueries, params):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT " + ", ".join(subqueries), params)
+        return cursor.fetchone()
+
+
+def load_ranges(slots):
+    """Primo e ultimo id attivo di ogni casella: due ricerche nell'indice per casella, una sola query.
+
+    Un GROUP BY con MIN/MAX leggerebbe invece tutta la tabella.
+    """
+    params = []
+    for category, level in slots:
+        params.extend([True, category, level, True, category, level])
+    row = fetch_row([slot_subquery(), slot_subquery(order="id DESC")] * len(slots), params)
+    return {
+        slot: (low, high) for slot, low, high in zip(slots, row[0::2], row[1::2]) if low is not None
+    }
+
+
+def pick_ids(slots, ranges):
+    """Un id per casella in una sola query; None dove la casella non ha domande nell'intervallo."""
+    slots = [slot for slot in slots if slot in ranges]
+    if not slots:
+        return {}
+    params = []
+    for category, level in slots:
+        low, high = ranges[(category, level)]
+        params.extend([True, category, level, random.randint(low, high)])
+    return dict(zip(slots, fetch_row([slot_subquery(" AND id >= %s")] * len(slots), params)))
+
+
+def sample_by_id_range(slots):
+    """Sceglie una domanda attiva per ogni casella con l'estrazione per intervallo; {casella: id o None}."""
+    chosen = pick_ids(slots, slot_ranges.get())
+    missing = [slot for slot in slots if chosen.get(slot) is None]
+    if missing:
+        # Intervallo superato (domande disattivate in coda) o casella appena popolata: si ricalcola una volta.
+        slot_ranges.invalidate()
+        chosen.update(pick_ids(missing, slot_ranges.get()))
+    return {slot: chosen.get(slot) for slot in slots}
+
+
+def sample_board(slots):
+    """Una domanda attiva per casella: dall'indice in memoria se attivo, altrimenti per intervallo di id."""
+    if not question_bank.enabled:
+        return sample_by_id_range(slots)
+    chosen = question_bank.sample(slots)
+    ids = [qid for qid in chosen.values() if qid]
+    # Carica i record della partita (serviranno a ogni stato) e intercetta id cancellati da altri processi.
+    if len(question_bank.records(ids)) < len(ids):
+        question_bank.reload()
+        chosen = question_bank.sample(slots)
+    return chosen
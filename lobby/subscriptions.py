@@ -0,0 +1,41 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+
+
+class GroupSubscription:
+    """Iscrizione temporanea di una view async a un gruppo del channel layer.
+
+    Riceve gli stessi messaggi (room_update/game_update) dei consumer WebSocket,
+    così long-poll e stream HTTP non devono interrogare il DB per accorgersi dei cambi.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.channel_layer = get_channel_layer()
+        self.channel = None
+
+    async def __aenter__(self):
+        self.channel = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(self.group, self.channel)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.channel_layer.group_discard(self.group, self.channel)
+
+    async def receive_type(self, message_type, timeout):
+        """Primo messaggio del tipo indicato entro ``timeout`` secondi, None allo scadere."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (remaining := deadline - loop.time()) > 0:
+            message = await self.receive(remaining)
+            if message is None or message.get("type") == message_type:
+                return message
+        return None
+
+    async def receive(self, timeout):
+        """Prossimo messaggio del gruppo, None se entro ``timeout`` secondi non arriva nulla."""
+        try:
+            return await asyncio.wait_for(self.channel_layer.receive(self.channel), timeout)
+        except asyncio.TimeoutError:
+            return None
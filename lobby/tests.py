@@ -1,3 +1,1705 @@
-from django.test import TestCase
+import asyncio
+import copy
+import json
+import os
+import pickle
+import shutil
+import stat
+import threading
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from importlib import import_module
+from io import StringIO
+from tempfile import NamedTemporaryFile, mkdtemp
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .affinity import AffinityProxy, HashRing, RequestHead, room_code_of
+from .cache import game_snapshots, room_snapshots
+from .channel_layer import ChannelBroker, UnixSocketChannelLayer, loads_message
+from .db_executor import DatabaseExecutor, db_executor
+from .dedup import merge_duplicates
+from .engine import BUZZ_SCORING_WINDOW, GameEngine, GameEngines, StaleGame, game_engines, game_flusher, turn_deadlines
+from .importers import import_questions, upsert_chunk
+from .jobs import run_import
+from .models import Game, Player, Question, QuestionImportJob, Room, question_fingerprint
+from .patches import game_patch
+from .question_bank import bump_generation, current_generation, question_bank
+from .routing import websocket_urlpatterns
+from .sampling import BOARD_SLOTS, load_ranges, sample_board, sample_by_id_range, slot_ranges
+from .timer_wheel import TimerWheel
+from .ws_consumers import GameConsumer
+from .views import (
+    GAME_STATE_MAX_QUERIES,
+    broadcast_game_state,
+    build_game_snapshot,
+    expire_turn,
+    get_engine_snapshot,
+    get_room_snapshot,
+    perform_choose,
+    personalise_game_state,
+    replay_game_snapshot,
+)
+
+
+@override_settings(GAME_WRITE_BEHIND=False, TURN_CHOOSE_TIMEOUT=0, TURN_ANSWER_TIMEOUT=0)
+class GameTestCase(TestCase):
+    """Partite giocate con il client di test.
+
+    Il motore scrive in sincrono sul DB (niente write-behind) e il lavoro sul DB resta sul thread del
+    test, dentro la sua transazione; i turni non scadono.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # Id decrescenti rispetto all'ordine delle caselle: l'ordine di estrazione non coincide con quello degli id.
+        for category, level in reversed(BOARD_SLOTS):
+            Question.objects.create(
+                category=category,
+                difficulty=level,
+                text=f"{category} {level}",
+                option_a="a",
+                option_b="b",
+                option_c="c",
+                correct_option=Question.OPTION_A,
+            )
+
+    def setUp(self):
+        patcher = mock.patch.object(db_executor, "workers", 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Le pk si ripetono tra un test e l'altro: nessuno stato in memoria deve sopravvivere.
+        for cache in (game_engines, game_snapshots, room_snapshots):
+            cache.clear()
+        # Nessun motore in sospeso per il flush all'uscita, a DB di test già distrutto.
+        self.addCleanup(game_engines.clear)
+        question_bank.reload()
+        slot_ranges.invalidate()
+
+    def start_game(self, players=2, **options):
+        """Stanza con ``players`` giocatori e partita avviata; restituisce (codice, {nickname: client})."""
+        clients = {}
+        code = None
+        for seat, icon in enumerate(("volpe", "gatto", "cane", "gufo")[:players]):
+            client = Client()
+            if code is None:
+                code = client.get("/").url.rstrip("/").rsplit("/", 1)[-1]
+            client.post(f"/stanza/{code}/entra/", {"nickname": f"P{seat}", "icon": icon})
+            clients[f"P{seat}"] = client
+        response = clients["P0"].post(f"/stanza/{code}/start/", options)
+        self.assertEqual(response.status_code, 302)
+        return code, clients
+
+    def session_key(self, client):
+        return client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    def as_player(self, client):
+        """``AsyncClient`` con la sessione del client di test."""
+        async_client = AsyncClient()
+        async_client.cookies = client.cookies
+        return async_client
+
+    def state(self, client, code):
+        response = client.get(f"/stanza/{code}/gioco/state/")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def choose(self, clients, code):
+        """Il giocatore di turno sceglie la prima casella libera; restituisce (client, stato)."""
+        state = self.state(clients["P0"], code)
+        client = clients[state["current_player"]["nickname"]]
+        category, level = next(
+            (category, level) for category, levels in state["available"].items() for level, count in levels.items() if count
+        )
+        response = client.post(
+            f"/stanza/{code}/gioco/scegli/", {"category": category, "difficulty": level, "version": state["version"]}
+        )
+        self.assertEqual(response.status_code, 200, response.content)
+        return client, response.json()
+
+    def play_turn(self, clients, code, option=Question.OPTION_A):
+        client, state = self.choose(clients, code)
+        response = client.post(f"/stanza/{code}/gioco/rispondi/", {"option": option, "version": state["version"]})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def play_game(self, clients, code):
+        for turn in range(len(BOARD_SLOTS)):
+            state = self.play_turn(clients, code, Question.OPTION_A if turn % 3 else Question.OPTION_B)
+        self.assertTrue(state["game_over"])
+        return state
+
+
+class ReplayGameTests(GameTestCase):
+    def test_check_passes_after_a_played_game(self):
+        code, clients = self.start_game()
+        self.play_game(clients, code)
+        out = StringIO()
+        call_command("replay_game", code, "--check", stdout=out)
+        self.assertIn("Replay coerente", out.getvalue())
+
+    def test_rows_keep_the_sampling_order(self):
+        code, clients = self.start_game()
+        self.play_turn(clients, code)
+        game = Room.objects.get(code=code).game
+        started = game.events.get(seq=1).data["questions"]
+        engine = game_engines.cached(code)
+        self.assertEqual(type(engine).from_rows(engine.room, Game.objects.get(pk=game.pk)).question_ids, started)
+
+
+class SnapshotOverlayTests(GameTestCase):
+    """Uno snapshot per versione, condiviso tra le sessioni; i campi per-sessione si applicano sopra."""
+
+    def test_two_sessions_on_the_same_cached_version(self):
+        code, clients = self.start_game()
+        playing = self.state(clients["P0"], code)["current_player"]["nickname"]
+        waiting = next(nickname for nickname in clients if nickname != playing)
+        game_snapshots.clear()
+        with mock.patch("lobby.views.build_game_snapshot", wraps=build_game_snapshot) as build:
+            mine, theirs = self.state(clients[playing], code), self.state(clients[waiting], code)
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(mine["version"], theirs["version"])
+        for state, nickname in ((mine, playing), (theirs, waiting)):
+            rows = state["scoreboard"]
+            self.assertEqual([row["is_me"] for row in rows], [row["nickname"] == nickname for row in rows])
+        self.assertEqual((mine["current_player"]["is_me"], theirs["current_player"]["is_me"]), (True, False))
+        self.assertEqual(mine["actions"], {"can_choose": True, "can_answer": False})
+        self.assertEqual(theirs["actions"], {"can_choose": False, "can_answer": False})
+        # Domanda aperta: opzioni e risposta solo per chi è di turno.
+        self.choose(clients, code)
+        mine, theirs = self.state(clients[playing], code), self.state(clients[waiting], code)
+        self.assertEqual(set(mine["options"]), {Question.OPTION_A, Question.OPTION_B, Question.OPTION_C})
+        self.assertEqual(mine["actions"], {"can_choose": False, "can_answer": True})
+        self.assertIsNone(theirs["options"])
+        self.assertEqual(theirs["actions"], {"can_choose": False, "can_answer": False})
+
+    def test_overlay_leaves_the_shared_snapshot_untouched(self):
+        code, clients = self.start_game()
+        self.choose(clients, code)
+        snapshot = get_engine_snapshot(game_engines.cached(code))
+        shared = copy.deepcopy(snapshot)
+        for client in clients.values():
+            personalise_game_state(snapshot, self.session_key(client))
+        self.assertEqual(snapshot, shared)
+
+
+class GameStateQueryTests(GameTestCase):
+    """Le query per lo stato di gioco non crescono con i turni giocati (nessun N+1)."""
+
+    def cold_start(self):
+        # Processo appena riavviato: nessun motore, snapshot o record delle domande in memoria.
+        for cache in (game_engines, game_snapshots):
+            cache.clear()
+        question_bank.reload()
+
+    def test_state_with_engine_in_memory(self):
+        code, clients = self.start_game()
+        self.state(clients["P1"], code)
+        # Solo la stanza, per versione ed ETag: lo snapshot arriva dal motore.
+        with self.assertNumQueries(1):
+            self.state(clients["P1"], code)
+        self.play_game(clients, code)
+        with self.assertNumQueries(1):
+            self.state(clients["P1"], code)
+
+    def test_state_after_restart(self):
+        # Stanza più il caricamento del motore (checkpoint, coda del log, generazione e record del banco),
+        # uguale a partita appena iniziata, a un turno dalla fine e a partita finita.
+        for turns in (0, len(BOARD_SLOTS) - 1, len(BOARD_SLOTS)):
+            with self.subTest(turns=turns):
+                code, clients = self.start_game()
+                for _ in range(turns):
+                    self.play_turn(clients, code, Question.OPTION_A)
+                self.cold_start()
+                with self.assertNumQueries(GAME_STATE_MAX_QUERIES + 1):
+                    self.state(clients["P1"], code)
+
+    def test_engine_load_stays_within_the_ceiling(self):
+        for turns in (0, len(BOARD_SLOTS) - 1):
+            with self.subTest(turns=turns):
+                code, clients = self.start_game()
+                for _ in range(turns):
+                    self.play_turn(clients, code, Question.OPTION_A)
+                self.cold_start()
+                room = Room.objects.select_related("game").get(code=code)
+                with self.assertNumQueries(GAME_STATE_MAX_QUERIES):
+                    game_engines.get(room, room.game)
+
+
+class BoardMaskTests(GameTestCase):
+    """Il tabellone è una maschera di bit su ``Game``: caselle giocate e turni senza contare le righe."""
+
+    def test_mask_follows_the_turns_played(self):
+        code, clients = self.start_game()
+        chosen = []
+        for _ in range(3):
+            client, state = self.choose(clients, code)
+            chosen.append((state["question"]["category"], state["question"]["difficulty"]))
+            client.post(f"/stanza/{code}/gioco/rispondi/", {"option": Question.OPTION_A, "version": state["version"]})
+        game = Room.objects.get(code=code).game
+        self.assertEqual(game.asked_mask, sum(Game.slot_bit(category, level) for category, level in chosen))
+        self.assertEqual(game.turns_played, 3)
+        self.assertEqual(game.turns.count(), 3)
+        available = self.state(clients["P0"], code)["available"]
+        self.assertEqual(sum(count for levels in available.values() for count in levels.values()), len(BOARD_SLOTS) - 3)
+        for category, level in chosen:
+            self.assertEqual(available[category][str(level)], 0)
+
+    def test_asked_slot_cannot_be_chosen_again(self):
+        code, clients = self.start_game()
+        client, state = self.choose(clients, code)
+        question = state["question"]
+        client.post(f"/stanza/{code}/gioco/rispondi/", {"option": Question.OPTION_A, "version": state["version"]})
+        state = self.state(clients["P0"], code)
+        response = clients[state["current_player"]["nickname"]].post(
+            f"/stanza/{code}/gioco/scegli/",
+            {"category": question["category"], "difficulty": question["difficulty"], "version": state["version"]},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Room.objects.get(code=code).game.turns_played, 1)
+
+
+class RotationTests(GameTestCase):
+    """Anello dei turni su ``Game``: con ``on_wrong`` passa la mano solo chi sbaglia."""
+
+    def current(self, clients, code):
+        return self.state(clients["P0"], code)["current_player"]["nickname"]
+
+    def test_every_turn_advances_after_a_correct_answer(self):
+        code, clients = self.start_game(players=3)
+        first = self.current(clients, code)
+        self.play_turn(clients, code, Question.OPTION_A)
+        self.assertNotEqual(self.current(clients, code), first)
+
+    def test_on_wrong_keeps_the_turn_after_a_correct_answer(self):
+        code, clients = self.start_game(players=3, rotation_mode=Game.ROTATION_ON_WRONG)
+        first = self.current(clients, code)
+        cursor = Room.objects.get(code=code).game.turn_cursor
+        for _ in range(2):
+            self.play_turn(clients, code, Question.OPTION_A)
+            self.assertEqual(self.current(clients, code), first)
+        self.assertEqual(Room.objects.get(code=code).game.turn_cursor, cursor)
+
+    def test_on_wrong_advances_the_cursor_after_a_wrong_answer(self):
+        code, clients = self.start_game(players=3, rotation_mode=Game.ROTATION_ON_WRONG)
+        game = Room.objects.get(code=code).game
+        ring, cursor = game.turn_order, game.turn_cursor
+        self.play_turn(clients, code, Question.OPTION_B)
+        game = Room.objects.get(code=code).game
+        self.assertEqual(game.turn_cursor, (cursor + 1) % len(ring))
+        self.assertEqual(game.current_player_id, ring[game.turn_cursor])
+        self.assertEqual(Player.objects.get(pk=ring[game.turn_cursor]).nickname, self.current(clients, code))
+
+
+class VersionConflictTests(GameTestCase):
+    """Compare-and-swap su ``Game.version``: una scrittura basata su uno stato vecchio diventa un 409."""
+
+    def free_slot(self, state):
+        return next(
+            (category, level) for category, levels in state["available"].items() for level, count in levels.items() if count
+        )
+
+    def test_stale_version_from_the_client_is_rejected(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        self.play_turn(clients, code)
+        state_now = self.state(clients["P0"], code)
+        category, level = self.free_slot(state_now)
+        client = clients[state_now["current_player"]["nickname"]]
+        response = client.post(
+            f"/stanza/{code}/gioco/scegli/", {"category": category, "difficulty": level, "version": state["version"]}
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json(), {"error": response.json()["error"], "stale": True, "version": state_now["version"]})
+        self.assertEqual(self.state(clients["P0"], code)["version"], state_now["version"])
+
+    def test_flush_fails_when_the_saved_version_moved(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        room = Room.objects.select_related("game").get(code=code)
+        first, second = GameEngine.load(room, room.game), GameEngine.load(room, room.game)
+        category, level = self.free_slot(state)
+        for engine in (first, second):
+            engine.choose(engine.current_player.session_key, {"category": category, "difficulty": level})
+        first.flush()
+        with self.assertRaises(StaleGame) as raised:
+            second.flush()
+        self.assertEqual(raised.exception.version, first.version)
+        # Il batch in conflitto non ha scritto niente e resta in sospeso.
+        self.assertEqual(room.game.events.count(), first.seq)
+        self.assertTrue(second.dirty)
+
+    def test_write_through_conflict_discards_the_engine(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        # Motore in memoria letto prima che un altro processo salvasse la stessa scelta.
+        stale = game_engines.cached(code)
+        room = Room.objects.select_related("game").get(code=code)
+        other = GameEngine.load(room, room.game)
+        category, level = self.free_slot(state)
+        other.choose(other.current_player.session_key, {"category": category, "difficulty": level})
+        other.flush()
+        client = clients[state["current_player"]["nickname"]]
+        with mock.patch.object(GameEngines, "get", return_value=stale):
+            response = client.post(
+                f"/stanza/{code}/gioco/scegli/", {"category": category, "difficulty": level, "version": state["version"]}
+            )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["version"], other.version)
+        self.assertIsNone(game_engines.cached(code))
+        self.assertEqual(self.state(clients["P0"], code)["version"], other.version)
+
+
+class WriteBehindTests(GameTestCase):
+    def test_cached_engine_is_dropped_when_another_worker_wrote(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        stale = game_engines.cached(code)
+        # Un altro worker, a cui la stanza è passata nel frattempo, sceglie e salva.
+        room = Room.objects.select_related("game").get(code=code)
+        other = GameEngine.load(room, room.game)
+        category, level = next(
+            (category, level) for category, levels in state["available"].items() for level, count in levels.items() if count
+        )
+        other.choose(other.current_player.session_key, {"category": category, "difficulty": level})
+        other.flush()
+        client = clients[state["current_player"]["nickname"]]
+        with override_settings(GAME_WRITE_BEHIND=True), mock.patch.object(game_flusher, "schedule"):
+            response = client.post(
+                f"/stanza/{code}/gioco/scegli/", {"category": category, "difficulty": level, "version": state["version"]}
+            )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["version"], other.version)
+        self.assertIsNot(game_engines.cached(code), stale)
+
+    def test_history_includes_unsaved_events_without_flushing(self):
+        code, clients = self.start_game()
+        with override_settings(GAME_WRITE_BEHIND=True), mock.patch.object(game_flusher, "schedule"):
+            self.play_turn(clients, code)
+            self.play_turn(clients, code)
+            with mock.patch.object(GameEngine, "flush") as flush:
+                response = clients["P0"].get(f"/stanza/{code}/gioco/storia/")
+        flush.assert_not_called()
+        game = Room.objects.get(code=code).game
+        self.assertEqual(game.events.count(), 1)
+        events = response.json()["events"]
+        self.assertEqual([event["seq"] for event in events], list(range(1, len(events) + 1)))
+        self.assertEqual([event["kind"] for event in events[1:3]], ["chosen", "answered"])
+        self.assertEqual(events[-1]["version"], game_engines.cached(code).version)
+
+
+class SamplingTests(GameTestCase):
+    """Estrazione per intervallo di id (indice in memoria spento): una domanda per casella del tabellone."""
+
+    def slot_question(self, slot):
+        category, level = slot
+        return Question.objects.get(category=category, difficulty=level)
+
+    def test_one_active_question_per_slot(self):
+        # Intervalli e poi estrazione: una query ciascuno per tutte le 25 caselle.
+        with self.assertNumQueries(2):
+            chosen = sample_by_id_range(BOARD_SLOTS)
+        self.assertEqual(chosen, {slot: self.slot_question(slot).pk for slot in BOARD_SLOTS})
+        with self.assertNumQueries(1):
+            sample_by_id_range(BOARD_SLOTS)
+        with mock.patch.object(question_bank, "enabled", False):
+            self.assertEqual(sample_board(BOARD_SLOTS), chosen)
+
+    def test_empty_slot_forces_a_reload_of_the_ranges(self):
+        slot = BOARD_SLOTS[0]
+        sample_by_id_range(BOARD_SLOTS)
+        question = self.slot_question(slot)
+        Question.objects.filter(pk=question.pk).update(is_active=False)
+        with mock.patch("lobby.sampling.load_ranges", wraps=load_ranges) as load:
+            # L'intervallo in memoria punta ancora alla domanda disattivata: si ricalcola una volta.
+            chosen = sample_by_id_range(BOARD_SLOTS)
+            self.assertEqual(load.call_count, 1)
+            self.assertIsNone(chosen[slot])
+            self.assertTrue(all(chosen[other] for other in BOARD_SLOTS[1:]))
+            # Casella appena popolata, assente dagli intervalli: stessa cosa.
+            question.pk = None
+            question.is_active = True
+            question.save()
+            self.assertEqual(sample_by_id_range(BOARD_SLOTS)[slot], question.pk)
+            self.assertEqual(load.call_count, 2)
+
+
+@mock.patch.object(question_bank, "check_interval", 60)
+class QuestionBankTests(GameTestCase):
+    """Indice in memoria aggiornato dai segnali di ``Question`` a transazione confermata."""
+
+    def ids(self, slot):
+        return list(question_bank.index().get(slot, []))
+
+    def new_question(self, slot, **fields):
+        category, level = slot
+        fields = {"text": "Nuova", "option_a": "a", "option_b": "b", "option_c": "c", "correct_option": "A", **fields}
+        return Question.objects.create(category=category, difficulty=level, **fields)
+
+    def test_save_and_delete_update_the_index_and_bump_the_generation(self):
+        first, second = BOARD_SLOTS[:2]
+        before = {slot: self.ids(slot) for slot in (first, second)}
+        generation = current_generation()
+        with mock.patch.object(question_bank, "load_index", wraps=question_bank.load_index) as load:
+            with self.captureOnCommitCallbacks(execute=True):
+                question = self.new_question(first)
+            self.assertEqual(self.ids(first), before[first] + [question.pk])
+            self.assertEqual(question_bank.record(question.pk).text, "Nuova")
+            with self.captureOnCommitCallbacks(execute=True):
+                question.category, question.difficulty = second
+                question.text = "Spostata"
+                question.save()
+            self.assertEqual((self.ids(first), self.ids(second)), (before[first], before[second] + [question.pk]))
+            with self.assertNumQueries(0):
+                self.assertEqual(question_bank.record(question.pk).text, "Spostata")
+            with self.captureOnCommitCallbacks(execute=True):
+                question.is_active = False
+                question.save()
+            self.assertEqual(self.ids(second), before[second])
+            with self.captureOnCommitCallbacks(execute=True):
+                question.delete()
+            self.assertIsNone(question_bank.record(question.pk))
+            # Modifiche di questo processo: applicate in memoria, senza ricaricare l'indice.
+            load.assert_not_called()
+        self.assertEqual(current_generation(), generation + 4)
+
+    def test_rolled_back_save_leaves_the_index_alone(self):
+        slot = BOARD_SLOTS[0]
+        before, generation = self.ids(slot), current_generation()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks, self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.new_question(slot)
+                raise RuntimeError("annullato")
+        self.assertEqual(callbacks, [])
+        self.assertEqual((self.ids(slot), current_generation()), (before, generation))
+
+    def test_generation_bumped_elsewhere_reloads_the_index(self):
+        slot = BOARD_SLOTS[0]
+        self.ids(slot)
+        # Un altro processo aggiunge una domanda: qui arriva solo il contatore.
+        with mock.patch.object(question_bank, "handle_save"):
+            question = self.new_question(slot)
+        bump_generation()
+        self.assertNotIn(question.pk, self.ids(slot))
+        with mock.patch.object(question_bank, "check_interval", 0):
+            self.assertIn(question.pk, self.ids(slot))
+
+
+CSV_HEADER = "category,difficulty,text,option_a,option_b,option_c,correct_option\n"
+
+
+class ImportQuestionsTests(TestCase):
+    def rows(self, count, correct="A"):
+        return "".join(f"storia,{n % 5 + 1},Domanda {n},a,b,c,{correct}\n" for n in range(count))
+
+    def test_imports_valid_rows_in_chunks_and_reports_errors(self):
+        csv = CSV_HEADER + self.rows(5) + "storia,9,Fuori range,a,b,c,A\n" + "arte,1,Materia,a,b,c,A\n" + "storia,1,,a,b,c,A\n"
+        progress = []
+        result = import_questions(StringIO(csv), chunk_size=2, max_errors=2, on_chunk=lambda r: progress.append(r.created))
+        self.assertEqual((result.rows, result.created, result.error_count), (8, 5, 3))
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(Question.objects.count(), 5)
+        self.assertEqual(result.errors, ["riga 7: difficoltà fuori range 1-5", "riga 8: categoria 'arte' non valida"])
+        self.assertTrue(result.summary().endswith("(e altri 1 errori)"))
+
+    def test_missing_headers_are_rejected(self):
+        with self.assertRaises(ValueError):
+            import_questions(StringIO("category,text\nstoria,Domanda\n"))
+        self.assertFalse(Question.objects.exists())
+
+    def test_reimport_does_not_duplicate_and_updates_the_answer(self):
+        import_questions(StringIO(CSV_HEADER + self.rows(4)))
+        again = import_questions(StringIO(CSV_HEADER + self.rows(4)))
+        self.assertEqual((again.created, again.updated, again.unchanged), (0, 0, 4))
+        # Stesso testo con un'altra risposta corretta: stessa impronta, la domanda si aggiorna.
+        changed = import_questions(StringIO(CSV_HEADER + self.rows(4, correct="B")))
+        self.assertEqual((changed.created, changed.updated), (0, 4))
+        self.assertEqual(set(Question.objects.values_list("correct_option", flat=True)), {"B"})
+        self.assertEqual(Question.objects.count(), 4)
+
+    def failing_second_chunk(self):
+        """``upsert_chunk`` che fallisce al secondo blocco."""
+        calls = []
+
+        def failing(chunk, result):
+            calls.append(len(chunk))
+            if len(calls) == 2:
+                raise RuntimeError("DB non disponibile")
+            upsert_chunk(chunk, result)
+
+        return mock.patch("lobby.importers.upsert_chunk", side_effect=failing)
+
+    def test_atomic_import_writes_nothing_on_failure(self):
+        with self.failing_second_chunk(), self.assertRaises(RuntimeError):
+            import_questions(StringIO(CSV_HEADER + self.rows(4)), chunk_size=2, atomic=True)
+        self.assertFalse(Question.objects.exists())
+
+    def test_failure_keeps_the_chunks_already_written(self):
+        with self.failing_second_chunk(), self.assertRaises(RuntimeError):
+            import_questions(StringIO(CSV_HEADER + self.rows(4)), chunk_size=2)
+        self.assertEqual(Question.objects.count(), 2)
+
+    def test_file_is_read_one_chunk_at_a_time(self):
+        lines = (CSV_HEADER + self.rows(6)).splitlines(keepends=True)
+        read = []
+
+        def stream():
+            for line in lines:
+                read.append(line)
+                yield line
+
+        progress = []
+        import_questions(stream(), chunk_size=2, on_chunk=lambda result: progress.append(len(read)))
+        # Intestazione più due righe per blocco: ogni blocco si scrive prima di leggere il resto del file.
+        self.assertEqual(progress, [3, 5, 7])
+
+    def test_every_required_header_must_be_present(self):
+        # Colonne in più non bastano a compensare quella mancante.
+        with self.assertRaises(ValueError):
+            import_questions(StringIO("category,difficulty,text,option_a,option_b,option_c,note\n"))
+        result = import_questions(StringIO(CSV_HEADER.replace("\n", ",is_active,note\n") + "storia,1,D,a,b,c,A,0,x\n"))
+        self.assertEqual(result.created, 1)
+        self.assertFalse(Question.objects.get().is_active)
+
+    def test_question_bank_reloads_once_per_import(self):
+        generation = current_generation()
+        with mock.patch.object(question_bank, "reload") as reload:
+            import_questions(StringIO(CSV_HEADER + self.rows(5)), chunk_size=2)
+        reload.assert_called_once_with()
+        self.assertEqual(current_generation(), generation + 1)
+
+
+@mock.patch("lobby.jobs.close_old_connections")
+@mock.patch("lobby.jobs.connection")
+class ImportJobTests(TestCase):
+    """Il job in background, eseguito sul thread del test al posto del pool."""
+
+    def job_for(self, content):
+        with NamedTemporaryFile("w", suffix=".csv", delete=False) as upload:
+            upload.write(content)
+        return QuestionImportJob.objects.create(filename="domande.csv", path=upload.name, size=len(content))
+
+    def test_completed_job_records_counts_and_removes_the_upload(self, *_):
+        job = self.job_for(CSV_HEADER + "storia,1,Chi?,a,b,c,A\nstoria,2,Dove?,a,b,c,Z\n")
+        run_import(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, QuestionImportJob.STATUS_DONE)
+        self.assertEqual((job.rows, job.imported, job.error_count), (2, 1, 1))
+        self.assertEqual(job.bytes_read, job.size)
+        self.assertIn("riga 3", job.errors)
+        self.assertFalse(os.path.exists(job.path))
+
+    def test_bad_file_fails_the_job(self, *_):
+        job = self.job_for("text\nChi?\n")
+        run_import(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, QuestionImportJob.STATUS_FAILED)
+        self.assertIn("Intestazioni mancanti", job.errors)
+        self.assertIsNotNone(job.finished_at)
+
+
+class DedupTests(GameTestCase):
+    def copy_questions(self):
+        """Una copia di ogni domanda, l'unica attiva: le partite nuove usano le copie."""
+        originals = set(Question.objects.values_list("id", flat=True))
+        for question in Question.objects.order_by("id"):
+            question.pk = None
+            question.save()
+        Question.objects.filter(id__in=originals).update(is_active=False)
+        question_bank.reload()
+        slot_ranges.invalidate()
+        return originals
+
+    def test_dry_run_counts_without_changes(self):
+        self.copy_questions()
+        self.assertEqual(merge_duplicates(batch_size=10, dry_run=True), (len(BOARD_SLOTS), len(BOARD_SLOTS)))
+        self.assertEqual(Question.objects.count(), 2 * len(BOARD_SLOTS))
+
+    @override_settings(GAME_CHECKPOINT_INTERVAL=2)
+    def test_copies_are_merged_into_the_oldest_question(self):
+        originals = self.copy_questions()
+        code, clients = self.start_game()
+        self.play_turn(clients, code)
+        self.play_turn(clients, code)
+        game = Room.objects.get(code=code).game
+        self.assertFalse(game.game_questions.filter(question_id__in=originals).exists())
+        pages = []
+        groups, removed = merge_duplicates(batch_size=10, on_page=lambda groups, removed: pages.append(groups))
+        self.assertEqual((groups, removed), (len(BOARD_SLOTS), len(BOARD_SLOTS)))
+        self.assertEqual(pages, [10, 20, 25])
+        self.assertEqual(set(Question.objects.values_list("id", flat=True)), originals)
+        # Basta una copia attiva perché la domanda tenuta torni nei quiz.
+        self.assertFalse(Question.objects.filter(is_active=False).exists())
+        self.assertEqual(set(game.game_questions.values_list("question_id", flat=True)), originals)
+        self.assertLessEqual(set(game.turns.values_list("question_id", flat=True)), originals)
+        self.assertLessEqual(set(game.events.get(seq=1).data["questions"]), originals)
+        chosen = game.events.filter(kind="chosen").values_list("data", flat=True)
+        self.assertLessEqual({data["question"] for data in chosen}, originals)
+        self.assertTrue(game.checkpoints.exists())
+        for checkpoint in game.checkpoints.all():
+            self.assertLessEqual(set(checkpoint.state["questions"]), originals)
+        # Il log rimappato si rigioca come le tabelle.
+        out = StringIO()
+        call_command("replay_game", code, "--check", stdout=out)
+        self.assertIn("Replay coerente", out.getvalue())
+        self.assertEqual(merge_duplicates(), (0, 0))
+
+
+class TimerWheelTests(SimpleTestCase):
+    async def test_timers_fire_in_order_and_never_early(self):
+        # Quattro caselle da 10 ms per livello: 20 ms al livello 0, 70 ms al livello 1, 250 ms al livello 2.
+        wheel = TimerWheel(tick=0.01, slots=4, levels=3)
+        loop = asyncio.get_running_loop()
+        fired = []
+        done = loop.create_future()
+
+        def record(name, when):
+            fired.append((name, when, loop.time()))
+            if len(fired) == 3:
+                done.set_result(None)
+
+        start = loop.time()
+        cancelled = wheel.call_later(0.05, record, "annullato", start)
+        for name, delay in (("livello 2", 0.25), ("livello 0", 0.02), ("livello 1", 0.07)):
+            wheel.call_later(delay, record, name, start + delay)
+        cancelled.cancel()
+        self.assertTrue(cancelled.cancelled())
+        self.assertEqual(wheel.pending, 3)
+        await asyncio.wait_for(done, 3)
+        self.assertEqual([name for name, _, _ in fired], ["livello 0", "livello 1", "livello 2"])
+        for _, when, at in fired:
+            self.assertGreaterEqual(at, when - 1e-6)
+        self.assertEqual((wheel.pending, wheel.fired), (0, 3))
+
+    def test_slots_must_be_a_power_of_two(self):
+        with self.assertRaises(ValueError):
+            TimerWheel(slots=48)
+
+
+class TurnExpiryTests(GameTestCase):
+    """Scadenze dei turni fatte valere da ``expire_turn``, con l'orologio spostato in avanti."""
+
+    def setUp(self):
+        super().setUp()
+        # Nessun timer reale: la scadenza si chiama a mano.
+        patcher = mock.patch.object(turn_deadlines, "arm")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def expire(self, code, seconds):
+        engine = game_engines.cached(code)
+        with mock.patch("django.utils.timezone.now", return_value=timezone.now() + timedelta(seconds=seconds)):
+            async_to_sync(expire_turn)(code, engine.version)
+        return game_engines.cached(code)
+
+    @override_settings(TURN_ANSWER_TIMEOUT=10)
+    def test_unanswered_question_closes_as_wrong(self):
+        code, clients = self.start_game()
+        client, state = self.choose(clients, code)
+        version = state["version"]
+        self.assertEqual(self.expire(code, 5).version, version)
+        engine = self.expire(code, 11)
+        self.assertEqual(engine.version, version + 1)
+        self.assertEqual(engine.state, Game.STATE_CHOOSING)
+        self.assertNotEqual(engine.current_player.nickname, state["current_player"]["nickname"])
+        game = Room.objects.get(code=code).game
+        turn = game.turns.get()
+        self.assertEqual((turn.selected_option, turn.was_correct, turn.points_awarded), (None, False, 0))
+        self.assertTrue(game.events.get(kind="answered").data["expired"])
+        # La risposta arrivata dopo la scadenza trova il turno chiuso.
+        response = client.post(f"/stanza/{code}/gioco/rispondi/", {"option": Question.OPTION_A, "version": version})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(TURN_CHOOSE_TIMEOUT=10)
+    def test_idle_chooser_passes_the_turn_with_backoff(self):
+        code, clients = self.start_game()
+        first = self.state(clients["P0"], code)["current_player"]["nickname"]
+        engine = self.expire(code, 11)
+        self.assertNotEqual(engine.current_player.nickname, first)
+        self.assertEqual(engine.idle_turns, 1)
+        self.assertEqual(engine.deadline - engine.since, timedelta(seconds=10))
+        engine = self.expire(code, 22)
+        self.assertEqual(engine.current_player.nickname, first)
+        # Un giro intero senza giocare: il tempo per scegliere raddoppia.
+        self.assertEqual(engine.deadline - engine.since, timedelta(seconds=20))
+        events = Room.objects.get(code=code).game.events.filter(kind="rotated")
+        self.assertEqual([event.data["expired"] for event in events], [True, True])
+
+
+@override_settings(TURN_ANSWER_TIMEOUT=10)
+class SimultaneousAnswerTests(GameTestCase):
+    """Modalità "rispondono tutti": ordine d'arrivo, posizioni e bonus di velocità calcolati alla chiusura."""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(turn_deadlines, "arm")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def answer_at(self, client, code, state, option, seconds):
+        """Risposta arrivata ``seconds`` secondi dopo l'apertura della domanda."""
+        started = game_engines.cached(code).current_turn.started_at
+        with mock.patch("django.utils.timezone.now", return_value=started + timedelta(seconds=seconds)):
+            return client.post(f"/stanza/{code}/gioco/rispondi/", {"option": option, "version": state["version"]})
+
+    def test_everyone_answers_and_is_ranked_by_arrival(self):
+        code, clients = self.start_game(players=3, answer_mode=Game.ANSWER_ALL)
+        _, state = self.choose(clients, code)
+        level = state["question"]["difficulty"]
+        response = self.answer_at(clients["P2"], code, state, Question.OPTION_A, 1)
+        self.assertEqual(response.status_code, 200)
+        # Nessuna nuova versione finché non hanno risposto tutti.
+        self.assertEqual(response.json()["version"], state["version"])
+        self.assertEqual(self.answer_at(clients["P2"], code, state, Question.OPTION_B, 1.5).status_code, 400)
+        self.answer_at(clients["P0"], code, state, Question.OPTION_B, 2)
+        response = self.answer_at(clients["P1"], code, state, Question.OPTION_A, 4)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["version"], state["version"] + 1)
+        self.assertEqual(response.json()["status"], Game.STATE_CHOOSING)
+        expected = [
+            ("P2", Question.OPTION_A, True, level + round(level * 0.9), 1),
+            ("P0", Question.OPTION_B, False, 0, None),
+            ("P1", Question.OPTION_A, True, level + round(level * 0.6), 2),
+        ]
+        game = Room.objects.get(code=code).game
+        rows = game.answers.order_by("received_at").values_list(
+            "player__nickname", "option", "was_correct", "points", "rank"
+        )
+        self.assertEqual(list(rows), expected)
+        answers = self.state(clients["P0"], code)["last_answer"]["answers"]
+        self.assertEqual(
+            [(row["player"]["nickname"], row["rank"]) for row in answers],
+            [(nickname, rank) for nickname, _, _, _, rank in expected],
+        )
+        scores = dict(game.players.values_list("player__nickname", "score"))
+        self.assertEqual(scores, {nickname: points for nickname, _, _, points, _ in expected})
+
+    def test_expiry_scores_the_answers_received(self):
+        code, clients = self.start_game(players=3, answer_mode=Game.ANSWER_ALL)
+        _, state = self.choose(clients, code)
+        level = state["question"]["difficulty"]
+        other = next(nickname for nickname in clients if nickname != state["current_player"]["nickname"])
+        self.answer_at(clients[other], code, state, Question.OPTION_A, 5)
+        engine = game_engines.cached(code)
+        with mock.patch("django.utils.timezone.now", return_value=engine.current_turn.started_at + timedelta(seconds=11)):
+            async_to_sync(expire_turn)(code, engine.version)
+        game = Room.objects.get(code=code).game
+        self.assertEqual(game.state, Game.STATE_CHOOSING)
+        self.assertEqual(
+            list(game.answers.values_list("player__nickname", "points", "rank")), [(other, level + round(level * 0.5), 1)]
+        )
+        turn = game.turns.get()
+        # Il turno resta di chi ha scelto: vale la sua risposta, qui mancante.
+        self.assertEqual((turn.selected_option, turn.points_awarded), (None, 0))
+        self.assertFalse(game.events.get(kind="answered").data.get("expired", False))
+
+    @override_settings(TURN_ANSWER_TIMEOUT=0)
+    def test_absent_player_does_not_stall_the_turn_without_answer_timeout(self):
+        code, clients = self.start_game(players=3, answer_mode=Game.ANSWER_ALL)
+        _, state = self.choose(clients, code)
+        level = state["question"]["difficulty"]
+        engine = game_engines.cached(code)
+        self.assertEqual(engine.deadline, engine.current_turn.started_at + timedelta(seconds=BUZZ_SCORING_WINDOW))
+        self.answer_at(clients["P0"], code, state, Question.OPTION_A, BUZZ_SCORING_WINDOW / 2)
+        self.answer_at(clients["P1"], code, state, Question.OPTION_B, BUZZ_SCORING_WINDOW / 2 + 1)
+        started = engine.current_turn.started_at
+        with mock.patch("django.utils.timezone.now", return_value=started + timedelta(seconds=BUZZ_SCORING_WINDOW + 1)):
+            async_to_sync(expire_turn)(code, engine.version)
+        game = Room.objects.get(code=code).game
+        self.assertEqual(game.state, Game.STATE_CHOOSING)
+        self.assertEqual(
+            list(game.answers.order_by("received_at").values_list("player__nickname", "points")),
+            [("P0", level + round(level * 0.5)), ("P1", 0)],
+        )
+
+
+def apply_patch(state, ops):
+    """Come ``applyPatch`` della pagina di gioco: operazioni di un game_patch su una copia dello stato JSON."""
+    state = json.loads(json.dumps(state))
+    for op, path, *value in ops:
+        if not path:
+            state = value[0] if op == "set" else None
+            continue
+        target = state
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        if op == "set":
+            target[path[-1]] = value[0]
+        else:
+            target.pop(path[-1], None)
+    return state
+
+
+def as_json(value):
+    return json.loads(json.dumps(value))
+
+
+class GameSocketTestCase(GameTestCase):
+    """Socket di gioco aperti con ``WebsocketCommunicator`` per i client di test, dentro ``async_to_sync``."""
+
+    async def open_socket(self, session_key, code, query="", path="gioco/"):
+        """Socket collegato con la sessione ``session_key``; restituisce (socket, primo messaggio dopo l'hello)."""
+        socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/stanza/{code}/{path}?{query}")
+        socket.scope["session"] = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        connected, _ = await socket.connect()
+        self.assertTrue(connected)
+        self.assertEqual((await socket.receive_json_from())["type"], "hello")
+        return socket, await socket.receive_json_from()
+
+    async def queries(self):
+        # Le query del lavoro sul DB passano dal thread del test, dove ``CaptureQueriesContext`` le registra.
+        return await sync_to_async(lambda: len(connection.queries))()
+
+
+class GamePatchTests(GameSocketTestCase):
+    def test_patches_rebuild_every_version_of_a_game(self):
+        code, clients = self.start_game()
+        session_key = self.session_key(clients["P0"])
+        engine = game_engines.cached(code)
+
+        def current():
+            return personalise_game_state(get_engine_snapshot(engine), session_key)
+
+        states = [current()]
+        for turn in range(len(BOARD_SLOTS)):
+            client, _ = self.choose(clients, code)
+            states.append(current())
+            option = Question.OPTION_A if turn % 2 else Question.OPTION_B
+            client.post(f"/stanza/{code}/gioco/rispondi/", {"option": option, "version": engine.version})
+            states.append(current())
+        self.assertTrue(states[-1]["game_over"])
+        for old, new in zip(states, states[1:]):
+            # Il patch viaggia in JSON come gli stati: chiavi intere comprese.
+            patch = as_json(game_patch(old, new))
+            self.assertEqual((patch["base"], patch["version"]), (old["version"], new["version"]))
+            self.assertEqual(apply_patch(as_json(old), patch["ops"]), as_json(new))
+
+    def test_removed_keys_and_unchanged_states(self):
+        old = {"version": 1, "question": {"id": 3, "text": "t"}, "available": {"storia": {1: 1, 2: 1}}}
+        new = {"version": 2, "available": {"storia": {1: 0, 2: 1}}, "scoreboard": [{"score": 1}]}
+        patch = game_patch(old, new)
+        self.assertIn(["del", ["question"]], patch["ops"])
+        self.assertIn(["set", ["available", "storia", "1"], 0], patch["ops"])
+        self.assertEqual(apply_patch(as_json(old), as_json(patch["ops"])), as_json(new))
+        self.assertIsNone(game_patch(old, dict(old)))
+
+    def test_delta_socket_sends_patches_and_a_full_state_on_resync(self):
+        code, clients = self.start_game()
+        session_key = self.session_key(clients["P0"])
+        playing = self.session_key(clients[self.state(clients["P0"], code)["current_player"]["nickname"]])
+        category, level = next(iter(BOARD_SLOTS))
+
+        async def play():
+            socket, first = await self.open_socket(session_key, code, "delta=1")
+            await perform_choose(code, playing, {"category": category, "difficulty": level})
+            patch = await socket.receive_json_from()
+            await socket.send_json_to({"type": "resync"})
+            resync = await socket.receive_json_from()
+            await socket.disconnect()
+            return first, patch, resync
+
+        first, patch, resync = async_to_sync(play)()
+        self.assertEqual(first["type"], "game_state")
+        self.assertEqual((patch["type"], patch["base"], patch["version"]), ("game_patch", first["version"], first["version"] + 1))
+        self.assertEqual(apply_patch(first, patch["ops"]), resync)
+        self.assertEqual(resync, self.state(clients["P0"], code))
+
+
+class SocketResumeTests(GameSocketTestCase):
+    """Riconnessione con ``?delta=1&resume=<versione>``: up_to_date, patch o stato completo."""
+
+    def resume(self, client, code, version):
+        async def connect():
+            socket, first = await self.open_socket(self.session_key(client), code, f"delta=1&resume={version}")
+            await socket.disconnect()
+            return first
+
+        return async_to_sync(connect)()
+
+    def test_client_already_up_to_date(self):
+        code, clients = self.start_game()
+        version = self.state(clients["P0"], code)["version"]
+        self.assertEqual(self.resume(clients["P0"], code, version), {"type": "up_to_date", "version": version})
+
+    def test_older_version_gets_a_patch_from_the_cache_or_the_log(self):
+        code, clients = self.start_game()
+        old = self.state(clients["P0"], code)
+        self.play_turn(clients, code)
+        new = self.state(clients["P0"], code)
+        for evicted in (False, True):
+            with self.subTest(evicted=evicted):
+                if evicted:
+                    # Versione uscita dalla cache: si ricostruisce da checkpoint e log.
+                    game_snapshots.clear()
+                with mock.patch("lobby.views.replay_game_snapshot", wraps=replay_game_snapshot) as replay:
+                    patch = self.resume(clients["P0"], code, old["version"])
+                self.assertEqual(replay.called, evicted)
+                self.assertEqual((patch["type"], patch["base"], patch["version"]), ("game_patch", old["version"], new["version"]))
+                self.assertEqual(apply_patch(old, patch["ops"]), new)
+
+    def test_unknown_version_gets_the_full_state(self):
+        code, clients = self.start_game()
+        self.play_turn(clients, code)
+        state = self.state(clients["P0"], code)
+        for version in (state["version"] + 5, -1, "x"):
+            with self.subTest(version=version):
+                self.assertEqual(self.resume(clients["P0"], code, version), state)
+
+
+class SocketHeartbeatTests(GameSocketTestCase):
+    """Ping con versione: pong dal registro in processo, stato solo se il client è indietro, mai il DB."""
+
+    def test_ping_is_answered_without_the_database(self):
+        code, clients = self.start_game()
+        playing = self.session_key(clients[self.state(clients["P0"], code)["current_player"]["nickname"]])
+        category, level = next(iter(BOARD_SLOTS))
+
+        async def play():
+            socket, state = await self.open_socket(self.session_key(clients["P0"]), code)
+            version = state["version"]
+            replies, counts = [], []
+            mark = await self.queries()
+            for ping in ({"type": "ping", "version": version}, "ping", {"type": "ping", "version": version - 1}):
+                await (socket.send_to("ping") if ping == "ping" else socket.send_json_to(ping))
+                replies.append(await socket.receive_json_from())
+            counts.append(await self.queries() - mark)
+            # Broadcast perso: il registro conosce la nuova versione, lo snapshot arriva dalla cache.
+            mark = await self.queries()
+            with mock.patch.object(GameConsumer, "game_update", new=mock.AsyncMock()):
+                await perform_choose(code, playing, {"category": category, "difficulty": level})
+            counts.append(await self.queries() - mark)
+            mark = await self.queries()
+            await socket.send_json_to({"type": "ping", "version": version})
+            replies.append(await socket.receive_json_from())
+            counts.append(await self.queries() - mark)
+            await socket.disconnect()
+            return version, replies, counts
+
+        with CaptureQueriesContext(connection):
+            version, replies, (idle, acted, behind) = async_to_sync(play)()
+        pong = {"type": "pong", "version": version}
+        self.assertEqual(replies[:2], [pong, pong])
+        # Client indietro rispetto a quanto già inviato: lo stato si reinvia intero.
+        self.assertEqual((replies[2]["type"], replies[2]["version"]), ("game_state", version))
+        self.assertEqual(replies[3], self.state(clients["P0"], code))
+        self.assertEqual(replies[3]["version"], version + 1)
+        self.assertEqual((idle, behind), (0, 0))
+        # Il conteggio vede davvero le query: l'azione ha salvato la partita.
+        self.assertGreater(acted, 0)
+
+
+class SocketBroadcastTests(GameSocketTestCase):
+    def test_broadcast_reaches_every_socket_without_queries(self):
+        code, clients = self.start_game()
+        playing = self.state(clients["P0"], code)["current_player"]["nickname"]
+        sessions = {nickname: self.session_key(client) for nickname, client in clients.items()}
+        room = Room.objects.get(code=code)
+        category, level = next(iter(BOARD_SLOTS))
+
+        async def play():
+            sockets = {nickname: (await self.open_socket(key, code))[0] for nickname, key in sessions.items()}
+            lobby, _ = await self.open_socket(sessions["P0"], code, path="")
+            await perform_choose(code, sessions[playing], {"category": category, "difficulty": level})
+            room_snapshot = await sync_to_async(get_room_snapshot)(room)
+            # Da qui solo consegna: snapshot già nei messaggi, sessione letta alla connessione.
+            mark = await self.queries()
+            states = {nickname: await socket.receive_json_from() for nickname, socket in sockets.items()}
+            await get_channel_layer().group_send(f"room_{code}", {"type": "room_update", "snapshot": room_snapshot})
+            lobby_state = await lobby.receive_json_from()
+            delivered = await self.queries() - mark
+            for socket in (*sockets.values(), lobby):
+                await socket.disconnect()
+            return states, lobby_state, delivered
+
+        with CaptureQueriesContext(connection):
+            states, lobby_state, delivered = async_to_sync(play)()
+        self.assertEqual(delivered, 0)
+        self.assertEqual({state["version"] for state in states.values()}, {states["P0"]["version"]})
+        for nickname, state in states.items():
+            self.assertEqual(state, self.state(clients[nickname], code))
+        self.assertEqual(lobby_state["type"], "room_state")
+
+
+class SocketActionTests(GameSocketTestCase):
+    def test_actions_are_acked_with_the_new_version(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        nickname = state["current_player"]["nickname"]
+        session_key = self.session_key(clients[nickname])
+        category, level = next(
+            (category, level) for category, levels in state["available"].items() for level, count in levels.items() if count
+        )
+
+        async def play():
+            socket, _ = await self.open_socket(session_key, code)
+            choose = {"type": "choose", "request_id": "c1", "category": category, "difficulty": level}
+            await socket.send_json_to({**choose, "version": state["version"]})
+            ack = await socket.receive_json_from()
+            chosen = await socket.receive_json_from()
+            await socket.send_json_to({"type": "answer", "request_id": "a1", "option": "A", "version": chosen["version"]})
+            answer_ack = await socket.receive_json_from()
+            answered = await socket.receive_json_from()
+            await socket.disconnect()
+            return ack, chosen, answer_ack, answered
+
+        ack, chosen, answer_ack, answered = async_to_sync(play)()
+        # L'ack precede lo stato del broadcast e ne porta la versione.
+        self.assertEqual(ack, {"type": "ack", "action": "choose", "request_id": "c1", "ok": True, "version": chosen["version"]})
+        self.assertEqual(chosen["status"], Game.STATE_ANSWERING)
+        self.assertEqual(
+            answer_ack, {"type": "ack", "action": "answer", "request_id": "a1", "ok": True, "version": answered["version"]}
+        )
+        self.assertEqual(answered["last_answer"]["player"]["nickname"], nickname)
+        self.assertEqual(Room.objects.get(code=code).game.turns_played, 1)
+
+    def test_rejected_actions_carry_status_and_payload(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        waiting = next(nickname for nickname in clients if nickname != state["current_player"]["nickname"])
+        playing = self.session_key(clients[state["current_player"]["nickname"]])
+        category, level = next(iter(BOARD_SLOTS))
+
+        async def play():
+            socket, _ = await self.open_socket(self.session_key(clients[waiting]), code)
+            await socket.send_json_to({"type": "choose", "request_id": 1, "category": category, "difficulty": level})
+            not_your_turn = await socket.receive_json_from()
+            await socket.disconnect()
+            socket, _ = await self.open_socket(playing, code)
+            choose = {"type": "choose", "request_id": 2, "category": category, "difficulty": level}
+            await socket.send_json_to({**choose, "version": state["version"] - 1})
+            stale = await socket.receive_json_from()
+            self.assertTrue(await socket.receive_nothing())
+            await socket.disconnect()
+            return not_your_turn, stale
+
+        not_your_turn, stale = async_to_sync(play)()
+        self.assertEqual(
+            not_your_turn,
+            {"type": "ack", "action": "choose", "request_id": 1, "ok": False, "status": 403, "error": "Non è il tuo turno."},
+        )
+        self.assertEqual(
+            (stale["ok"], stale["status"], stale["stale"], stale["version"]), (False, 409, True, state["version"])
+        )
+        self.assertEqual(Room.objects.get(code=code).game.version, state["version"])
+
+    def test_missing_room_is_a_json_404(self):
+        async def play():
+            socket, first = await self.open_socket("missing", "NOPE00")
+            await socket.send_json_to({"type": "answer", "request_id": "x", "option": "A"})
+            ack = await socket.receive_json_from()
+            await socket.disconnect()
+            return first, ack
+
+        first, ack = async_to_sync(play)()
+        self.assertEqual(first, {"type": "not_found"})
+        self.assertEqual((ack["ok"], ack["status"], ack["error"]), (False, 404, "Stanza non trovata."))
+        response = Client().post("/stanza/NOPE00/gioco/rispondi/", {"option": "A"})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"error": "Stanza non trovata."})
+
+
+class StateEndpointTests(GameTestCase):
+    """ETag per sessione e long-poll di ``game_state``/``room_state``."""
+
+    async def wait_for_subscriber(self, code):
+        layer = get_channel_layer()
+        deadline = time.monotonic() + 2
+        while not layer.groups.get(f"room_{code}"):
+            self.assertLess(time.monotonic(), deadline, "nessuna richiesta in attesa sul gruppo")
+            await asyncio.sleep(0.01)
+
+    def test_etag_answers_304_until_the_state_changes(self):
+        code, clients = self.start_game()
+        for url in (f"/stanza/{code}/gioco/state/", f"/stanza/{code}/state/"):
+            with self.subTest(url=url):
+                response = clients["P0"].get(url)
+                etag = response["ETag"]
+                self.assertEqual(response.status_code, 200)
+                response = clients["P0"].get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual((response.status_code, response["ETag"], response.content), (304, etag, b""))
+                # Payload diverso per sessione: l'ETag di un altro giocatore non vale.
+                self.assertEqual(clients["P1"].get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = clients["P0"].get(f"/stanza/{code}/gioco/state/")["ETag"]
+        self.play_turn(clients, code)
+        response = clients["P0"].get(f"/stanza/{code}/gioco/state/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_long_poll_wakes_up_on_the_next_version(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        playing = self.session_key(clients[state["current_player"]["nickname"]])
+        category, level = next(iter(BOARD_SLOTS))
+        async_client = self.as_player(clients["P0"])
+
+        async def play():
+            url = f"/stanza/{code}/gioco/state/?wait={state['version']}&timeout=5"
+            started = time.monotonic()
+            polling = asyncio.ensure_future(async_client.get(url))
+            await self.wait_for_subscriber(code)
+            await perform_choose(code, playing, {"category": category, "difficulty": level})
+            response = await polling
+            return response, time.monotonic() - started
+
+        response, elapsed = async_to_sync(play)()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["version"], state["version"] + 1)
+        self.assertLess(elapsed, 5)
+
+    def test_long_poll_times_out_with_304(self):
+        code, clients = self.start_game()
+        state = self.state(clients["P0"], code)
+        async_client = self.as_player(clients["P0"])
+
+        async def poll():
+            started = time.monotonic()
+            response = await async_client.get(f"/stanza/{code}/gioco/state/?wait={state['version']}&timeout=0.2")
+            return response, time.monotonic() - started
+
+        response, elapsed = async_to_sync(poll)()
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], clients["P0"].get(f"/stanza/{code}/gioco/state/")["ETag"])
+        self.assertGreaterEqual(elapsed, 0.2)
+        # Versione già superata: risposta subito, senza attendere.
+        response = clients["P0"].get(f"/stanza/{code}/gioco/state/?wait={state['version'] - 1}&timeout=5")
+        self.assertEqual(response.json()["version"], state["version"])
+
+
+class EventStreamTests(GameTestCase):
+    """Stream SSE della partita: id degli eventi = versioni, ripresa con Last-Event-ID."""
+
+    async def next_event(self, stream):
+        """Prossimo evento dello stream come dict (id, event, data), saltando retry e keepalive."""
+        while True:
+            chunk = (await asyncio.wait_for(anext(stream), 2)).decode()
+            if chunk.startswith(("retry:", ":")):
+                continue
+            fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+            return {**fields, "data": json.loads(fields["data"])}
+
+    def first_event(self, client, code, query="", headers=None):
+        async def read():
+            response = await self.as_player(client).get(f"/stanza/{code}/gioco/eventi/?{query}", headers=headers)
+            stream = aiter(response.streaming_content)
+            try:
+                return await self.next_event(stream)
+            finally:
+                await stream.aclose()
+
+        return async_to_sync(read)()
+
+    def test_resume_with_last_event_id(self):
+        code, clients = self.start_game()
+        old = self.state(clients["P0"], code)
+        self.play_turn(clients, code)
+        new = self.state(clients["P0"], code)
+        event = self.first_event(clients["P0"], code)
+        self.assertEqual((event["event"], event["id"], event["data"]), ("game_state", str(new["version"]), new))
+        event = self.first_event(clients["P0"], code, headers={"Last-Event-ID": str(new["version"])})
+        self.assertEqual(event["data"], {"type": "up_to_date", "version": new["version"]})
+        event = self.first_event(clients["P0"], code, headers={"Last-Event-ID": str(old["version"])})
+        self.assertEqual((event["event"], event["data"]["base"]), ("game_patch", old["version"]))
+        self.assertEqual(apply_patch(old, event["data"]["ops"]), new)
+        # Prima apertura di EventSource: la versione arriva nella query.
+        event = self.first_event(clients["P0"], code, f"last_event_id={new['version']}")
+        self.assertEqual(event["event"], "up_to_date")
+
+    def test_stream_sends_patches_after_the_first_state(self):
+        code, clients = self.start_game()
+        playing = self.session_key(clients[self.state(clients["P0"], code)["current_player"]["nickname"]])
+        category, level = next(iter(BOARD_SLOTS))
+        async_client = self.as_player(clients["P0"])
+
+        async def play():
+            response = await async_client.get(f"/stanza/{code}/gioco/eventi/")
+            stream = aiter(response.streaming_content)
+            try:
+                first = await self.next_event(stream)
+                await perform_choose(code, playing, {"category": category, "difficulty": level})
+                return response, first, await self.next_event(stream)
+            finally:
+                await stream.aclose()
+
+        response, first, patch = async_to_sync(play)()
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual((patch["event"], patch["id"]), ("game_patch", str(first["data"]["version"] + 1)))
+        self.assertEqual(apply_patch(first["data"], patch["data"]["ops"]), self.state(clients["P0"], code))
+
+
+class BroadcastTests(SimpleTestCase):
+    async def test_broadcast_from_another_thread_wakes_the_server_loop(self):
+        # Come il flusher dopo un conflitto: il broadcast parte da un thread, i consumer aspettano sul loop.
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add("room_RESYNC", channel)
+        room = Room(code="RESYNC")
+        loop = asyncio.get_running_loop()
+        receiving = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0)
+        try:
+            with mock.patch("lobby.views.get_game_snapshot", return_value={"state": {"version": 3}}):
+                # Il loop non aspetta il thread: deve svegliarlo il messaggio, non la fine del thread.
+                sender = threading.Thread(target=broadcast_game_state, args=(room, loop))
+                started = loop.time()
+                sender.start()
+                message = await asyncio.wait_for(receiving, 3)
+                elapsed = loop.time() - started
+                await asyncio.to_thread(sender.join)
+        finally:
+            await layer.group_discard("room_RESYNC", channel)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(message["type"], "game_update")
+        self.assertEqual(message["snapshot"]["state"]["version"], 3)
+
+
+class GameEnginesTests(SimpleTestCase):
+    def test_concurrent_loads_of_a_room_run_once(self):
+        engines = GameEngines(load_concurrency=2)
+        room, game = Room(code="ONCE"), Game(pk=7, version=4)
+        calls = []
+        release = threading.Event()
+
+        def load(room, game):
+            calls.append(game.pk)
+            release.wait(1)
+            engine = GameEngine(room, game.pk)
+            engine.version = engine.saved_version = game.version
+            return engine
+
+        with mock.patch.object(GameEngine, "load", side_effect=load):
+            threads = [threading.Thread(target=engines.get, args=(room, game)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(calls, [7])
+        self.assertEqual(engines.cached("ONCE").version, 4)
+
+    def test_newer_game_version_reloads(self):
+        engines = GameEngines()
+
+        def load(room, game):
+            engine = GameEngine(room, game.pk)
+            engine.version = engine.saved_version = game.version
+            return engine
+
+        with mock.patch.object(GameEngine, "load", side_effect=load) as loader:
+            room = Room(code="AHEAD")
+            engines.get(room, Game(pk=7, version=4))
+            engines.get(room, Game(pk=7, version=4))
+            self.assertEqual(engines.get(room, Game(pk=7, version=6)).version, 6)
+        self.assertEqual(loader.call_count, 2)
+
+
+class DatabaseExecutorTests(SimpleTestCase):
+    def test_rooms_are_served_round_robin(self):
+        executor = DatabaseExecutor(workers=1, name="test-db")
+        started, release = threading.Event(), threading.Event()
+        blocker = executor.submit("A", lambda: started.set() or release.wait(2))
+        self.assertTrue(started.wait(2))
+        order = []
+        # Coda profonda per A, poi un solo task per B: B non aspetta tutta la coda di A.
+        futures = [executor.submit("A", order.append, f"A{n}") for n in range(5)]
+        futures.append(executor.submit("B", order.append, "B0"))
+        self.assertEqual(executor.stats()["rooms_waiting"], 2)
+        release.set()
+        for future in [blocker, *futures]:
+            future.result(2)
+        self.assertEqual(order, ["A0", "B0", "A1", "A2", "A3", "A4"])
+        self.assertEqual(executor.stats()["completed"], 7)
+
+    async def test_no_workers_falls_back_to_sync_to_async(self):
+        executor = DatabaseExecutor(workers=0)
+        with mock.patch.object(executor, "submit") as submit:
+            self.assertEqual(await executor.run("A", lambda value: value * 2, 21), 42)
+        submit.assert_not_called()
+        self.assertEqual(executor.stats()["threads"], 0)
+
+    def test_database_error_closes_the_connection_and_the_worker_survives(self):
+        executor = DatabaseExecutor(workers=1, name="test-db")
+
+        def broken():
+            raise DatabaseError("server closed the connection")
+
+        with mock.patch("lobby.db_executor.connections") as connections:
+            with self.assertRaises(DatabaseError):
+                executor.submit("A", broken).result(2)
+            connections.close_all.assert_called_once_with()
+            # Stesso thread, connessione riaperta al task successivo.
+            self.assertEqual(executor.submit("A", lambda: 1).result(2), 1)
+            with self.assertRaises(ValueError):
+                executor.submit("A", int, "x").result(2)
+            connections.close_all.assert_called_once_with()
+        self.assertEqual(executor.stats()["threads"], 1)
+
+
+class BrokerTestCase(SimpleTestCase):
+    """Broker e layer multi-processo: più layer nello stesso processo fanno da worker distinti."""
+
+    def setUp(self):
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.path = os.path.join(directory, "channels.sock")
+
+    @asynccontextmanager
+    async def running_broker(self, **options):
+        broker = ChannelBroker(self.path, **options)
+        await broker.start()
+        try:
+            yield broker
+        finally:
+            await broker.close()
+
+    async def wait_until(self, condition, timeout=3):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("condizione non raggiunta")
+            await asyncio.sleep(0.01)
+
+
+class ChannelBrokerTests(BrokerTestCase):
+    async def test_socket_is_private_from_the_start(self):
+        umask = os.umask(0)
+        try:
+            # Nessun chmod dopo il bind: i permessi devono essere già quelli giusti.
+            with mock.patch("os.chmod"):
+                broker = ChannelBroker(self.path)
+                await broker.start()
+        finally:
+            os.umask(umask)
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+            with mock.patch("lobby.channel_layer.peer_uid", return_value=os.getuid() + 1):
+                layer = UnixSocketChannelLayer(path=self.path)
+                layer.start()
+                await asyncio.sleep(0.2)
+                # Né il broker né il layer accettano un processo di un altro utente.
+                self.assertEqual(broker.clients, {})
+        finally:
+            await broker.close()
+
+    async def test_messages_cannot_name_classes_or_functions(self):
+        layer = UnixSocketChannelLayer(path=self.path)
+        channel = await layer.new_channel()
+        message = {"type": "game.update", "snapshot": {1: ("a", None), "ok": {True, 2.5}}}
+        self.assertEqual(loads_message(pickle.dumps(message, pickle.HIGHEST_PROTOCOL)), message)
+        body = pickle.dumps({"type": "game.update", "run": os.getcwd})
+        with self.assertRaises(pickle.UnpicklingError):
+            loads_message(body)
+        layer.deliver_remote([channel], body)
+        self.assertEqual((layer.dropped, layer.channels), (1, {}))
+        with self.assertRaises(pickle.UnpicklingError):
+            await layer.send(channel, {"type": "game.update", "at": datetime.now()})
+
+
+class ChannelLayerTests(BrokerTestCase):
+    """Due layer collegati allo stesso broker, come due worker ASGI."""
+
+    async def connect(self, broker, **options):
+        layers = [UnixSocketChannelLayer(path=self.path, **options) for _ in range(2)]
+        for layer in layers:
+            layer.start()
+        await self.wait_until(lambda: all(layer.client_id in broker.clients for layer in layers))
+        return layers
+
+    async def join(self, broker, layer, group):
+        channel = await layer.new_channel()
+        await layer.group_add(group, channel)
+        await self.wait_until(lambda: channel in broker.groups.get(group, {}))
+        return channel
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 2)
+
+    async def assert_nothing(self, layer, channel):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.2)
+
+    async def test_group_send_and_send_reach_the_other_process(self):
+        async with self.running_broker() as broker:
+            first, second = await self.connect(broker)
+            local = await self.join(broker, first, "room_A")
+            remote = await self.join(broker, second, "room_A")
+            await first.group_send("room_A", {"type": "game.update", "available": {1: 0}})
+            # Tipi Python conservati: chiavi intere comprese.
+            self.assertEqual(await self.receive(second, remote), {"type": "game.update", "available": {1: 0}})
+            self.assertEqual((await self.receive(first, local))["available"], {1: 0})
+            await second.send(local, {"type": "ack", "n": 1})
+            self.assertEqual(await self.receive(first, local), {"type": "ack", "n": 1})
+            # Un frame per processo, non uno per canale: il mittente si consegna da solo.
+            self.assertEqual(broker.forwarded, 2)
+
+    async def test_group_discard_stops_delivery(self):
+        async with self.running_broker() as broker:
+            first, second = await self.connect(broker)
+            channel = await self.join(broker, second, "room_B")
+            await second.group_discard("room_B", channel)
+            await self.wait_until(lambda: "room_B" not in broker.groups)
+            await first.group_send("room_B", {"type": "game.update"})
+            await self.assert_nothing(second, channel)
+            self.assertEqual(broker.forwarded, 0)
+
+    async def test_group_membership_expires(self):
+        async with self.running_broker(group_expiry=0.2) as broker:
+            first, second = await self.connect(broker, group_expiry=0.2)
+            channel = await self.join(broker, second, "room_C")
+            await asyncio.sleep(0.3)
+            await first.group_send("room_C", {"type": "game.update"})
+            await self.assert_nothing(second, channel)
+            self.assertEqual(second.local_members("room_C"), [])
+            self.assertNotIn(channel, broker.groups.get("room_C", {}))
+
+    async def test_expired_messages_are_dropped_and_the_channel_leaves_its_groups(self):
+        async with self.running_broker() as broker:
+            first, second = await self.connect(broker, expiry=0.1)
+            channel = await self.join(broker, second, "room_D")
+            await first.group_send("room_D", {"type": "game.update"})
+            await self.wait_until(lambda: channel in second.channels)
+            await asyncio.sleep(0.2)
+            await self.assert_nothing(second, channel)
+            # Messaggi scaduti: il canale è considerato chiuso, anche per il broker.
+            await self.wait_until(lambda: "room_D" not in broker.groups)
+            self.assertNotIn("room_D", second.groups)
+
+    async def test_full_channel_drops_remote_messages(self):
+        async with self.running_broker() as broker:
+            first, second = await self.connect(broker, capacity=2)
+            channel = await self.join(broker, second, "room_E")
+            for n in range(3):
+                await first.group_send("room_E", {"type": "game.update", "n": n})
+            await self.wait_until(lambda: second.dropped == 1)
+            self.assertEqual([(await self.receive(second, channel))["n"] for _ in range(2)], [0, 1])
+            # In locale il canale pieno è un errore per chi invia, come nell'in-memory.
+            await second.send(channel, {"type": "a"})
+            await second.send(channel, {"type": "b"})
+            with self.assertRaises(ChannelFull):
+                await second.send(channel, {"type": "c"})
+
+    async def test_groups_are_announced_again_after_a_broker_restart(self):
+        async with self.running_broker() as broker:
+            first, second = await self.connect(broker, reconnect_delay=0.05)
+            channel = await self.join(broker, second, "room_F")
+        async with self.running_broker() as broker:
+            await self.wait_until(lambda: {first.client_id, second.client_id} <= set(broker.clients))
+            await self.wait_until(lambda: channel in broker.groups.get("room_F", {}))
+            await first.group_send("room_F", {"type": "game.update"})
+            self.assertEqual(await self.receive(second, channel), {"type": "game.update"})
+
+
+class HashRingTests(SimpleTestCase):
+    keys = [f"R{n:05d}" for n in range(10000)]
+
+    def owners(self, ring):
+        return {key: ring.owner(key) for key in self.keys}
+
+    def test_owner_does_not_depend_on_the_ring_instance(self):
+        ring = HashRing(["w0", "w1", "w2", "w3"])
+        self.assertEqual(self.owners(ring), self.owners(HashRing(["w3", "w1", "w0", "w2"])))
+        self.assertEqual(set(self.owners(ring).values()), {"w0", "w1", "w2", "w3"})
+        self.assertIsNone(HashRing().owner("R00000"))
+
+    def test_adding_or_removing_a_node_moves_about_one_nth_of_the_keys(self):
+        ring = HashRing(["w0", "w1", "w2", "w3"])
+        before = self.owners(ring)
+        ring.add("w4")
+        after = self.owners(ring)
+        moved = [key for key in self.keys if before[key] != after[key]]
+        # Si spostano solo le chiavi che passano al nuovo nodo, circa 1/5.
+        self.assertEqual({after[key] for key in moved}, {"w4"})
+        self.assertAlmostEqual(len(moved) / len(self.keys), 1 / 5, delta=0.06)
+        ring.remove("w1")
+        removed = self.owners(ring)
+        moved = [key for key in self.keys if after[key] != removed[key]]
+        self.assertEqual({after[key] for key in moved}, {"w1"})
+        self.assertAlmostEqual(len(moved) / len(self.keys), 1 / 5, delta=0.06)
+
+    def test_room_code_from_http_and_websocket_paths(self):
+        self.assertEqual(room_code_of("/stanza/ab12cd/gioco/state/"), "AB12CD")
+        self.assertEqual(room_code_of("/ws/stanza/AB12CD/gioco/"), "AB12CD")
+        for path in ("/", "/admin/", "/static/app.js", "/stanza/", "/api/stanza/AB12CD/"):
+            self.assertIsNone(room_code_of(path))
+
+
+class AffinityProxyTests(SimpleTestCase):
+    """Proxy davanti a due worker finti che rispondono con il proprio nome e la richiesta ricevuta."""
+
+    def setUp(self):
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.directory = directory
+
+    async def worker(self, node):
+        async def handle(reader, writer):
+            try:
+                while True:
+                    head = RequestHead(await reader.readuntil(b"\r\n\r\n"))
+                    body = await reader.readexactly(head.content_length)
+                    payload = json.dumps(
+                        {
+                            "node": node,
+                            "path": head.path,
+                            "body": body.decode(),
+                            "forwarded_for": head.headers.get("x-forwarded-for"),
+                        }
+                    ).encode()
+                    writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(payload), payload))
+                    await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+
+        path = os.path.join(self.directory, f"{node}.sock")
+        return path, await asyncio.start_unix_server(handle, path)
+
+    @asynccontextmanager
+    async def running_proxy(self, nodes):
+        proxy = AffinityProxy()
+        servers = []
+        for node in nodes:
+            path, server = await self.worker(node)
+            proxy.add(node, path)
+            servers.append(server)
+        server = await proxy.serve("127.0.0.1", 0)
+        try:
+            yield proxy, await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+        finally:
+            server.close()
+            await proxy.close()
+            for worker in servers:
+                worker.close()
+                await worker.wait_closed()
+
+    async def request(self, client, path, body=b""):
+        reader, writer = client
+        method = "POST" if body else "GET"
+        writer.write(f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        head = RequestHead(await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 2))
+        return json.loads(await reader.readexactly(head.content_length))
+
+    def rooms_on(self, ring, count=2):
+        """Un codice stanza per ognuno dei primi ``count`` nodi dell'anello."""
+        rooms = {}
+        for n in range(1000):
+            rooms.setdefault(ring.owner(f"R{n:05d}"), f"R{n:05d}")
+            if len(rooms) == count:
+                return rooms
+        self.fail("anello sbilanciato")
+
+    async def test_requests_go_to_the_room_owner(self):
+        async with self.running_proxy(["w0", "w1"]) as (proxy, client):
+            rooms = self.rooms_on(proxy.ring)
+            for node, code in rooms.items():
+                response = await self.request(client, f"/stanza/{code.lower()}/gioco/rispondi/", b"option=A")
+                self.assertEqual(response["node"], node)
+                self.assertEqual(response["path"], f"/stanza/{code.lower()}/gioco/rispondi/")
+                self.assertEqual(response["body"], "option=A")
+                self.assertEqual(response["forwarded_for"], "127.0.0.1")
+                self.assertEqual(proxy.route(f"/ws/stanza/{code}/"), node)
+
+    async def test_keep_alive_connection_switches_rooms(self):
+        async with self.running_proxy(["w0", "w1"]) as (proxy, client):
+            (first_node, first), (second_node, second) = self.rooms_on(proxy.ring).items()
+            self.assertEqual((await self.request(client, f"/stanza/{first}/gioco/state/"))["node"], first_node)
+            self.assertEqual((await self.request(client, f"/stanza/{second}/gioco/state/"))["node"], second_node)
+            # Senza stanza resta sul worker dell'ultima richiesta.
+            self.assertEqual((await self.request(client, "/static/app.js"))["node"], second_node)
+            self.assertEqual((await self.request(client, f"/stanza/{first}/gioco/state/"))["node"], first_node)
+
+
+class MigrationTestCase(TransactionTestCase):
+    """Migrazione dati eseguita sui modelli storici: da ``migrate_from`` a ``migrate_to``."""
+
+    migrate_from = None
+    migrate_to = None
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        self.latest = executor.loader.graph.leaf_nodes("lobby")
+        executor.migrate([("lobby", self.migrate_from)])
+        self.apps = executor.loader.project_state([("lobby", self.migrate_from)]).apps
+        self.addCleanup(self.migrate, self.latest)
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+
+class BoardMaskMigrationTests(MigrationTestCase):
+    migrate_from = "0010_question_fingerprint"
+    migrate_to = "0011_game_board_mask"
+
+    def test_fills_mask_and_turn_count_from_turns(self):
+        Question = self.apps.get_model("lobby", "Question")
+        Room = self.apps.get_model("lobby", "Room")
+        Player = self.apps.get_model("lobby", "Player")
+        Game = self.apps.get_model("lobby", "Game")
+        GameTurn = self.apps.get_model("lobby", "GameTurn")
+        room = Room.objects.create(code="MASK01")
+        player = Player.objects.create(room=room, nickname="P0", icon="volpe", session_key="s")
+        game = Game.objects.create(room=room)
+        for category, level in (("storia", 1), ("geografia", 5)):
+            question = Question.objects.create(
+                category=category, difficulty=level, text="t", option_a="a", option_b="b", option_c="c", correct_option="A"
+            )
+            GameTurn.objects.create(game=game, player=player, question=question)
+        apps = self.migrate([("lobby", self.migrate_to)])
+        game = apps.get_model("lobby", "Game").objects.get(pk=game.pk)
+        self.assertEqual(game.asked_mask, 1 << 0 | 1 << 24)
+        self.assertEqual(game.turns_played, 2)
+
+
+class TurnRingMigrationTests(MigrationTestCase):
+    migrate_from = "0011_game_board_mask"
+    migrate_to = "0012_game_turn_ring"
+
+    def test_fills_ring_and_cursor_from_players(self):
+        Room = self.apps.get_model("lobby", "Room")
+        Player = self.apps.get_model("lobby", "Player")
+        Game = self.apps.get_model("lobby", "Game")
+        GamePlayer = self.apps.get_model("lobby", "GamePlayer")
+        room = Room.objects.create(code="RING01")
+        players = [
+            Player.objects.create(room=room, nickname=f"P{seat}", icon=icon, session_key=f"s{seat}")
+            for seat, icon in enumerate(("volpe", "gatto", "cane"))
+        ]
+        game = Game.objects.create(room=room, current_player=players[0])
+        # Ordine di gioco diverso da quello delle pk.
+        for order, player in enumerate((players[2], players[0], players[1])):
+            GamePlayer.objects.create(game=game, player=player, order=order)
+        other = Game.objects.create(room=Room.objects.create(code="RING02"))
+        apps = self.migrate([("lobby", self.migrate_to)])
+        Game = apps.get_model("lobby", "Game")
+        game = Game.objects.get(pk=game.pk)
+        self.assertEqual(game.turn_order, [players[2].pk, players[0].pk, players[1].pk])
+        self.assertEqual(game.turn_cursor, 1)
+        # Partita senza giocatori: anello vuoto, cursore al default.
+        other = Game.objects.get(pk=other.pk)
+        self.assertEqual((other.turn_order, other.turn_cursor), ([], 0))
+
+
+class FingerprintMigrationTests(MigrationTestCase):
+    migrate_from = "0009_question_import_job"
+    migrate_to = "0010_question_fingerprint"
+
+    def test_fills_the_same_fingerprint_as_the_model(self):
+        Question = self.apps.get_model("lobby", "Question")
+        fields = dict(category="storia", difficulty=2, text="  Chi  fondò ROMA? ", option_a="Romolo", option_b="Remo", option_c="Numa")
+        pk = Question.objects.create(correct_option="A", **fields).pk
+        apps = self.migrate([("lobby", self.migrate_to)])
+        self.assertEqual(apps.get_model("lobby", "Question").objects.get(pk=pk).fingerprint, question_fingerprint(**fields))
@@ -0,0 +1,139 @@
+"""Ruota di timer gerarchica per l'event loop del processo.
+
+Decine di migliaia di scadenze (una per stanza) costano un solo task asyncio: ``call_later``
+e ``Timer.cancel`` sono O(1), e il task si sveglia una volta per tick, non una per timer.
+Ogni livello ha ``slots`` caselle; una casella del livello ``n`` copre ``slots**n`` tick e,
+quando il livello sotto compie un giro, i suoi timer scendono verso il livello 0, dove scadono.
+Un timer non scatta mai prima del suo istante: al più un tick dopo, più il ritardo del loop.
+"""
+
+import asyncio
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    """Scadenza registrata sulla ruota; ``cancel`` la toglie dalla sua casella."""
+
+    __slots__ = ("when", "tick", "callback", "args", "slot", "wheel")
+
+    def __init__(self, wheel, when, tick, callback, args):
+        self.wheel = wheel
+        self.when = when
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        if self.slot is not None:
+            del self.slot[self]
+            self.slot = None
+            self.wheel.pending -= 1
+
+    def cancelled(self):
+        return self.slot is None
+
+
+class TimerWheel:
+    """Timer di un event loop su ``levels`` ruote di ``slots`` caselle (potenza di 2) da ``tick`` secondi."""
+
+    def __init__(self, tick=0.1, slots=64, levels=4):
+        if slots & (slots - 1):
+            raise ValueError("slots deve essere una potenza di 2")
+        self.tick = tick
+        self.bits = slots.bit_length() - 1
+        self.mask = slots - 1
+        self.horizon = slots**levels
+        # Ogni casella è un dict usato come insieme ordinato: aggiunta e rimozione O(1).
+        self.wheels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.pending = 0
+        self.fired = 0
+        self.loop = None
+        self.origin = 0.0
+        self.current = 0  # prossimo tick da elaborare
+        self._task = None
+
+    def call_later(self, delay, callback, *args):
+        """Chiama ``callback(*args)`` dopo ``delay`` secondi; dal thread dell'event loop."""
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # Primo uso, o un loop nuovo (test, benchmark): la ruota riparte vuota.
+            self.reset(loop)
+        now = loop.time()
+        if not self.pending:
+            # Ruota ferma: si riparte dal tick corrente invece di recuperare quelli passati a vuoto.
+            self.current = max(self.current, self.tick_at(now))
+        when = now + max(delay, 0.0)
+        timer = Timer(self, when, max(math.ceil((when - self.origin) / self.tick), self.current), callback, args)
+        self.place(timer)
+        self.pending += 1
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self.run())
+        return timer
+
+    def reset(self, loop):
+        for wheel in self.wheels:
+            for slot in wheel:
+                for timer in slot:
+                    timer.slot = None
+                slot.clear()
+        self.loop = loop
+        self.origin = loop.time()
+        self.current = 0
+        self.pending = 0
+        self._task = None
+
+    def tick_at(self, now):
+        # Margine per l'arrotondamento: svegliandosi all'istante esatto del tick lo si elabora subito.
+        return int((now - self.origin) / self.tick + 1e-6)
+
+    def place(self, timer):
+        delta = min(timer.tick - self.current, self.horizon - 1)
+        tick = self.current + delta
+        level = 0
+        while delta >> (self.bits * (level + 1)):
+            level += 1
+        slot = self.wheels[level][(tick >> (self.bits * level)) & self.mask]
+        slot[timer] = None
+        timer.slot = slot
+
+    def advance(self, now):
+        """Elabora tutti i tick fino a ``now`` compreso: discese tra i livelli e timer scaduti."""
+        target = self.tick_at(now)
+        while self.current <= target and self.pending:
+            tick = self.current
+            # Dall'alto verso il basso: i timer scesi da un livello finiscono in caselle non ancora elaborate.
+            cascade = 0
+            while cascade + 1 < len(self.wheels) and not tick & ((1 << (self.bits * (cascade + 1))) - 1):
+                cascade += 1
+            for level in range(cascade, 0, -1):
+                slot = self.wheels[level][(tick >> (self.bits * level)) & self.mask]
+                if slot:
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        self.place(timer)
+            slot = self.wheels[0][tick & self.mask]
+            self.current = tick + 1
+            if not slot:
+                continue
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                timer.slot = None
+            self.pending -= len(timers)
+            for timer in timers:
+                self.fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logger.exception("timer wheel callback failed")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while self.pending:
+            await asyncio.sleep(max(self.origin + self.current * self.tick - loop.time(), 0))
+            self.advance(loop.time())
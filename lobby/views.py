@@ -1,25 +1,49 @@
+import asyncio
 import base64
+import hashlib
+import json
 import logging
 import random
+from contextlib import contextmanager, nullcontext
 from io import BytesIO
 
 import qrcode
 from django.utils import timezone
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from channels.layers import get_channel_layer
-from django.db import IntegrityError, transaction
-from django.db.models import Count, F
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import get_object_or_404, redirect, render
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import IntegrityError, connection, transaction
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404, redirect, render
 from django.urls import reverse
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.http import require_GET, require_POST
 
+from .cache import game_snapshots, room_snapshots, state_versions
+from .db_executor import db_executor
+from .engine import (
+    ActionRejected,
+    GameEngine,
+    StaleGame,
+    game_engines,
+    game_flusher,
+    iso,
+    parse_time,
+    stale_rejection,
+    turn_deadlines,
+)
 from .forms import ICON_CHOICES, ICON_EMOJIS, ICON_LABELS, JoinForm
-from .models import Game, GamePlayer, GameQuestion, GameTurn, Player, Question, Room
+from .models import Game, GameEvent, GamePlayer, GameQuestion, Player, Question, Room, TurnAnswer
+from .patches import game_patch
+from .sampling import BOARD_SLOTS, sample_board
+from .subscriptions import GroupSubscription
 
 MAX_PLAYERS = 10
-REQUIRED_COMBINATIONS = [(category, level) for category, _ in Question.CATEGORY_CHOICES for level in range(1, 6)]
-QUESTIONS_PER_GAME = len(REQUIRED_COMBINATIONS)
+REQUIRED_COMBINATIONS = BOARD_SLOTS
+# Query per caricare il motore di una partita: ultimo checkpoint, coda del log, generazione del banco e record
+# mancanti. Il controllo della generazione salta se fatto da poco, quindi è un tetto, non un conteggio esatto.
+GAME_STATE_MAX_QUERIES = 4
 logger = logging.getLogger(__name__)
 
 
@@ -27,37 +51,29 @@ def broadcast_room_state(room):
     channel_layer = get_channel_layer()
     if channel_layer is None:
         return
-    players = list(room.players.all())
-    host = players[0] if players else None
-    data_players = [
-        {
-            "nickname": player.nickname,
-            "icon": player.icon,
-            "icon_display": f"{ICON_EMOJIS[player.icon]} {ICON_LABELS[player.icon]}",
-            "is_host": host == player,
-        }
-        for player in players
-    ]
+    snapshot = get_room_snapshot(room)
+    # Il messaggio porta lo snapshot già pronto: i consumer aggiungono solo i flag per-sessione.
     async_to_sync(channel_layer.group_send)(
         f"room_{room.code}",
         {
             "type": "room_update",
-            "data": {
-                "type": "room_state",
-                "room": room.code,
-                "players_count": len(players),
-                "max_players": MAX_PLAYERS,
-                "can_start": len(players) >= 2,
-                "host": host.nickname if host else None,
-                "host_is_me": False,
-                "players": data_players,
-                "started": room.started,
-            },
+            "snapshot": snapshot,
         },
     )
 
 
-def broadcast_game_state(room):
+def broadcast_game_state(room, loop=None):
+    snapshot = get_game_snapshot(room)
+    if loop is None or not loop.is_running():
+        async_to_sync(abroadcast_game_state)(room, snapshot)
+        return
+    # Da un thread fuori dalla richiesta (il flusher) si passa dal loop del server: il channel
+    # layer in memoria non sveglia un loop diverso da quello su cui i consumer sono in attesa.
+    asyncio.run_coroutine_threadsafe(abroadcast_game_state(room, snapshot), loop).result()
+
+
+async def abroadcast_game_state(room, snapshot):
+    """Invia lo snapshot al gruppo della stanza; dalle view async, senza passare da un thread."""
     channel_layer = get_channel_layer()
     if channel_layer is None:
         logger.warning("broadcast_game_state skipped: no channel layer", extra={"room": room.code})
@@ -66,20 +82,108 @@ def broadcast_game_state(room):
         "Broadcasting game state",
         extra={"room": room.code, "ts": timezone.now().isoformat(), "group": f"room_{room.code}"},
     )
-    async_to_sync(channel_layer.group_send)(
+    await channel_layer.group_send(
         f"room_{room.code}",
         {
             "type": "game_update",
-            "data": build_game_state(room),
+            "snapshot": snapshot,
         },
     )
 
 
+def get_room_snapshot(room):
+    state_versions.observe(("room", room.code), room.version)
+    return room_snapshots.get_or_build(room.pk, room.version, lambda: build_room_snapshot(room))
+
+
+def build_room_snapshot(room):
+    players = list(room.players.all())
+    host = players[0] if players else None
+    payload = {
+        "type": "room_state",
+        "room": room.code,
+        "version": room.version,
+        "players_count": len(players),
+        "max_players": MAX_PLAYERS,
+        "can_start": len(players) >= 2,
+        "host": host.nickname if host else None,
+        "host_is_me": False,
+        "players": [
+            {
+                "nickname": player.nickname,
+                "icon": player.icon,
+                "icon_display": f"{ICON_EMOJIS[player.icon]} {ICON_LABELS[player.icon]}",
+                "is_host": host == player,
+                "is_me": False,
+            }
+            for player in players
+        ],
+        "join_url": reverse("join_room", args=[room.code]),
+        "started": room.started,
+    }
+    return {"state": payload, "sessions": [player.session_key for player in players]}
+
+
+def personalise_room_state(snapshot, session_key=None):
+    payload = dict(snapshot["state"])
+    if not session_key:
+        return payload
+    sessions = snapshot["sessions"]
+    payload["players"] = [
+        dict(row, is_me=row_session == session_key) for row, row_session in zip(payload["players"], sessions)
+    ]
+    payload["host_is_me"] = bool(sessions) and sessions[0] == session_key
+    return payload
+
+
 def ensure_session(request):
     if not request.session.session_key:
         request.session.create()
 
 
+async def aensure_session(request):
+    if not request.session.session_key:
+        await sync_to_async(request.session.create)()
+    return request.session.session_key
+
+
+def state_etag(prefix, key, version, session_key):
+    # La sessione entra nell'ETag: il payload contiene i flag is_me/actions di chi chiede.
+    digest = hashlib.blake2s((session_key or "").encode(), digest_size=4).hexdigest()
+    return quote_etag(f"{prefix}{key}-{version}-{digest}")
+
+
+def etag_matches(request, etag):
+    return etag in parse_etags(request.headers.get("If-None-Match", ""))
+
+
+def state_response(payload, etag):
+    response = JsonResponse(payload)
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def not_modified(etag):
+    response = HttpResponseNotModified()
+    response["ETag"] = etag
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def parse_long_poll(request):
+    """Legge ?wait=<versione>&timeout=<secondi>; (None, 0) se il client non chiede il long-poll."""
+    try:
+        wait = int(request.GET["wait"])
+    except (KeyError, ValueError):
+        return None, 0
+    try:
+        timeout = float(request.GET.get("timeout", settings.LONG_POLL_TIMEOUT))
+    except ValueError:
+        timeout = settings.LONG_POLL_TIMEOUT
+    return wait, max(0.0, min(timeout, settings.LONG_POLL_MAX_TIMEOUT))
+
+
 def create_room(request):
     ensure_session(request)
     room = Room.objects.create()
@@ -179,6 +283,7 @@ def room_view(request, code):
             "is_host": is_host,
             # Relative URL evita mixed content dietro tunnel HTTPS.
             "state_url": reverse("room_state", args=[room.code]),
+            "events_url": reverse("room_events", args=[room.code]),
             "entry_url": entry_url,
             "start_url": reverse("start_game", args=[room.code]),
             "game_url": reverse("game_view", args=[room.code]),
@@ -194,42 +299,26 @@ def build_qr_data_url(join_url):
     return f"data:image/png;base64,{encoded}"
 
 
-@require_GET
-def room_state(request, code):
-    ensure_session(request)
-    room = get_object_or_404(Room, code=code)
-    players = list(room.players.all())
-    host = players[0] if players else None
-    players_count = len(players)
-    can_start = players_count >= 2
-    me_session = request.session.session_key
-
-    host_is_me = host.session_key == me_session if host else False
+async def aget_room_version(code, session_key):
+    room = await aget_object_or_404(Room, code=code)
+    return room, room.version, state_etag("r", room.pk, room.version, session_key)
 
-    data_players = []
-    for player in players:
-        data_players.append(
-            {
-                "nickname": player.nickname,
-                "icon": player.icon,
-                "icon_display": f"{ICON_EMOJIS[player.icon]} {ICON_LABELS[player.icon]}",
-                "is_host": host == player,
-                "is_me": player.session_key == me_session,
-            }
-        )
 
-    return JsonResponse(
-        {
-            "room": room.code,
-            "players_count": players_count,
-            "max_players": MAX_PLAYERS,
-            "can_start": can_start,
-            "started": room.started,
-            "host": host.nickname if host else None,
-            "host_is_me": host_is_me,
-            "players": data_players,
-        }
-    )
+@require_GET
+async def room_state(request, code):
+    session_key = await aensure_session(request)
+    wait, timeout = parse_long_poll(request)
+    # Iscrizione al gruppo prima della lettura: un aggiornamento nel mezzo non va perso.
+    async with (GroupSubscription(f"room_{code}") if wait is not None else nullcontext()) as subscription:
+        room, version, etag = await aget_room_version(code, session_key)
+        if subscription and version == wait:
+            if await subscription.receive_type("room_update", timeout) is None:
+                return not_modified(etag)
+            room, version, etag = await aget_room_version(code, session_key)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    snapshot = await sync_to_async(get_room_snapshot)(room)
+    return state_response(personalise_room_state(snapshot, session_key), etag)
 
 
 def join_room(request, code):
@@ -258,6 +347,7 @@ def join_room(request, code):
                     icon=form.cleaned_data["icon"],
                     session_key=session_key,
                 )
+                room.bump_version()
                 broadcast_room_state(room)
                 return redirect("join_room", code=room.code)
             except IntegrityError:
@@ -288,10 +378,13 @@ def join_room(request, code):
             "host": host,
             # Relative URL evita mixed content dietro tunnel HTTPS.
             "state_url": reverse("room_state", args=[room.code]),
+            "events_url": reverse("room_events", args=[room.code]),
             "entry_url": entry_url,
             "can_start": can_start,
             "leave_url": reverse("leave_room", args=[room.code]),
             "start_url": reverse("start_game", args=[room.code]),
+            "rotation_choices": Game.ROTATION_CHOICES,
+            "answer_choices": Game.ANSWER_CHOICES,
             "game_url": reverse("game_view", args=[room.code]),
         },
     )
@@ -304,8 +397,10 @@ def leave_room(request, code):
     session_key = request.session.session_key
     if room.started:
         return redirect("game_view", code=room.code)
-    room.players.filter(session_key=session_key).delete()
-    broadcast_room_state(room)
+    deleted, _ = room.players.filter(session_key=session_key).delete()
+    if deleted:
+        room.bump_version()
+        broadcast_room_state(room)
     return redirect("join_room", code=room.code)
 
 
@@ -324,16 +419,16 @@ def start_game(request, code):
     if len(players) < 2:
         return redirect("room", code=room.code)
     first_player = random.choice(players)
+    rotation_mode = request.POST.get("rotation_mode") or Game.ROTATION_EVERY_TURN
+    if rotation_mode not in dict(Game.ROTATION_CHOICES):
+        return HttpResponse("Modalità di rotazione dei turni non valida.", status=400)
+    answer_mode = request.POST.get("answer_mode") or Game.ANSWER_SINGLE
+    if answer_mode not in dict(Game.ANSWER_CHOICES):
+        return HttpResponse("Modalità di risposta non valida.", status=400)
 
     chosen_ids = []
     missing_slots = []
-    for category, level in REQUIRED_COMBINATIONS:
-        qid = (
-            Question.objects.filter(is_active=True, category=category, difficulty=level)
-            .order_by("?")
-            .values_list("id", flat=True)
-            .first()
-        )
+    for (category, level), qid in sample_board(REQUIRED_COMBINATIONS).items():
         if qid:
             chosen_ids.append(qid)
         else:
@@ -346,23 +441,52 @@ def start_game(request, code):
             status=400,
         )
 
-    with transaction.atomic():
-        Game.objects.filter(room=room).delete()
-        game = Game.objects.create(room=room, current_player=first_player, state=Game.STATE_CHOOSING)
-        for idx, player in enumerate(players):
-            GamePlayer.objects.create(game=game, player=player, order=idx)
-        questions = Question.objects.filter(id__in=chosen_ids)
-        for q in questions:
-            GameQuestion.objects.create(game=game, question=q)
-        room.started = True
-        room.started_at = timezone.now()
-        room.save(update_fields=["started", "started_at"])
-
+    create_game(room, players, first_player, chosen_ids, rotation_mode, answer_mode)
     broadcast_room_state(room)
     broadcast_game_state(room)
     return redirect("game_view", code=room.code)
 
 
+@transaction.atomic
+def create_game(
+    room,
+    players,
+    first_player,
+    question_ids,
+    rotation_mode=Game.ROTATION_EVERY_TURN,
+    answer_mode=Game.ANSWER_SINGLE,
+):
+    """Crea la partita della stanza con i giocatori in ordine di ingresso e chiude la stanza."""
+    Game.objects.filter(room=room).delete()
+    game = Game.objects.create(
+        room=room,
+        current_player=first_player,
+        state=Game.STATE_CHOOSING,
+        turn_order=[player.id for player in players],
+        turn_cursor=players.index(first_player),
+        rotation_mode=rotation_mode,
+        answer_mode=answer_mode,
+    )
+    GamePlayer.objects.bulk_create(GamePlayer(game=game, player=player, order=idx) for idx, player in enumerate(players))
+    # Gli id arrivano dall'indice in memoria: nessuna rilettura delle domande. L'ordine delle pk è
+    # quello di estrazione, lo stesso dell'evento ``started`` (``GameEngine.from_rows`` lo rilegge così).
+    GameQuestion.objects.bulk_create(GameQuestion(game=game, question_id=qid) for qid in question_ids)
+    GameEngine.started_event(game, players, question_ids).save()
+    room.started = True
+    room.started_at = timezone.now()
+    room.save(update_fields=["started", "started_at"])
+    room.bump_version()
+    # Un motore della partita precedente non deve sopravvivere alla nuova.
+    transaction.on_commit(lambda: game_engines.discard(room.code))
+    return game
+
+
+@staff_member_required
+def db_executor_stats(request):
+    """Code e contatori del pool DB di questo processo (solo staff)."""
+    return JsonResponse(db_executor.stats())
+
+
 def game_view(request, code):
     ensure_session(request)
     room = get_object_or_404(Room, code=code)
@@ -374,195 +498,418 @@ def game_view(request, code):
         {
             "room": room,
             "state_url": reverse("game_state", args=[room.code]),
+            "events_url": reverse("game_events", args=[room.code]),
             "choose_url": reverse("choose_question", args=[room.code]),
             "answer_url": reverse("submit_answer", args=[room.code]),
         },
     )
 
 
+async def aget_game_version(code, session_key):
+    room = await aget_object_or_404(Room.objects.select_related("game"), code=code)
+    game = getattr(room, "game", None) if room.started else None
+    # Con il write-behind il DB può essere indietro: conta la versione del motore in memoria.
+    version = game_engines.version_of(room, game) if game else 0
+    return room, version, state_etag("g", game.pk if game else 0, version, session_key)
+
+
 @require_GET
-def game_state(request, code):
-    ensure_session(request)
-    room = get_object_or_404(Room, code=code)
-    return JsonResponse(build_game_state(room, session_key=request.session.session_key))
+async def game_state(request, code):
+    session_key = await aensure_session(request)
+    wait, timeout = parse_long_poll(request)
+    async with (GroupSubscription(f"room_{code}") if wait is not None else nullcontext()) as subscription:
+        room, version, etag = await aget_game_version(code, session_key)
+        if subscription and version == wait:
+            # Long-poll: la richiesta resta aperta finché arriva un game_update o scade il timeout.
+            if await subscription.receive_type("game_update", timeout) is None:
+                return not_modified(etag)
+            room, version, etag = await aget_game_version(code, session_key)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    snapshot = await sync_to_async(get_game_snapshot)(room)
+    watch_turn_deadline(room.code)
+    return state_response(personalise_game_state(snapshot, session_key), etag)
 
 
-@require_POST
-def choose_question(request, code):
-    ensure_session(request)
-    room = get_object_or_404(Room, code=code)
-    game = get_object_or_404(Game, room=room)
-    if game.state == Game.STATE_FINISHED:
-        logger.warning(
-            "choose_question rejected: game finished",
-            extra={"room": room.code, "session": request.session.session_key},
-        )
-        return JsonResponse({"error": "La partita è già terminata."}, status=400)
-    current_player = game.current_player
-    if not current_player or current_player.session_key != request.session.session_key:
-        logger.info(
-            "choose_question rejected: not current player",
-            extra={
-                "room": room.code,
-                "session": request.session.session_key,
-                "current_player": getattr(current_player, "session_key", None),
-            },
-        )
-        return JsonResponse({"error": "Non è il tuo turno."}, status=403)
+@require_GET
+def game_history(request, code):
+    """Log degli eventi della partita, per riepiloghi e debug; senza chiavi di sessione."""
+    room = get_object_or_404(Room.objects.select_related("game"), code=code)
+    game = getattr(room, "game", None)
+    if game is None:
+        return JsonResponse({"error": "Partita non trovata."}, status=404)
+    engine = game_engines.cached(room.code)
+    # Con il write-behind la coda del log può essere ancora in memoria: si aggiunge senza forzare il
+    # salvataggio. Prima la memoria e poi il DB: un batch confermato nel frattempo è in uno dei due.
+    unsaved = engine.unsaved_events() if engine is not None and engine.game_id == game.pk else []
+    events = {event.seq: event for event in game.events.order_by("seq")}
+    for event in unsaved:
+        events.setdefault(event.seq, event)
+    rows = [
+        {
+            "seq": event.seq,
+            "version": event.version,
+            "kind": event.kind,
+            "at": event.created_at.isoformat(),
+            "data": public_event_data(event),
+        }
+        for _, event in sorted(events.items())
+    ]
+    return JsonResponse({"room": room.code, "events": rows})
+
+
+def public_event_data(event):
+    if event.kind != GameEvent.KIND_STARTED:
+        return event.data
+    data = {key: value for key, value in event.data.items() if key not in ("seats", "absent")}
+    data["players"] = [{"id": row[0], "nickname": row[1], "icon": row[2]} for row in event.data["seats"]]
+    return data
+
+
+def sse_event(event, data, event_id=None):
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
 
-    category = request.POST.get("category")
-    difficulty = request.POST.get("difficulty")
+
+def event_stream_response(events):
+    response = StreamingHttpResponse(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Senza questo nginx accumula lo stream nel buffer e gli eventi arrivano a blocchi.
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def parse_last_event_id(request):
+    """Versione da cui riprende lo stream: header Last-Event-ID (riconnessione di EventSource) o ?last_event_id=."""
+    value = request.headers.get("Last-Event-ID") or request.GET.get("last_event_id", "")
     try:
-        difficulty = int(difficulty)
-    except (TypeError, ValueError):
-        logger.warning(
-            "choose_question bad difficulty",
-            extra={"room": room.code, "session": request.session.session_key, "category": category, "raw": difficulty},
-        )
-        return JsonResponse({"error": "Livello non valido."}, status=400)
+        return int(value)
+    except ValueError:
+        return None
 
-    if category not in dict(Question.CATEGORY_CHOICES):
-        logger.warning(
-            "choose_question invalid category",
-            extra={"room": room.code, "session": request.session.session_key, "category": category},
-        )
-        return JsonResponse({"error": "Materia non valida."}, status=400)
-    if difficulty not in range(1, 6):
-        return JsonResponse({"error": "Livello non valido."}, status=400)
-
-    if game.state != Game.STATE_CHOOSING:
-        logger.info(
-            "choose_question rejected: game not choosing",
-            extra={"room": room.code, "state": game.state, "session": request.session.session_key},
-        )
-        return JsonResponse({"error": "C'è già una domanda attiva."}, status=400)
-
-    with transaction.atomic():
-        qs = (
-            GameQuestion.objects.select_related("question")
-            .filter(game=game, question__category=category, question__difficulty=difficulty)
-            .exclude(question__turns__game=game)
-            .order_by("?")
-        )
-        game_question = qs.first()
-        question = game_question.question if game_question else None
-        if not question:
-            logger.info(
-                "choose_question no question available",
-                extra={"room": room.code, "category": category, "difficulty": difficulty},
-            )
-            return JsonResponse({"error": "Nessuna domanda disponibile per questa materia/livello."}, status=400)
-        turn = GameTurn.objects.create(game=game, player=current_player, question=question)
-        game.current_turn = turn
-        game.state = Game.STATE_ANSWERING
-        game.save(update_fields=["current_turn", "state"])
-        logger.info(
-            "choose_question OK",
-            extra={
-                "room": room.code,
-                "category": category,
-                "difficulty": difficulty,
-                "question_id": question.id,
-                "turn_id": turn.id,
-                "player": current_player.nickname,
-            },
-        )
 
-    broadcast_game_state(room)
-    return JsonResponse(build_game_state(room, session_key=request.session.session_key))
+@require_GET
+async def room_events(request, code):
+    session_key = await aensure_session(request)
+    await aget_object_or_404(Room, code=code)
+    return event_stream_response(room_event_stream(code, session_key, parse_last_event_id(request)))
+
+
+async def room_event_stream(code, session_key, resume):
+    yield f"retry: {settings.WS_RECONNECT_MIN_MS}\n\n"
+    async with GroupSubscription(f"room_{code}") as subscription:
+        room = await Room.objects.filter(code=code).afirst()
+        if room is None:
+            yield sse_event("not_found", {"type": "not_found"})
+            return
+        snapshot = await sync_to_async(get_room_snapshot)(room)
+        version = snapshot["state"]["version"]
+        if resume == version:
+            yield sse_event("up_to_date", {"type": "up_to_date", "version": version}, version)
+        else:
+            yield sse_event("room_state", personalise_room_state(snapshot, session_key), version)
+        while True:
+            message = await subscription.receive(settings.SSE_KEEPALIVE)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+            if message.get("type") != "room_update":
+                continue
+            snapshot = message["snapshot"]
+            if snapshot["state"]["version"] < version:
+                continue
+            version = snapshot["state"]["version"]
+            state_versions.observe(("room", code), version)
+            yield sse_event("room_state", personalise_room_state(snapshot, session_key), version)
+
+
+@require_GET
+async def game_events(request, code):
+    session_key = await aensure_session(request)
+    await aget_object_or_404(Room, code=code)
+    return event_stream_response(game_event_stream(code, session_key, parse_last_event_id(request)))
+
+
+async def game_event_stream(code, session_key, resume):
+    """Stesso protocollo del WebSocket in modalità delta: uno snapshot (o un patch in ripresa), poi solo patch."""
+    yield f"retry: {settings.WS_RECONNECT_MIN_MS}\n\n"
+    async with GroupSubscription(f"room_{code}") as subscription:
+        snapshot, previous, _ = await sync_to_async(load_game_snapshots)(code, resume)
+        if snapshot is None:
+            yield sse_event("not_found", {"type": "not_found"})
+            return
+        watch_turn_deadline(code)
+        state = personalise_game_state(snapshot, session_key)
+        version = state["version"]
+        if resume == version:
+            yield sse_event("up_to_date", {"type": "up_to_date", "version": version}, version)
+        elif previous is not None:
+            patch = game_patch(personalise_game_state(previous, session_key), state)
+            yield sse_event("game_patch", patch, version) if patch else sse_event("game_state", state, version)
+        else:
+            yield sse_event("game_state", state, version)
+        while True:
+            message = await subscription.receive(settings.SSE_KEEPALIVE)
+            if message is None:
+                yield ": keepalive\n\n"
+                continue
+            if message.get("type") != "game_update":
+                continue
+            data = personalise_game_state(message["snapshot"], session_key)
+            if data["version"] < state["version"]:
+                continue
+            state_versions.observe(("game", code), data["version"])
+            patch = game_patch(state, data)
+            state = data
+            if patch:
+                yield sse_event("game_patch", patch, data["version"])
 
 
 @require_POST
-def submit_answer(request, code):
-    ensure_session(request)
-    room = get_object_or_404(Room, code=code)
-    game = get_object_or_404(Game, room=room)
-    session_key = request.session.session_key
-    if game.state != Game.STATE_ANSWERING or not game.current_turn:
-        logger.info(
-            "submit_answer rejected: no active question",
-            extra={"room": room.code, "state": game.state, "session": session_key},
-        )
-        return JsonResponse({"error": "Nessuna domanda attiva."}, status=400)
-    if not game.current_player or game.current_player.session_key != session_key:
-        logger.info(
-            "submit_answer rejected: not current player",
-            extra={
-                "room": room.code,
-                "session": session_key,
-                "current_player": getattr(game.current_player, "session_key", None),
-            },
-        )
-        return JsonResponse({"error": "Non puoi rispondere, non è il tuo turno."}, status=403)
+async def choose_question(request, code):
+    session_key = await aensure_session(request)
+    return await action_response(perform_choose(code, session_key, request.POST), session_key)
 
-    selected = request.POST.get("option")
-    if selected not in dict(Question.OPTION_CHOICES):
-        logger.warning(
-            "submit_answer invalid option",
-            extra={"room": room.code, "session": session_key, "selected": selected},
-        )
-        return JsonResponse({"error": "Opzione non valida."}, status=400)
-
-    with transaction.atomic():
-        turn = GameTurn.objects.select_for_update().get(pk=game.current_turn_id)
-        if turn.selected_option:
-            logger.info(
-                "submit_answer rejected: already answered",
-                extra={"room": room.code, "turn_id": turn.id, "session": session_key},
-            )
-            return JsonResponse({"error": "Hai già risposto a questa domanda."}, status=400)
-        turn.selected_option = selected
-        correct = selected == turn.question.correct_option
-        turn.was_correct = correct
-        turn.answered_at = timezone.now()
-        points = turn.question.points if correct else 0
-        turn.points_awarded = points
-        turn.save(update_fields=["selected_option", "was_correct", "answered_at", "points_awarded"])
-
-        if points:
-            GamePlayer.objects.filter(game=game, player=turn.player).update(score=F("score") + points)
-        logger.info(
-            "submit_answer recorded",
-            extra={
-                "room": room.code,
-                "turn_id": turn.id,
-                "question_id": turn.question_id,
-                "player": turn.player.nickname,
-                "selected": selected,
-                "correct": correct,
-                "points": points,
-            },
+
+@require_POST
+async def submit_answer(request, code):
+    session_key = await aensure_session(request)
+    return await action_response(perform_answer(code, session_key, request.POST), session_key)
+
+
+async def action_response(action, session_key):
+    try:
+        snapshot = await action
+    except ActionRejected as exc:
+        return JsonResponse(exc.payload, status=exc.status)
+    return JsonResponse(personalise_game_state(snapshot, session_key))
+
+
+def load_game_engine(code):
+    """Motore della partita della stanza, ricaricato dal DB se manca o se il DB è più avanti."""
+    room = Room.objects.select_related("game").filter(code=code).first()
+    if room is None:
+        raise ActionRejected(404, "Stanza non trovata.")
+    game = getattr(room, "game", None)
+    if game is None:
+        raise ActionRejected(404, "Partita non trovata.")
+    with query_ceiling(GAME_STATE_MAX_QUERIES, "GameEngine.load"):
+        return game_engines.get(room, game)
+
+
+def saved_game_version(game_id):
+    return Game.objects.filter(pk=game_id).values_list("version", flat=True).first()
+
+
+async def aget_game_engine(code):
+    if settings.GAME_WRITE_BEHIND:
+        engine = game_engines.cached(code)
+        if engine is not None:
+            # Il motore in memoria vale finché il DB non è andato oltre: la stanza può essere passata
+            # a un altro worker (anello cambiato, riavvio) ed essere poi tornata qui. Una sola query sulla pk.
+            version = await db_executor.run(code, saved_game_version, engine.game_id)
+            if version is not None and version <= engine.version:
+                return engine
+    return await db_executor.run(code, load_game_engine, code)
+
+
+async def perform_choose(code, session_key, params):
+    """Scelta della casella da HTTP o dal WebSocket: applica al motore, salva, invia il broadcast e restituisce lo snapshot.
+
+    ActionRejected se l'azione non è ammessa.
+    """
+    engine = await aget_game_engine(code)
+    engine.choose(session_key, params)
+    return await commit_action(engine, "choose_question", urgent=False)
+
+
+async def perform_answer(code, session_key, params):
+    """Risposta alla domanda attiva da HTTP o dal WebSocket; come ``perform_choose``."""
+    # Istante di arrivo preso prima di ogni attesa: ordina le risposte simultanee.
+    received_at = timezone.now()
+    engine = await aget_game_engine(code)
+    if engine.answer_mode == Game.ANSWER_ALL:
+        return await perform_buzz(engine, session_key, params, received_at)
+    engine.answer(session_key, params)
+    # Turno completo: si salva subito, di solito insieme alla scelta che l'ha aperto.
+    return await commit_action(engine, "submit_answer", urgent=True)
+
+
+async def perform_buzz(engine, session_key, params, received_at):
+    """Risposta simultanea: si registra senza nuova versione né broadcast; l'ultima attesa chiude il turno.
+
+    Restituisce lo snapshot corrente, o quello del turno chiuso.
+    """
+    seat, turn, complete = engine.buzz(session_key, params, received_at)
+    if not settings.GAME_WRITE_BEHIND:
+        # Le risposte di una stanza possono arrivare a processi diversi: conta la riga sul DB.
+        complete = await db_executor.run(
+            engine.room.code, save_buzz, engine, seat, turn, params.get("option"), received_at
         )
+    if not complete:
+        return get_engine_snapshot(engine)
+    return await close_buzz_turn(engine, turn.id)
 
-        remaining_questions = (
-            GameQuestion.objects.filter(game=game)
-            .exclude(question__turns__game=game)
-            .exclude(question=turn.question)
-            .count()
+
+def save_buzz(engine, seat, turn, option, received_at):
+    """Inserisce la risposta (nessun lock di riga: il vincolo unico scarta i doppioni); True se hanno risposto tutti."""
+    try:
+        TurnAnswer.objects.create(
+            game_id=engine.game_id, turn=turn.id, player_id=seat.player_id, option=option, received_at=received_at
         )
+    except IntegrityError:
+        raise ActionRejected(400, "Hai già risposto a questa domanda.") from None
+    return TurnAnswer.objects.filter(game_id=engine.game_id, turn=turn.id).count() >= len(engine.seats)
 
-        game.current_turn = None
-        if remaining_questions <= 0:
-            game.state = Game.STATE_FINISHED
-            game.finished_at = timezone.now()
-            game.save(update_fields=["state", "finished_at", "current_turn"])
+
+def load_buzzes(engine, turn_id):
+    """Senza write-behind: le risposte arrivate agli altri processi, prima di valutare il turno."""
+    rows = TurnAnswer.objects.filter(game_id=engine.game_id, turn=turn_id).values_list(
+        "player_id", "option", "received_at"
+    )
+    engine.merge_buzzes(turn_id, rows)
+
+
+async def close_buzz_turn(engine, turn_id):
+    if not settings.GAME_WRITE_BEHIND:
+        await db_executor.run(engine.room.code, load_buzzes, engine, turn_id)
+    if not engine.close_buzz(turn_id):
+        # Chiuso nel frattempo da un'altra risposta o dalla scadenza.
+        return get_engine_snapshot(engine)
+    return await commit_action(engine, "submit_answer", urgent=True)
+
+
+async def commit_action(engine, action, urgent):
+    if settings.GAME_WRITE_BEHIND:
+        game_flusher.schedule(engine, urgent)
+    else:
+        try:
+            await db_executor.run(engine.room.code, engine.flush)
+        except StaleGame as exc:
+            game_engines.discard(engine.room.code, engine)
+            raise stale_rejection(engine.room, action, exc.version) from None
+        except Exception:
+            # Lo stato in memoria è più avanti del DB: si riparte dal DB alla prossima azione.
+            game_engines.discard(engine.room.code, engine)
+            raise
+    snapshot = get_engine_snapshot(engine)
+    await abroadcast_game_state(engine.room, snapshot)
+    turn_deadlines.arm(engine)
+    return snapshot
+
+
+def watch_turn_deadline(code):
+    """Arma la scadenza del turno se il motore della stanza è in memoria (dopo una lettura dello stato)."""
+    engine = game_engines.cached(code)
+    if engine is not None:
+        turn_deadlines.arm(engine)
+
+
+async def expire_turn(code, version):
+    """Scadenza del turno dalla ruota di timer: stessa strada di ``perform_answer``, senza sessione."""
+    try:
+        engine = await aget_game_engine(code)
+        if not settings.GAME_WRITE_BEHIND and engine.answer_mode == Game.ANSWER_ALL and engine.current_turn:
+            await db_executor.run(code, load_buzzes, engine, engine.current_turn.id)
+        if engine.expire(version):
+            await commit_action(engine, "turn_timeout", urgent=True)
         else:
-            game.state = Game.STATE_CHOOSING
-            game.save(update_fields=["state", "current_turn"])
-            game.rotate_to_next_player()
-        logger.debug(
-            "submit_answer next_state",
-            extra={"room": room.code, "state": game.state, "remaining": remaining_questions},
-        )
+            # Partita andata avanti nel frattempo, o orologio appena indietro: si riarma sullo stato attuale.
+            turn_deadlines.arm(engine)
+    except ActionRejected as exc:
+        logger.info("turn timeout skipped", extra={"room": code, "version": version, "error": exc.payload["error"]})
+    except Exception:
+        logger.exception("turn timeout failed", extra={"room": code, "version": version})
 
-    broadcast_game_state(room)
-    return JsonResponse(build_game_state(room, session_key=session_key))
+
+turn_deadlines.on_expire = expire_turn
 
 
-def build_game_state(room, session_key=None):
+def resync_game(code, loop=None):
+    """Dopo un conflitto del write-behind (dal thread del flusher): reinvia ai client lo stato ricaricato dal DB."""
+    room = Room.objects.select_related("game").filter(code=code).first()
+    if room is not None and room.started:
+        broadcast_game_state(room, loop)
+
+
+game_flusher.on_conflict = resync_game
+
+
+def get_game_snapshot(room):
+    """Snapshot indipendente dalla sessione, costruito una volta per versione della partita."""
+    game = getattr(room, "game", None)
+    if not room.started or not game:
+        return build_game_snapshot(room, None)
+    with query_ceiling(GAME_STATE_MAX_QUERIES, "GameEngine.load"):
+        engine = game_engines.get(room, game)
+    return get_engine_snapshot(engine)
+
+
+def get_engine_snapshot(engine):
+    with engine.lock:
+        state_versions.observe(("game", engine.room.code), engine.version)
+        snapshot = game_snapshots.get(engine.game_id, engine.version)
+        if snapshot is None:
+            # Dal motore in memoria, senza query: basta il lock, niente single-flight.
+            snapshot = build_game_snapshot(engine.room, engine)
+            game_snapshots.set(engine.game_id, engine.version, snapshot)
+        return snapshot
+
+
+@contextmanager
+def query_ceiling(limit, label):
+    """In DEBUG segnala nel log i blocchi che superano ``limit`` query: una regressione N+1 si vede subito."""
+    if not settings.DEBUG:
+        yield
+        return
+    count = 0
+
+    def counter(execute, sql, params, many, context):
+        nonlocal count
+        count += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(counter):
+        yield
+    if count > limit:
+        logger.warning("%s: %s query, limite %s", label, count, limit, extra={"queries": count})
+
+
+def load_game_snapshots(code, resume=None):
+    """Snapshot corrente, quello della versione ``resume`` (dalla cache o dal log) e pk della partita.
+
+    (None, None, None) se la stanza non esiste.
+    """
+    try:
+        room = Room.objects.select_related("game").get(code=code)
+    except Room.DoesNotExist:
+        return None, None, None
+    snapshot = get_game_snapshot(room)
+    game = getattr(room, "game", None)
+    if game is None:
+        return snapshot, None, None
+    previous = None
+    if resume is not None and 0 <= resume < snapshot["state"]["version"]:
+        previous = game_snapshots.get(game.pk, resume) or replay_game_snapshot(room, game, resume)
+    return snapshot, previous, game.pk
+
+
+def replay_game_snapshot(room, game, version):
+    """Snapshot di una versione passata, uscita dalla cache: ultimo checkpoint più la coda del log."""
+    with query_ceiling(GAME_STATE_MAX_QUERIES, "GameEngine.replay"):
+        engine = GameEngine.replay(room, game, version)
+    if engine is None or engine.version != version:
+        return None
+    return build_game_snapshot(room, engine)
+
+
+def build_game_snapshot(room, engine):
     payload = {
         "type": "game_state",
         "room": room.code,
+        "version": 0,
         "status": "not_started",
         "scoreboard": [],
         "current_player": None,
@@ -577,94 +924,122 @@ def build_game_state(room, session_key=None):
         "question_grid": {},
         "last_answer": None,
         "public_options": None,
+        "deadline": None,
+        "answer_mode": Game.ANSWER_SINGLE,
     }
-    game = getattr(room, "game", None)
-    if not room.started or not game:
-        return payload
-
-    game_players = list(game.players.select_related("player").order_by("order"))
-    scoreboard = []
-    for gp in game_players:
-        scoreboard.append(
+    # I campi per-sessione restano fuori dal payload pubblico: li applica personalise_game_state.
+    snapshot = {
+        "state": payload,
+        "sessions": [],
+        "current_session": None,
+        "options": None,
+        "can_choose": False,
+        "can_answer": False,
+    }
+    if engine is None:
+        return snapshot
+
+    payload["version"] = engine.version
+    # Scadenza della fase corrente: il client mostra il conto alla rovescia, il server la fa valere.
+    payload["deadline"] = iso(engine.deadline)
+    payload["answer_mode"] = engine.answer_mode
+    turns, records = engine.turns, engine.records
+    scoreboard = sorted(
+        (
             {
-                "nickname": gp.player.nickname,
-                "icon": gp.player.icon,
-                "score": gp.score,
-                "is_me": gp.player.session_key == session_key if session_key else False,
+                "nickname": seat.nickname,
+                "icon": seat.icon,
+                "score": seat.score,
+                "is_me": False,
+                "session_key": seat.session_key,
             }
-        )
-    payload["scoreboard"] = sorted(scoreboard, key=lambda s: (-s["score"], s["nickname"]))
-    payload["asked_questions"] = game.turns.count()
+            for seat in engine.seats.values()
+        ),
+        key=lambda s: (-s["score"], s["nickname"]),
+    )
+    snapshot["sessions"] = [row.pop("session_key") for row in scoreboard]
+    payload["scoreboard"] = scoreboard
+    payload["asked_questions"] = len(turns)
 
-    current_player = game.current_player
+    current_player = engine.current_player
     if current_player:
         payload["current_player"] = {
             "nickname": current_player.nickname,
             "icon": current_player.icon,
-            "is_me": current_player.session_key == session_key if session_key else False,
+            "is_me": False,
         }
+        snapshot["current_session"] = current_player.session_key
 
-    remaining_by_level = get_remaining_by_level(game)
+    remaining_by_level = engine.remaining_by_level()
     payload["available"] = remaining_by_level
-    payload["remaining_questions"] = sum(
-        count for cat_data in remaining_by_level.values() for count in cat_data.values()
-    )
+    payload["remaining_questions"] = engine.remaining_questions
     payload["question_grid"] = build_question_grid(
-        game, current_player=current_player, remaining_by_level=remaining_by_level
+        turns, records, engine.current_turn, current_player=current_player, remaining_by_level=remaining_by_level
     )
-    last_answer = get_last_answer(game)
+    last_answer = get_last_answer(turns, records, engine.seat_of)
 
-    if game.state == Game.STATE_FINISHED or payload["remaining_questions"] == 0:
+    if engine.state == Game.STATE_FINISHED or payload["remaining_questions"] == 0:
         payload["status"] = Game.STATE_FINISHED
         payload["game_over"] = True
         payload["last_answer"] = last_answer
-        return payload
+        return snapshot
 
-    payload["status"] = game.state
+    payload["status"] = engine.state
     payload["game_over"] = False
 
-    turn = game.current_turn
+    turn = engine.current_turn
     if turn:
+        question = records[turn.question_id]
         payload["current_turn_id"] = turn.id
         payload["question"] = {
             "id": turn.question_id,
-            "category": turn.question.category,
-            "category_label": turn.question.get_category_display(),
-            "difficulty": turn.question.difficulty,
-            "text": turn.question.text,
+            "category": question.category,
+            "category_label": question.get_category_display(),
+            "difficulty": question.difficulty,
+            "text": question.text,
         }
-        payload["public_options"] = turn.question.get_options()
-        if current_player and current_player.session_key == session_key:
-            payload["options"] = turn.question.get_options()
-
-    is_my_turn = bool(current_player and current_player.session_key == session_key)
-    payload["actions"] = {
-        "can_choose": is_my_turn and game.state == Game.STATE_CHOOSING and payload["remaining_questions"] > 0,
-        "can_answer": is_my_turn and game.state == Game.STATE_ANSWERING and not (turn and turn.selected_option),
-    }
+        payload["public_options"] = question.get_options()
+        snapshot["options"] = question.get_options()
+
+    snapshot["can_choose"] = engine.state == Game.STATE_CHOOSING and payload["remaining_questions"] > 0
+    snapshot["can_answer"] = engine.state == Game.STATE_ANSWERING and not (turn and turn.selected_option)
     payload["last_answer"] = last_answer
 
-    return payload
+    return snapshot
 
 
-def get_remaining_by_level(game):
-    remaining = {key: {level: 0 for level in range(1, 6)} for key, _ in Question.CATEGORY_CHOICES}
-    aggregates = (
-        GameQuestion.objects.filter(game=game)
-        .exclude(question__turns__game=game)
-        .values("question__category", "question__difficulty")
-        .annotate(count=Count("id"))
-    )
-    for item in aggregates:
-        remaining[item["question__category"]][item["question__difficulty"]] = item["count"]
-    return remaining
+def personalise_game_state(snapshot, session_key=None):
+    """Applica allo snapshot condiviso i campi che dipendono dalla sessione (is_me, options, actions).
+
+    Copia solo i livelli che modifica: il resto del payload resta condiviso e non va mutato.
+    """
+    payload = dict(snapshot["state"])
+    if not session_key:
+        return payload
+
+    payload["scoreboard"] = [
+        dict(row, is_me=row_session == session_key)
+        for row, row_session in zip(payload["scoreboard"], snapshot["sessions"])
+    ]
+    is_my_turn = snapshot["current_session"] == session_key
+    if payload["current_player"]:
+        payload["current_player"] = dict(payload["current_player"], is_me=is_my_turn)
+    # Risposta simultanea: rispondono tutti i giocatori seduti, sceglie solo chi è di turno.
+    answers_too = payload["answer_mode"] == Game.ANSWER_ALL and session_key in snapshot["sessions"]
+    if (is_my_turn or answers_too) and not payload["game_over"]:
+        payload["options"] = snapshot["options"]
+        payload["actions"] = {
+            "can_choose": snapshot["can_choose"] and is_my_turn,
+            "can_answer": snapshot["can_answer"],
+        }
+    return payload
 
 
-def build_question_grid(game, current_player=None, remaining_by_level=None):
-    remaining = remaining_by_level or get_remaining_by_level(game)
-    turns = list(game.turns.select_related("question", "player"))
-    turn_lookup = {(turn.question.category, turn.question.difficulty): turn for turn in turns}
-    current_turn = game.current_turn
+def build_question_grid(turns, records, current_turn=None, current_player=None, remaining_by_level=None):
+    remaining = remaining_by_level or {}
+    slot_of = {qid: (records[qid].category, records[qid].difficulty) for qid in (turn.question_id for turn in turns)}
+    turn_lookup = {slot_of[turn.question_id]: turn for turn in turns}
+    current_slot = slot_of[current_turn.question_id] if current_turn else None
     grid = {category: {} for category, _ in Question.CATEGORY_CHOICES}
     for category, _ in Question.CATEGORY_CHOICES:
         for level in range(1, 6):
@@ -675,7 +1050,7 @@ def build_question_grid(game, current_player=None, remaining_by_level=None):
                 "status": "available",
             }
             combo = (category, level)
-            if current_turn and current_turn.question.category == category and current_turn.question.difficulty == level:
+            if current_slot == combo:
                 cell["status"] = "active"
                 cell["turn_id"] = current_turn.id
                 if current_turn.player:
@@ -703,16 +1078,13 @@ def build_question_grid(game, current_player=None, remaining_by_level=None):
     return grid
 
 
-def get_last_answer(game):
-    last_turn = (
-        game.turns.select_related("player", "question")
-        .exclude(answered_at__isnull=True)
-        .order_by("-answered_at", "-id")
-        .first()
-    )
-    if not last_turn:
+def get_last_answer(turns, records, seat_of=None):
+    answered = [turn for turn in turns if turn.answered_at is not None]
+    if not answered:
         return None
-    options = last_turn.question.get_options()
+    last_turn = max(answered, key=lambda turn: (turn.answered_at, turn.id))
+    question = records[last_turn.question_id]
+    options = question.get_options()
     return {
         "id": last_turn.id,
         "player": {
@@ -720,16 +1092,38 @@ def get_last_answer(game):
             "icon": last_turn.player.icon,
         },
         "question": {
-            "category": last_turn.question.category,
-            "category_label": last_turn.question.get_category_display(),
-            "difficulty": last_turn.question.difficulty,
-            "text": last_turn.question.text,
+            "category": question.category,
+            "category_label": question.get_category_display(),
+            "difficulty": question.difficulty,
+            "text": question.text,
         },
         "selected_option": last_turn.selected_option,
         "selected_option_label": options.get(last_turn.selected_option),
+        "timed_out": last_turn.selected_option is None and not last_turn.answers,
         "options": options,
-        "correct_option": last_turn.question.correct_option,
+        "correct_option": question.correct_option,
         "was_correct": last_turn.was_correct,
         "answered_at": last_turn.answered_at.isoformat() if last_turn.answered_at else None,
         "points": last_turn.points_awarded,
+        "answers": get_turn_answers(last_turn, options, seat_of) if last_turn.answers is not None else None,
     }
+
+
+def get_turn_answers(turn, options, seat_of):
+    """Risposte simultanee del turno in ordine d'arrivo, con i millisecondi dall'apertura della domanda."""
+    rows = []
+    for player_id, option, received_at, correct, points, rank in turn.answers:
+        seat = seat_of(player_id) if seat_of else None
+        elapsed = parse_time(received_at) - turn.started_at
+        rows.append(
+            {
+                "player": {"nickname": getattr(seat, "nickname", None), "icon": getattr(seat, "icon", None)},
+                "option": option,
+                "option_label": options.get(option),
+                "was_correct": correct,
+                "points": points,
+                "rank": rank,
+                "ms": round(elapsed.total_seconds() * 1000),
+            }
+        )
+    return rows
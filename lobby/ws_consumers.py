@@ -1,137 +1,268 @@
 import json
+from urllib.parse import parse_qs
 
-from asgiref.sync import sync_to_async
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from django.urls import reverse
+from django.conf import settings
 
-from .forms import ICON_EMOJIS, ICON_LABELS
-from .models import Room
-from .views import MAX_PLAYERS, build_game_state
+from .cache import game_snapshots, state_versions
+from .db_executor import db_executor
+from .jobs import IMPORT_GROUP
+from .models import QuestionImportJob, Room
+from .patches import game_patch
+from .views import (
+    ActionRejected,
+    get_room_snapshot,
+    load_game_snapshots,
+    perform_answer,
+    perform_choose,
+    personalise_game_state,
+    personalise_room_state,
+    watch_turn_deadline,
+)
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def reconnect_hints():
+    # Il client sceglie il ritardo con jitter entro questi limiti, raddoppiando a ogni tentativo fallito.
+    return {"min_ms": settings.WS_RECONNECT_MIN_MS, "max_ms": settings.WS_RECONNECT_MAX_MS}
+
+
+def parse_resume(scope):
+    """Versione dichiarata dal client con ?resume=<n>, None se assente o non valida."""
+    query = parse_qs(scope.get("query_string", b"").decode())
+    try:
+        return int(query.get("resume", [""])[0])
+    except ValueError:
+        return None
+
+
+# Azioni di gioco accettate sul socket, con la stessa validazione delle view HTTP.
+GAME_ACTIONS = {"choose": perform_choose, "answer": perform_answer}
+
+
+def parse_message(text_data):
+    """Messaggio JSON del client; il vecchio ping testuale vale come ping senza versione."""
+    if text_data == "ping":
+        return {"type": "ping"}
+    try:
+        message = json.loads(text_data or "")
+    except ValueError:
+        return {}
+    return message if isinstance(message, dict) else {}
+
+
+def session_key_of(scope):
+    session = scope.get("session")
+    return session.session_key if session else None
+
+
+def load_room_snapshot(code):
+    try:
+        room = Room.objects.get(code=code)
+    except Room.DoesNotExist:
+        return None
+    return get_room_snapshot(room)
+
+
 class RoomConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.code = self.scope["url_route"]["kwargs"]["code"]
         self.group_name = f"room_{self.code}"
+        # Letta una sola volta: i broadcast successivi non devono toccare sessione né DB.
+        self.session_key = await self.get_session_key()
+        self.last_version = None
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
-        await self.send_room_state()
+        await self.send(text_data=json.dumps({"type": "hello", "reconnect": reconnect_hints()}))
+        await self.send_room_state(resume=parse_resume(self.scope))
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
         # Support manual ping from client.
-        if text_data == "ping":
+        message = parse_message(text_data)
+        if message.get("type") == "ping":
             logger.debug("RoomConsumer ping", extra={"room": self.code})
-            await self.send_room_state()
+            await self.heartbeat(message.get("version"))
+
+    async def heartbeat(self, client_version=None):
+        """Risponde al ping con la versione nota in processo; rilegge lo stato solo se il client è indietro."""
+        if client_version is None:
+            client_version = self.last_version
+        known = state_versions.get(("room", self.code))
+        if known is None or client_version is None or client_version >= known:
+            await self.send(text_data=json.dumps({"type": "pong", "version": known}))
+            return
+        await self.send_room_state()
 
-    async def send_room_state(self):
-        room = await self.get_room_or_none(self.code)
-        if not room:
+    async def send_room_state(self, resume=None):
+        snapshot = await self.get_room_snapshot(self.code)
+        if snapshot is None:
             await self.send(text_data=json.dumps({"type": "not_found"}))
             return
-        players = await self.get_players(room)
-        host = players[0] if players else None
-        me_session = await self.get_session_key()
-        data_players = []
-        for player in players:
-            data_players.append(
-                {
-                    "nickname": player.nickname,
-                    "icon": player.icon,
-                    "icon_display": f"{ICON_EMOJIS[player.icon]} {ICON_LABELS[player.icon]}",
-                    "is_host": host == player,
-                    "is_me": player.session_key == me_session,
-                }
-            )
-        payload = {
-            "type": "room_state",
-            "room": room.code,
-            "players_count": len(players),
-            "max_players": MAX_PLAYERS,
-            "can_start": len(players) >= 2,
-            "host": host.nickname if host else None,
-            "host_is_me": bool(host and host.session_key == me_session),
-            "players": data_players,
-            "join_url": reverse("join_room", args=[room.code]),
-            "started": room.started,
-        }
-        await self.send(text_data=json.dumps(payload))
+        version = snapshot["state"]["version"]
+        self.last_version = version
+        if resume == version:
+            await self.send(text_data=json.dumps({"type": "up_to_date", "version": version}))
+            return
+        await self.send(text_data=json.dumps(personalise_room_state(snapshot, self.session_key)))
 
     async def room_update(self, event):
-        # On any broadcast, send a fresh state per connection (per-session flags).
-        await self.send_room_state()
+        # Lo snapshot arriva già costruito nel messaggio di gruppo: solo i flag per-sessione qui.
+        version = event["snapshot"]["state"]["version"]
+        state_versions.observe(("room", self.code), version)
+        self.last_version = version
+        await self.send(text_data=json.dumps(personalise_room_state(event["snapshot"], self.session_key)))
 
     async def game_update(self, event):
         # Ignore game updates in the lobby socket.
         return
 
-    @database_sync_to_async
-    def get_room_or_none(self, code):
-        try:
-            return Room.objects.get(code=code)
-        except Room.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def get_players(self, room):
-        return list(room.players.all())
+    async def get_room_snapshot(self, code):
+        return await db_executor.run(code, load_room_snapshot, code)
 
-    @sync_to_async
-    def get_session_key(self):
-        session = self.scope.get("session")
-        return session.session_key if session else None
+    async def get_session_key(self):
+        return await db_executor.run(self.code, session_key_of, self.scope)
 
 
 class GameConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.code = self.scope["url_route"]["kwargs"]["code"]
         self.group_name = f"room_{self.code}"
+        self.session_key = await self.get_session_key()
+        # Con ?delta=1 dopo il primo snapshot completo si inviano solo i patch (game_patch).
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        self.delta = query.get("delta", ["0"])[0] == "1"
+        self.last_state = None
+        self.game_id = None
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
-        await self.send_game_state()
+        await self.send(text_data=json.dumps({"type": "hello", "reconnect": reconnect_hints()}))
+        await self.send_game_state(resume=parse_resume(self.scope) if self.delta else None)
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.group_name, self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
-        if text_data == "ping":
+        message = parse_message(text_data)
+        if message.get("type") == "ping":
             logger.debug("GameConsumer ping", extra={"room": self.code})
-            await self.send_game_state()
+            await self.heartbeat(message.get("version"))
+        elif message.get("type") == "resync":
+            # Il client ha perso un patch: riparte dall'ultimo stato inviato, senza rileggere il DB.
+            if self.last_state is None:
+                await self.send_game_state()
+            else:
+                await self.push_game_state(self.last_state, full=True)
+        elif message.get("type") in GAME_ACTIONS:
+            await self.perform_action(message)
+
+    async def perform_action(self, message):
+        """Esegue choose/answer e risponde con un ack; il nuovo stato arriva a tutti con il broadcast.
+
+        L'ack precede lo stato: il game_update del broadcast viene consegnato a questo consumer
+        solo dopo che il messaggio corrente è stato gestito.
+        """
+        ack = {"type": "ack", "action": message["type"], "request_id": message.get("request_id")}
+        try:
+            snapshot = await GAME_ACTIONS[message["type"]](self.code, self.session_key, message)
+        except ActionRejected as exc:
+            await self.send(text_data=json.dumps({**ack, "ok": False, "status": exc.status, **exc.payload}))
+            return
+        await self.send(text_data=json.dumps({**ack, "ok": True, "version": snapshot["state"]["version"]}))
 
     async def room_update(self, event):
-        await self.send_game_state()
+        # Lo stato di gioco arriva sempre con il suo game_update dedicato.
+        return
 
     async def game_update(self, event):
-        logger.warning("GameConsumer game_update", extra={"room": self.code, "event": event.get("type")})
-        await self.send_game_state()
+        logger.debug("GameConsumer game_update", extra={"room": self.code, "event": event.get("type")})
+        state_versions.observe(("game", self.code), event["snapshot"]["state"]["version"])
+        await self.push_game_state(personalise_game_state(event["snapshot"], self.session_key))
+
+    async def heartbeat(self, client_version=None):
+        """Pong senza DB se il client è allineato; altrimenti lo stato, dalla cache quando possibile."""
+        sent = self.last_state["version"] if self.last_state is not None else None
+        if client_version is None:
+            client_version = sent
+        known = state_versions.get(("game", self.code))
+        if known is None or client_version is None or client_version >= known:
+            await self.send(text_data=json.dumps({"type": "pong", "version": known}))
+            return
+        if sent is not None and sent >= known:
+            # Lo stato aggiornato era già partito ma il client non l'ha applicato: lo si reinvia intero.
+            await self.push_game_state(self.last_state, full=True)
+            return
+        snapshot = game_snapshots.get(self.game_id, known) if self.game_id else None
+        if snapshot is None:
+            await self.send_game_state()
+            return
+        await self.push_game_state(personalise_game_state(snapshot, self.session_key))
 
-    async def send_game_state(self):
-        room = await self.get_room_or_none(self.code)
-        if not room:
+    async def send_game_state(self, resume=None):
+        snapshot, previous, self.game_id = await self.get_game_snapshots(self.code, resume)
+        if snapshot is None:
             await self.send(text_data=json.dumps({"type": "not_found"}))
             return
-        session_key = await self.get_session_key()
-        data = await sync_to_async(build_game_state)(room, session_key=session_key)
-        logger.warning(
+        watch_turn_deadline(self.code)
+        data = personalise_game_state(snapshot, self.session_key)
+        logger.debug(
             "GameConsumer send_game_state",
-            extra={"room": self.code, "session": session_key, "state": data.get("status")},
+            extra={"room": self.code, "session": self.session_key, "state": data.get("status")},
         )
-        await self.send(text_data=json.dumps(data))
+        if resume is not None and resume == data["version"]:
+            # Il client ha già questa versione: basta confermarlo, senza reinviare lo stato.
+            self.last_state = data
+            await self.send(text_data=json.dumps({"type": "up_to_date", "version": resume}))
+            return
+        if previous is not None:
+            # Versione ancora in cache o ricostruita dal log: il client riprende con un patch invece dello snapshot completo.
+            self.last_state = personalise_game_state(previous, self.session_key)
+        await self.push_game_state(data)
 
-    @database_sync_to_async
-    def get_room_or_none(self, code):
-        try:
-            return Room.objects.select_related("game").get(code=code)
-        except Room.DoesNotExist:
-            return None
-
-    @sync_to_async
-    def get_session_key(self):
-        session = self.scope.get("session")
-        return session.session_key if session else None
+    async def push_game_state(self, data, full=False):
+        if self.last_state is not None and data["version"] < self.last_state["version"]:
+            # Una lettura partita prima dell'ultimo broadcast non deve riportare indietro il client.
+            return
+        message = data
+        if self.delta and self.last_state is not None and not full:
+            message = game_patch(self.last_state, data)
+            if message is None:
+                return
+        self.last_state = data
+        await self.send(text_data=json.dumps(message))
+
+    async def get_game_snapshots(self, code, resume=None):
+        return await db_executor.run(code, load_game_snapshots, code, resume)
+
+    async def get_session_key(self):
+        return await db_executor.run(self.code, session_key_of, self.scope)
+
+
+class QuestionImportConsumer(AsyncWebsocketConsumer):
+    """Avanzamento degli import CSV per l'elenco domande in admin (solo staff)."""
+
+    async def connect(self):
+        user = self.scope.get("user")
+        if not user or not user.is_staff:
+            await self.close()
+            return
+        await self.channel_layer.group_add(IMPORT_GROUP, self.channel_name)
+        await self.accept()
+        await self.send(text_data=json.dumps({"type": "import_jobs", "jobs": await self.get_recent_jobs()}))
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(IMPORT_GROUP, self.channel_name)
+
+    async def import_progress(self, event):
+        await self.send(text_data=json.dumps({"type": "import_progress", "job": event["job"]}))
+
+    async def get_recent_jobs(self):
+        return await db_executor.run(IMPORT_GROUP, recent_import_jobs)
+
+
+def recent_import_jobs():
+    return [job.as_dict() for job in QuestionImportJob.objects.all()[:10]]
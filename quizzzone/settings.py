@@ -49,7 +49,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'lobby.middleware.AsyncWhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -159,8 +159,77 @@ if DEBUG:
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 ASGI_APPLICATION = 'quizzzone.asgi.application'
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+# Socket Unix del broker dei gruppi (manage.py channel_broker): se impostato, i broadcast
+# raggiungono i socket di tutti i worker ASGI della macchina, non solo del processo corrente.
+CHANNEL_BROKER_SOCKET = os.environ.get('QUIZZZONE_CHANNEL_BROKER', '')
+if CHANNEL_BROKER_SOCKET:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'lobby.channel_layer.UnixSocketChannelLayer',
+            'CONFIG': {'path': CHANNEL_BROKER_SOCKET},
+        }
     }
-}
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
+    }
+
+# Snapshot dello stato di gioco tenuti in memoria per processo (una voce per partita).
+SNAPSHOT_CACHE_SIZE = int(os.environ.get('QUIZZZONE_SNAPSHOT_CACHE_SIZE', '512'))
+# Versioni precedenti conservate per partita, per rispondere con un patch ai client che riprendono.
+SNAPSHOT_HISTORY = int(os.environ.get('QUIZZZONE_SNAPSHOT_HISTORY', '8'))
+# Build di snapshot e caricamenti dei motori di gioco concorrenti per processo (limita il carico sul DB dopo un riavvio).
+SNAPSHOT_BUILD_CONCURRENCY = int(os.environ.get('QUIZZZONE_SNAPSHOT_BUILD_CONCURRENCY', '4'))
+
+# Motore di gioco in memoria: con 0 ogni azione aspetta il proprio salvataggio prima di ack e broadcast (serve
+# anche se una stanza può finire su più processi). Con 1 le azioni non aspettano il DB (write-behind): una
+# risposta già confermata ai client si salva subito dopo, una scelta entro GAME_FLUSH_DELAY secondi, e l'ultimo
+# salvataggio avviene all'uscita del processo. Un crash o un SIGKILL perde quindi le azioni di quella finestra
+# (il batch in corso più le scelte in attesa), che i client hanno già visto confermate.
+GAME_WRITE_BEHIND = os.environ.get('QUIZZZONE_GAME_WRITE_BEHIND', '0') == '1'
+# Secondi entro cui una scelta viene salvata se la risposta non arriva prima (risposte e fine partita: subito).
+GAME_FLUSH_DELAY = float(os.environ.get('QUIZZZONE_GAME_FLUSH_DELAY', '1'))
+# Eventi del log di una partita tra due checkpoint: un replay legge al più un checkpoint e questa coda.
+GAME_CHECKPOINT_INTERVAL = int(os.environ.get('QUIZZZONE_GAME_CHECKPOINT_INTERVAL', '20'))
+# Partite attive di cui ogni processo tiene il motore in memoria.
+GAME_ENGINE_CACHE_SIZE = int(os.environ.get('QUIZZZONE_GAME_ENGINE_CACHE_SIZE', '512'))
+# Secondi per scegliere la casella e per rispondere (0: nessuna scadenza); allo scadere il turno passa.
+TURN_CHOOSE_TIMEOUT = float(os.environ.get('QUIZZZONE_TURN_CHOOSE_TIMEOUT', '60'))
+TURN_ANSWER_TIMEOUT = float(os.environ.get('QUIZZZONE_TURN_ANSWER_TIMEOUT', '30'))
+# Granularità in secondi della ruota di timer che fa scadere i turni (un solo task per processo).
+TURN_TIMER_TICK = float(os.environ.get('QUIZZZONE_TURN_TIMER_TICK', '0.1'))
+
+# Thread per processo dedicati al DB dei consumer WebSocket e delle azioni di gioco (0: sync_to_async, thread unico).
+DB_EXECUTOR_WORKERS = int(os.environ.get('QUIZZZONE_DB_EXECUTOR_WORKERS', '8'))
+# Secondi dopo cui un thread del pool chiude e riapre la propria connessione al DB.
+DB_EXECUTOR_CONN_MAX_AGE = float(os.environ.get('QUIZZZONE_DB_EXECUTOR_CONN_MAX_AGE', '300'))
+
+# Suggerimenti di backoff inviati ai client WebSocket per la riconnessione (con jitter lato client).
+WS_RECONNECT_MIN_MS = int(os.environ.get('QUIZZZONE_WS_RECONNECT_MIN_MS', '1000'))
+WS_RECONNECT_MAX_MS = int(os.environ.get('QUIZZZONE_WS_RECONNECT_MAX_MS', '30000'))
+
+# Long-poll degli endpoint di stato (?wait=<versione>&timeout=<secondi>).
+LONG_POLL_TIMEOUT = float(os.environ.get('QUIZZZONE_LONG_POLL_TIMEOUT', '25'))
+LONG_POLL_MAX_TIMEOUT = float(os.environ.get('QUIZZZONE_LONG_POLL_MAX_TIMEOUT', '30'))
+
+# Secondi tra due commenti keepalive sugli stream Server-Sent Events (tengono aperti proxy e tunnel).
+SSE_KEEPALIVE = float(os.environ.get('QUIZZZONE_SSE_KEEPALIVE', '15'))
+
+# Secondi di validità degli intervalli di id per casella usati nell'estrazione delle domande.
+QUESTION_SAMPLING_TTL = float(os.environ.get('QUIZZZONE_QUESTION_SAMPLING_TTL', '60'))
+
+# Indice in memoria del banco domande (lobby.question_bank): estrazione e testi senza query.
+QUESTION_BANK_ENABLED = os.environ.get('QUIZZZONE_QUESTION_BANK', '1') == '1'
+# Record di domande (testo, opzioni, risposta) tenuti in memoria per processo.
+QUESTION_BANK_RECORDS = int(os.environ.get('QUIZZZONE_QUESTION_BANK_RECORDS', '20000'))
+# Secondi tra due controlli del contatore condiviso per accorgersi delle modifiche fatte da altri processi.
+QUESTION_BANK_CHECK_INTERVAL = float(os.environ.get('QUIZZZONE_QUESTION_BANK_CHECK_INTERVAL', '5'))
+
+# Righe scritte per transazione (bulk_create) dall'import CSV delle domande.
+QUESTION_IMPORT_CHUNK_SIZE = int(os.environ.get('QUIZZZONE_QUESTION_IMPORT_CHUNK_SIZE', '1000'))
+# Import CSV eseguiti in parallelo per processo, fuori dalle richieste HTTP.
+QUESTION_IMPORT_WORKERS = int(os.environ.get('QUIZZZONE_QUESTION_IMPORT_WORKERS', '2'))
+# Cartella per gli upload in attesa di import (default: cartella temporanea di sistema).
+QUESTION_IMPORT_DIR = os.environ.get('QUIZZZONE_QUESTION_IMPORT_DIR') or None